@@ -0,0 +1,495 @@
+import os
+import json
+import math
+import time
+import random
+import shutil
+import string
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from gfs_client import GFSClient, GFSError
+from start_cluster import NODES_CONFIG, PYTHON_EXE, SERVING_MODE, STOP_TIMEOUT
+
+# --- Configuration ---
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = ["create", "update", "read", "lookup", "access"]
+DEFAULT_MIX = "create=1,update=2,read=6,lookup=2,access=1"
+READY_TIMEOUT = 30         # Seconds for a fresh cluster to elect a leader and see every chunkserver
+POLL_INTERVAL = 0.05       # Seconds between probes while measuring a fault
+PROBE_TIMEOUT = 0.5
+EDIT_FRACTION = 0.01       # Share of a document's characters rewritten by one update
+
+
+# --- Cluster ---
+def topology(masters, chunkservers):
+    """NODES_CONFIG resized: the same first ports and argument shapes, with more or fewer nodes."""
+    master_base = min(p for p, c in NODES_CONFIG.items() if c["type"] == "master")
+    chunk_base = min(p for p, c in NODES_CONFIG.items() if c["type"] == "chunk")
+    master_ports = [master_base + i for i in range(masters)]
+    nodes = {}
+    for port in master_ports:
+        nodes[port] = {"type": "master", "args": [",".join(str(p) for p in master_ports if p != port)]}
+    for i in range(chunkservers):
+        nodes[chunk_base + i] = {"type": "chunk", "args": [",".join(str(p) for p in master_ports)]}
+    return nodes
+
+
+class Cluster:
+    """
+    A throwaway cluster for one run: every node starts in a fresh working directory,
+    so results never depend on (or disturb) the metadata and chunks of a dev cluster.
+    """
+    def __init__(self, nodes, serving_mode, workdir=None):
+        self.nodes = nodes
+        self.serving_mode = serving_mode
+        self.workdir = workdir or tempfile.mkdtemp(prefix="gfs-bench-")
+        self.processes = {}
+
+    @property
+    def masters(self):
+        return [p for p, c in self.nodes.items() if c["type"] == "master"]
+
+    @property
+    def chunkservers(self):
+        return [p for p, c in self.nodes.items() if c["type"] == "chunk"]
+
+    def start(self):
+        os.makedirs(os.path.join(self.workdir, "logs"), exist_ok=True)
+        for port in self.nodes:
+            self.spawn(port)
+        print(f"[BENCH] Started {len(self.masters)} masters and {len(self.chunkservers)} chunkservers in {self.workdir}")
+
+    def spawn(self, port):
+        conf = self.nodes[port]
+        env = {**os.environ, "GFS_SERVING_MODE": self.serving_mode}
+        script = os.path.join(BACKEND_DIR, "master.py" if conf["type"] == "master" else "chunkserver.py")
+        log = open(os.path.join(self.workdir, "logs", f"node_{port}.log"), "a")
+        self.processes[port] = subprocess.Popen([PYTHON_EXE, script, str(port)] + conf["args"],
+                                                cwd=self.workdir, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+    def restart_empty(self, port):
+        """Starts a stopped master again without its database (its WAL and checkpoint stay behind)."""
+        self.processes[port].wait(timeout=STOP_TIMEOUT)
+        os.remove(os.path.join(self.workdir, f"master_{port}.db"))
+        self.spawn(port)
+
+    def stop(self, keep=False):
+        for p in self.processes.values():
+            if p.poll() is None:
+                p.terminate()
+        for p in self.processes.values():
+            try:
+                p.wait(timeout=STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def health(port):
+    try:
+        return requests.get(f"http://localhost:{port}/health", timeout=PROBE_TIMEOUT).json()
+    except:
+        return None
+
+
+def find_leader(masters):
+    for port in masters:
+        h = health(port)
+        if h and h.get('role') == 'leader':
+            return port
+    return None
+
+
+def leader_status(masters):
+    leader = find_leader(masters)
+    if leader is None:
+        return None
+    try:
+        return requests.get(f"http://localhost:{leader}/system/status", timeout=PROBE_TIMEOUT).json()
+    except:
+        return None
+
+
+def wait_until_ready(masters, chunkservers, timeout=READY_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = leader_status(masters)
+        if status and set(chunkservers) <= set(status.get('live_chunkservers', [])):
+            return status['node_id']
+        time.sleep(0.25)
+    raise RuntimeError(f"Cluster not ready after {timeout}s (no leader, or chunkservers missing)")
+
+
+# --- Workload ---
+class Recorder:
+    """Collects (operation, start offset, seconds, ok) samples from every worker."""
+    def __init__(self, origin):
+        self.origin = origin
+        self.lock = threading.Lock()
+        self.samples = []
+        self.errors = {}  # {operation: {message: count}}
+
+    def record(self, op, started, ok, error=None):
+        sample = (op, started - self.origin, time.time() - started, ok)
+        with self.lock:
+            self.samples.append(sample)
+            if error:
+                by_message = self.errors.setdefault(op, {})
+                by_message[error] = by_message.get(error, 0) + 1
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {op}; expected one of {OPERATIONS}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def random_text(rng, size):
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(64)]
+    out, length = [], 0
+    while length < size:
+        word = rng.choice(words)
+        out.append(word)
+        length += len(word) + 1
+    return " ".join(out)[:size]
+
+
+class Worker(threading.Thread):
+    """One simulated user: owns documents, edits and reads them, and asks for access to others'."""
+    def __init__(self, index, args, user_id, masters, shared_docs, recorder, stop_event):
+        super().__init__(name=f"bench-{index}", daemon=True)
+        self.args = args
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.client = GFSClient(user_id, master_ports=masters,
+                                location_ttl=0 if args.no_location_cache else args.location_ttl)
+        self.user_id = user_id
+        self.shared_docs = shared_docs
+        self.recorder = recorder
+        self.stop_event = stop_event
+        self.docs = {}  # {file_id: content}
+        self.ops = list(args.mix)
+        self.weights = [args.mix[op] for op in self.ops]
+
+    def doc_size(self):
+        jitter = self.args.size_jitter
+        return max(1, int(self.args.doc_size * self.rng.uniform(1 - jitter, 1 + jitter)))
+
+    def seed(self, count):
+        for i in range(count):
+            self.create()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            op = self.rng.choices(self.ops, self.weights)[0]
+            if op != "create" and op != "access" and not self.docs:
+                op = "create"
+            started = time.time()
+            try:
+                getattr(self, op)()
+                self.recorder.record(op, started, True)
+            except (GFSError, requests.RequestException) as e:
+                self.recorder.record(op, started, False, str(e)[:120])
+
+    # --- Operations ---
+    def create(self):
+        content = random_text(self.rng, self.doc_size())
+        file_id = self.client.create(f"bench-{self.name}-{len(self.docs)}", content)
+        self.docs[file_id] = content
+        self.shared_docs.append(file_id)
+
+    def update(self):
+        file_id = self.rng.choice(list(self.docs))
+        content = self.docs[file_id]
+        span = max(1, int(len(content) * EDIT_FRACTION))
+        at = self.rng.randrange(0, max(1, len(content) - span))
+        content = content[:at] + random_text(self.rng, span) + content[at + span:]
+        self.client.write(file_id, content)
+        self.docs[file_id] = content
+
+    def read(self):
+        file_id = self.rng.choice(list(self.docs))
+        content, _ = self.client.read(file_id)
+        if content != self.docs[file_id]:
+            raise GFSError("Read returned stale content")
+
+    def lookup(self):
+        """A metadata-only round trip to a master, bypassing the client's location cache."""
+        file_id = self.rng.choice(list(self.docs))
+        self.client.read_request("post", f"/file/lookup/{file_id}", {"user_id": self.user_id})
+
+    def access(self):
+        others = [f for f in self.shared_docs[-256:] if f not in self.docs]
+        if not others:
+            return
+        self.client.leader_request("post", "/access/request", {
+            "file_id": self.rng.choice(others),
+            "user_id": self.user_id,
+            "access_type": "READ"
+        })
+
+
+# --- Faults ---
+class Fault(threading.Thread):
+    """
+    Kills a node through /admin/kill at `at` seconds into the run and measures recovery.
+    leader: until another master holds the leader lease, and until the first metadata write
+    issued after the kill succeeds. chunkserver: until the leader has dropped the node and
+    re-replicated every chunk it held. rejoin: a leader fault, after which the old leader
+    restarts with its database deleted; until it holds what the new leader had, and until
+    every master's log agrees again (it bootstraps from a peer before it may lead again).
+    """
+    def __init__(self, kind, at, cluster_masters, chunkservers, recorder, seed, victim=None, timeout=60, cluster=None):
+        super().__init__(name="bench-fault", daemon=True)
+        self.kind, self.at, self.victim, self.timeout, self.cluster = kind, at, victim, timeout, cluster
+        self.masters, self.chunkservers = cluster_masters, chunkservers
+        self.recorder = recorder
+        self.rng = random.Random(seed)
+        self.result = {"kind": kind, "at": at}
+
+    def run(self):
+        time.sleep(max(0, self.recorder.origin + self.at - time.time()))
+        try:
+            victim = self.victim or (find_leader(self.masters) if self.kind in ("leader", "rejoin")
+                                     else self.rng.choice(self.chunkservers))
+            self.result["victim"] = victim
+            requests.post(f"http://localhost:{victim}/admin/kill", timeout=PROBE_TIMEOUT)
+            down_at = self.wait_for(lambda: health(victim) is None)
+            if down_at is None:
+                self.result["error"] = "Victim never went down"
+                return
+            self.result["down_at"] = round(down_at - self.recorder.origin, 3)
+            if self.kind == "leader":
+                self.measure_failover(victim, down_at)
+            elif self.kind == "rejoin":
+                self.measure_failover(victim, down_at)
+                self.measure_rejoin(victim)
+            else:
+                self.measure_rereplication(victim, down_at)
+        except Exception as e:
+            self.result["error"] = str(e)
+
+    def wait_for(self, condition, since=None):
+        deadline = (since or time.time()) + self.timeout
+        while time.time() < deadline:
+            if condition():
+                return time.time()
+            time.sleep(POLL_INTERVAL)
+        return None
+
+    def measure_failover(self, victim, down_at):
+        survivors = [p for p in self.masters if p != victim]
+        elected = self.wait_for(lambda: find_leader(survivors) is not None, down_at)
+        self.result["new_leader"] = find_leader(survivors)
+        self.result["election_seconds"] = round(elected - down_at, 3) if elected else None
+
+        # Metadata write availability as clients saw it: the first create or access request
+        # issued after the old leader went down that succeeded. Updates are left out: with
+        # a cached lease they go straight to the primary and never notice the failover.
+        def first_write():
+            with self.recorder.lock:
+                done = [s for s in self.recorder.samples
+                        if s[0] in ("create", "access") and s[3] and s[1] >= down_at - self.recorder.origin]
+            return min((s[1] + s[2] for s in done), default=None)
+        self.wait_for(lambda: first_write() is not None, down_at)
+        finished = first_write()
+        self.result["write_recovery_seconds"] = (
+            round(finished - (down_at - self.recorder.origin), 3) if finished is not None else None)
+
+    def measure_rejoin(self, victim):
+        new_leader = self.result.get("new_leader")
+        target = (health(new_leader) or {}).get('last_applied', 0)
+        restarted = time.time()
+        self.cluster.restart_empty(victim)
+        self.result["restarted_at"] = round(restarted - self.recorder.origin, 3)
+        rejoined = self.wait_for(lambda: (health(victim) or {}).get('last_applied', -1) >= target, restarted)
+        self.result["rejoin_seconds"] = round(rejoined - restarted, 3) if rejoined else None
+        self.result["leader_after_rejoin"] = find_leader(self.masters)
+
+        def positions():
+            return {(h.get('last_term'), h.get('last_applied')) if h else None for h in map(health, self.masters)}
+        converged = self.wait_for(lambda: len(positions()) == 1 and None not in positions(), restarted)
+        self.result["converged_seconds"] = round(converged - restarted, 3) if converged else None
+
+    def measure_rereplication(self, victim, down_at):
+        dropped = self.wait_for(lambda: victim not in ((leader_status(self.masters) or {}).get('live_chunkservers') or [victim]), down_at)
+        self.result["detection_seconds"] = round(dropped - down_at, 3) if dropped else None
+        if not dropped:
+            return
+
+        def repaired():
+            status = leader_status(self.masters)
+            if not status:
+                return False
+            repair = status['rereplication']
+            return (repair['last_scan'] or 0) > dropped and repair['under_replicated'] == 0 \
+                and repair['queued'] == 0 and repair['in_progress'] == 0
+        done = self.wait_for(repaired, down_at)
+        self.result["recovery_seconds"] = round(done - down_at, 3) if done else None
+        status = leader_status(self.masters) or {}
+        self.result["rereplication"] = status.get('rereplication')
+
+
+# --- Report ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)  # Nearest rank
+    return sorted_values[rank]
+
+
+def summarize(samples, elapsed):
+    report = {}
+    for op in OPERATIONS + ["all"]:
+        mine = [s for s in samples if op == "all" or s[0] == op]
+        if not mine:
+            continue
+        ok = sorted(s[2] for s in mine if s[3])
+        report[op] = {
+            "count": len(mine),
+            "errors": len(mine) - len(ok),
+            "throughput": round(len(ok) / elapsed, 2),
+            **{f"p{p}_ms": round(percentile(ok, p) * 1000, 2) if ok else None for p in (50, 95, 99)},
+            "max_ms": round(ok[-1] * 1000, 2) if ok else None
+        }
+    return report
+
+
+def timeline(samples, elapsed):
+    """Completed and failed operations per second of the run, to see a fault's dent."""
+    seconds = [{"ok": 0, "errors": 0} for _ in range(int(elapsed) + 1)]
+    for op, start, duration, ok in samples:
+        second = min(len(seconds) - 1, int(start + duration))
+        seconds[second]["ok" if ok else "errors"] += 1
+    return seconds
+
+
+def print_report(results, baseline=None):
+    print(f"\n{'op':<8}{'count':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, r in results["operations"].items():
+        row = f"{op:<8}{r['count']:>8}{r['errors']:>8}{r['throughput']:>10}" + "".join(
+            f"{r[k] if r[k] is not None else '-':>10}" for k in ("p50_ms", "p95_ms", "p99_ms"))
+        old = (baseline or {}).get("operations", {}).get(op)
+        if old and old["throughput"] and old["p99_ms"] and r["p99_ms"]:
+            row += (f"   vs baseline: {100 * (r['throughput'] / old['throughput'] - 1):+.1f}% ops/s, "
+                    f"{100 * (r['p99_ms'] / old['p99_ms'] - 1):+.1f}% p99")
+        print(row)
+    if results.get("fault"):
+        print(f"\nFault: {json.dumps(results['fault'])}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-tests a GFS cluster and reports per-operation latency.")
+    parser.add_argument("--masters", type=int, default=sum(c["type"] == "master" for c in NODES_CONFIG.values()))
+    parser.add_argument("--chunkservers", type=int, default=sum(c["type"] == "chunk" for c in NODES_CONFIG.values()))
+    parser.add_argument("--external", action="store_true", help="Use the cluster already running on the NODES_CONFIG ports")
+    parser.add_argument("--serving", choices=["production", "dev"], default=SERVING_MODE)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of measured load")
+    parser.add_argument("--concurrency", type=int, default=8, help="Simulated users issuing operations back to back")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--doc-size", type=int, default=4096, help="Mean document size in characters")
+    parser.add_argument("--size-jitter", type=float, default=0.5, help="Sizes vary uniformly by this fraction")
+    parser.add_argument("--seed-docs", type=int, default=2, help="Documents each user creates before measuring")
+    parser.add_argument("--location-ttl", type=float, default=30, help="Client location cache TTL in seconds")
+    parser.add_argument("--no-location-cache", action="store_true", help="Look up locations on every read")
+    parser.add_argument("--fault", choices=["none", "leader", "chunkserver", "rejoin"], default="none")
+    parser.add_argument("--fault-at", type=float, default=10, help="Seconds into the run to inject the fault")
+    parser.add_argument("--victim", type=int, help="Port to kill (default: the leader, or a seeded-random chunkserver)")
+    parser.add_argument("--recovery-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Results JSON path (default bench_results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results JSON to print deltas against")
+    parser.add_argument("--keep", action="store_true", help="Keep the cluster's working directory and logs")
+    args = parser.parse_args()
+    if args.fault == "rejoin" and args.external:
+        parser.error("--fault rejoin restarts a master, so it needs the benchmark's own cluster")
+
+    nodes = topology(args.masters, args.chunkservers) if not args.external else NODES_CONFIG
+    cluster = None if args.external else Cluster(nodes, args.serving)
+    masters = [p for p, c in nodes.items() if c["type"] == "master"]
+    chunkservers = [p for p, c in nodes.items() if c["type"] == "chunk"]
+    try:
+        if cluster:
+            cluster.start()
+        leader = wait_until_ready(masters, chunkservers)
+        print(f"[BENCH] Leader {leader}; {len(chunkservers)} chunkservers live")
+
+        # Users (registered once on the leader), then each seeds its own documents
+        run_id = f"{int(time.time())}-{args.seed}"
+        setup = GFSClient(None, master_ports=masters)
+        users = [setup.leader_request("post", "/auth/register", {"username": f"bench-{run_id}-{i}",
+                                                                 "password": "bench"})['user_id']
+                 for i in range(args.concurrency)]
+        shared_docs, stop_event = [], threading.Event()
+        recorder = Recorder(time.time())
+        workers = [Worker(i, args, users[i], masters, shared_docs, recorder, stop_event)
+                   for i in range(args.concurrency)]
+        seeding = [threading.Thread(target=w.seed, args=(args.seed_docs,)) for w in workers]
+        for t in seeding: t.start()
+        for t in seeding: t.join()
+        print(f"[BENCH] Seeded {len(shared_docs)} documents; measuring for {args.duration}s")
+
+        recorder = Recorder(time.time())
+        for w in workers:
+            w.recorder = recorder
+        fault = None
+        if args.fault != "none":
+            fault = Fault(args.fault, args.fault_at, masters, chunkservers, recorder, args.seed,
+                          args.victim, args.recovery_timeout, cluster)
+            fault.start()
+        for w in workers:
+            w.start()
+        time.sleep(args.duration)
+        stop_event.set()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - recorder.origin
+        if fault:
+            fault.join(timeout=max(0, recorder.origin + args.fault_at + args.recovery_timeout - time.time()))
+
+        results = {
+            "revision": git_revision(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(recorder.origin)),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "keep")},
+            "elapsed_seconds": round(elapsed, 3),
+            "operations": summarize(recorder.samples, elapsed),
+            "error_messages": recorder.errors,
+            "timeline": timeline(recorder.samples, elapsed),
+            "fault": fault.result if fault else None,
+            "clients": [w.client.stats() for w in workers]
+        }
+        output = args.output or os.path.join("bench_results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        print_report(results, baseline)
+        print(f"\n[BENCH] Results written to {output}")
+    finally:
+        if cluster:
+            cluster.stop(keep=args.keep)
+            if args.keep:
+                print(f"[BENCH] Cluster logs kept in {cluster.workdir}/logs")
+
+
+if __name__ == "__main__":
+    main()
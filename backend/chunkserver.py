@@ -5,8 +5,16 @@ import threading
 import sqlite3
 import requests
 import random
-from flask import Flask, request, jsonify
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from segment_store import SegmentStore
+from staging_store import StagingStore, StagingFull
+import serving
+import metrics
 
 # --- Arg Parsing ---
 if len(sys.argv) < 3:
@@ -20,32 +28,187 @@ except:
     MASTER_PORTS = []
 
 DB_NAME = f"chunk_{PORT}.db"
+SEGMENT_DIR = f"chunks_{PORT}"
+STAGING_DIR = f"staging_{PORT}"
+
+# --- Replication Fan-out ---
+REPLICA_TIMEOUT = 1.0      # Seconds per secondary commit
+PUSH_TIMEOUT = 5.0         # Seconds to stream staged data to the next replica in the chain
+PUSH_BLOCK = 64 * 1024     # Bytes read from the client before forwarding down the chain
+REPLICA_RETRIES = 2        # Background retries for a secondary that missed a commit
+ACK_POLICY = os.environ.get("GFS_ACK_POLICY", "all")  # "all": every secondary must ack | "majority": a majority of replicas, rest in background
+FANOUT_WORKERS = 16
+
+# --- Record Append ---
+DEFAULT_CHUNK_CAPACITY = 64 * 1024  # Characters, when the client does not pass the master's chunk size
+MAX_RECORD_FRACTION = 4             # A record may use at most 1/4 of a chunk (as in GFS)
+
+# --- Read Cache ---
+READ_CACHE_BYTES = 32 * 1024 * 1024  # Hot chunks kept in memory
+
+# --- Compression ---
+CHUNK_CODEC = os.environ.get("GFS_CHUNK_CODEC", "zlib-6")  # "none", "zlib-1", "zlib-6" or "zlib-9"
+WIRE_ENCODINGS = {"deflate": "zlib-6"}  # HTTP Content-Encoding -> a codec that decodes it
 
 app = Flask(__name__)
 CORS(app)
+metrics.install(app)
 
 # --- Internal State ---
 simulated_clock_offset = 0
+store = None  # SegmentStore, opened in init_db()
+chunk_locks = {}  # {handle: Lock} serializes version assignment per chunk on the primary
+chunk_locks_guard = threading.Lock()
+append_queues = {}    # {handle: [pending append slots]} combined into one batch per lock holder
+sealed_chunks = set() # Chunks that turned away a record; later appends go to the next chunk
+replica_failures = []  # [{'handle', 'port'}] secondaries that missed a commit, reported via heartbeat
+failures_lock = threading.Lock()
+mutated_as_primary = set()  # Handles we serialized mutations for since the last heartbeat (lease extension)
+
+# Keep-alive connections to peer chunkservers, shared by all fan-out workers. Every
+# request is marked as peer traffic, which admission control never turns away.
+peer_session = requests.Session()
+peer_session.headers["X-Forwarded-By"] = str(PORT)
+peer_session.mount("http://", HTTPAdapter(pool_connections=FANOUT_WORKERS, pool_maxsize=FANOUT_WORKERS))
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
 request_count = 0
-staging_buffer = {} # Memory buffer for 2-phase commit
+in_flight = 0  # Requests currently being served, reported to the master for placement
+counter_lock = threading.Lock()
+staging = StagingStore(STAGING_DIR)  # Bounded buffer for 2-phase commit, keyed by (handle, data_id)
+wire_counters = {"compressed_pushes": 0, "compressed_reads": 0, "wire_bytes_saved": 0}
 
 def get_simulated_time():
     return time.time() + simulated_clock_offset
 
 @app.before_request
 def count_requests():
-    global request_count
-    request_count += 1
+    global request_count, in_flight
+    with counter_lock:
+        request_count += 1
+        in_flight += 1
+
+@app.teardown_request
+def finish_request(exc):
+    global in_flight
+    with counter_lock:
+        in_flight -= 1
+
+def load_stats(elapsed, requests_before):
+    """Placement inputs for the master: what we store and how busy we are."""
+    storage = store.stats()
+    return {
+        "stored_bytes": storage["live_bytes"],
+        "chunk_count": storage["chunks"],
+        "in_flight": in_flight,
+        "request_rate": round((request_count - requests_before) / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+# --- Read Cache ---
+class ChunkCache:
+    """
+    Byte-bounded LRU of hot chunks, so read fan-in on a popular document is served
+    from memory. A chunk is cached in the forms readers asked for: 'payload' (the
+    text) and 'stored' (the bytes as stored, compressed under the chunk's codec, sent
+    as-is to deflate readers). Commits replace the cached copy; a per-handle generation
+    stops a slow reader from caching data that a concurrent commit already replaced.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {handle: {'entry': entry, form: bytes, ...}} in LRU order
+        self.generations = {}         # {handle: commits seen}
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, handle, form="payload"):
+        """(entry, bytes) of the chunk in `form`, or None."""
+        with self.lock:
+            cached = self.entries.get(handle)
+            if cached is None or form not in cached:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(handle)
+            self.counters["hits"] += 1
+            return cached['entry'], cached[form]
+
+    def admits(self, size):
+        """Chunks over a quarter of the cache would displace the whole working set."""
+        return size <= self.capacity // 4
+
+    def generation(self, handle):
+        with self.lock:
+            return self.generations.get(handle, 0)
+
+    def put(self, handle, entry, data, generation=None, form="payload"):
+        with self.lock:
+            if generation is not None and generation != self.generations.get(handle, 0):
+                return  # A commit landed while this reader was fetching
+            cached = self.entries.get(handle)
+            if cached is not None and cached['entry']['version'] != entry['version']:
+                self.drop(handle)
+                cached = None
+            if not self.admits(len(data)):
+                return
+            if cached is None:
+                cached = self.entries[handle] = {'entry': entry}
+            self.bytes += len(data) - len(cached.get(form, b""))
+            cached[form] = data
+            self.entries.move_to_end(handle)
+            while self.bytes > self.capacity:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= cache_size(old)
+                self.counters["evictions"] += 1
+
+    def replace(self, handle, entry, payload):
+        """Called on commit: bump the generation and cache the new version."""
+        with self.lock:
+            self.generations[handle] = self.generations.get(handle, 0) + 1
+            self.drop(handle)
+        self.put(handle, entry, payload)
+
+    def invalidate(self, handle):
+        """Called when a chunk is deleted: forget it and fence off in-flight readers."""
+        with self.lock:
+            self.generations[handle] = self.generations.get(handle, 0) + 1
+            self.drop(handle)
+
+    def drop(self, handle):
+        cached = self.entries.pop(handle, None)
+        if cached:
+            self.bytes -= cache_size(cached)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes, "capacity": self.capacity, **self.counters}
+
+def cache_size(cached):
+    return sum(len(v) for k, v in cached.items() if k != 'entry')
+
+read_cache = ChunkCache(READ_CACHE_BYTES)
+
+# --- Metrics ---
+metrics.gauge("gfs_staging_bytes", "Pushed-but-uncommitted bytes, by where they are held",
+              lambda: {(("tier", t),): staging.stats()[f"{t}_bytes"] for t in ("memory", "disk")})
+metrics.gauge("gfs_staging_entries", "Pushed-but-uncommitted writes", lambda: staging.stats()["entries"])
+metrics.gauge("gfs_read_cache_bytes", "Hot chunk bytes held in memory", lambda: read_cache.stats()["bytes"])
+metrics.gauge("gfs_stored_bytes", "Live chunk bytes in the segment store", lambda: store.stats()["live_bytes"])
+metrics.gauge("gfs_chunks", "Chunks stored", lambda: store.stats()["chunks"])
+metrics.gauge("gfs_primary_mutations_pending", "Chunks mutated as primary whose lease extension is not yet sent",
+              lambda: len(mutated_as_primary))
+metrics.gauge("gfs_in_flight", "Requests being served", lambda: in_flight)
+metrics.gauge("gfs_threads", "Live Python threads", threading.active_count)
 
 # --- Database ---
 def init_db():
+    """Opens the segment store; chunk_{PORT}.db now only holds the segment index."""
+    global store
     try:
+        store = SegmentStore(SEGMENT_DIR, DB_NAME, CHUNK_CODEC)
         conn = sqlite3.connect(DB_NAME, timeout=10)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS stored_chunks 
-                     (handle TEXT PRIMARY KEY, data TEXT, version INT, last_mod FLOAT)''')
-        conn.commit()
+        migrated = store.import_legacy(conn)
         conn.close()
+        if migrated:
+            print(f"[CHUNKSERVER-{PORT}] Migrated {migrated} chunks into segment files.")
     except Exception as e:
         print(f"DB Error: {e}")
         sys.exit(1)
@@ -54,72 +217,537 @@ def init_db():
 def send_heartbeat():
     # Add startup jitter to prevent thundering herd on Master
     time.sleep(random.uniform(0.5, 3.0))
+    last_sent, requests_before = time.time(), request_count
     
     while True:
+        with failures_lock:
+            failures = list(replica_failures)
+        # GFS LEASES: ask to extend the leases of chunks we are actively mutating
+        extensions = list(mutated_as_primary)
+        mutated_as_primary.difference_update(extensions)
+        now = time.time()
+        stats = load_stats(now - last_sent, requests_before)
+        last_sent, requests_before = now, request_count
+        delivered = False
         for m in MASTER_PORTS:
             try:
-                requests.post(f"http://localhost:{m}/heartbeat", 
-                              json={"port": PORT, "time": get_simulated_time()}, 
-                              timeout=0.5)
+                with metrics.rpc("heartbeat", m):
+                    requests.post(f"http://localhost:{m}/heartbeat",
+                                  json={"port": PORT, "time": get_simulated_time(),
+                                        "replica_failures": failures,
+                                        "chunk_versions": store.versions(),
+                                        "stats": stats,
+                                        "lease_extensions": extensions},
+                                  timeout=0.5)
+                delivered = True
             except:
                 pass # Master might be down, just retry next interval
+        if delivered and failures:
+            with failures_lock:
+                del replica_failures[:len(failures)]
         time.sleep(5)
 
 # --- GFS Data Logic ---
 
+def chunk_lock(handle):
+    with chunk_locks_guard:
+        return chunk_locks.setdefault(handle, threading.Lock())
+
+def current_version(handle):
+    entry = store.stat(handle)
+    return entry['version'] if entry else 0
+
+def forward_push(port, handle, data_id, chain, body, encoding=None):
+    """Pushes data to the next replica in the chain. Returns the ports that staged it."""
+    headers = {"Content-Type": "application/octet-stream",
+               "X-Chunk-Handle": handle, "X-Data-Id": data_id,
+               "X-Forward-To": ",".join(map(str, chain))}
+    if encoding:
+        headers["Content-Encoding"] = encoding  # Forwarded still compressed
+    try:
+        with metrics.rpc("push", port):
+            r = peer_session.post(f"http://localhost:{port}/chunk/stage", data=body, timeout=PUSH_TIMEOUT,
+                                  headers=headers)
+        r.raise_for_status()
+        return r.json().get("staged", [])
+    except requests.RequestException:
+        print(f"Chain push of {handle} to {port} failed")
+        return None
+
 @app.route('/chunk/stage', methods=['POST'])
 def stage_chunk():
-    """Phase 1: Hold data in memory."""
-    data = request.json
-    staging_buffer[data['handle']] = data['content']
-    return jsonify({"status": "staged"})
+    """
+    Phase 1: Hold data in memory.
+    GFS DATA FLOW: The raw body is pushed along a chain of replicas (X-Forward-To).
+    Each hop forwards bytes to the next replica while it is still receiving them,
+    so the client's uplink carries the data once. Staged data is keyed by data ID.
+    A body sent with Content-Encoding: deflate travels the whole chain compressed and
+    is only inflated by each hop for its own staging buffer.
+    """
+    handle = request.headers.get('X-Chunk-Handle')
+    data_id = request.headers.get('X-Data-Id')
+    if not handle or not data_id:
+        return jsonify({"error": "X-Chunk-Handle and X-Data-Id required"}), 400
+    encoding = request.headers.get('Content-Encoding')
+    if encoding and encoding not in WIRE_ENCODINGS:
+        return jsonify({"error": f"Unsupported Content-Encoding {encoding}"}), 415
+    chain = [int(p) for p in request.headers.get('X-Forward-To', '').split(",") if p]
+
+    received = bytearray()
+    def tee():
+        while True:
+            piece = request.stream.read(PUSH_BLOCK)
+            if not piece:
+                break
+            received.extend(piece)
+            yield piece
+
+    incoming = tee()
+    downstream = []
+    while chain:
+        next_port, chain = chain[0], chain[1:]
+        if not received:
+            staged = forward_push(next_port, handle, data_id, chain, incoming, encoding)
+        else:
+            # The streaming hop broke part-way: finish receiving, then route around it
+            for _ in incoming: pass
+            staged = forward_push(next_port, handle, data_id, chain, bytes(received), encoding)
+        if staged is not None:
+            downstream = staged
+            break
+    for _ in incoming: pass  # Drain whatever the downstream hop did not consume
+
+    body = bytes(received)
+    if encoding:
+        try:
+            body = store.decode(WIRE_ENCODINGS[encoding], body)
+        except zlib.error:
+            return jsonify({"error": "Corrupt compressed body"}), 400
+        wire_counters["compressed_pushes"] += 1
+        wire_counters["wire_bytes_saved"] += len(body) - len(received)
+
+    try:
+        staging.put(handle, data_id, body)
+    except StagingFull as e:
+        return jsonify({"error": str(e)}), 507
+    return jsonify({"status": "staged", "staged": [PORT] + downstream})
+
+def forward_mutation(sec, path, payload, retries=0):
+    """Sends one secondary a mutation (commit/patch) over the pooled session. Returns True on ack."""
+    for attempt in range(retries + 1):
+        try:
+            with metrics.rpc("fanout" + path.replace("/chunk/", "_"), sec):  # fanout_commit, fanout_patch, ...
+                r = peer_session.post(f"http://localhost:{sec}{path}", json=payload, timeout=REPLICA_TIMEOUT)
+            if r.ok:
+                return True
+        except requests.RequestException:
+            pass
+    return False
+
+def report_failure(handle, sec, version):
+    """Queues, for the next heartbeat, a secondary that never applied `version` of the chunk."""
+    print(f"Failed to replicate {handle} v{version} to {sec}")
+    with failures_lock:
+        replica_failures.append({"handle": handle, "port": sec, "version": version})
+
+def repair_in_background(future, handle, sec, path, payload):
+    """A secondary that missed the quorum window gets retried, then reported to the master."""
+    def on_done(f):
+        if f.result() or forward_mutation(sec, path, payload, retries=REPLICA_RETRIES):
+            return
+        report_failure(handle, sec, payload.get('assigned_version', 0))
+    future.add_done_callback(on_done)
+
+def required_acks(policy, num_secondaries):
+    """Secondary acks needed; the primary already holds the data, so majority needs one fewer."""
+    if policy == "all":
+        return num_secondaries
+    return (num_secondaries + 1) // 2
+
+def replicate_to_secondaries(handle, secondaries, payload, policy, path="/chunk/commit"):
+    """
+    GFS REPLICATION:
+    Fans a mutation out to all secondaries concurrently. Returns (acked, failed, pending)
+    once the ack policy is satisfied or can no longer be; stragglers keep going in the
+    background and are reported to the master if they ultimately fail.
+    """
+    if not secondaries:
+        return [], [], []
+    needed = required_acks(policy, len(secondaries))
+
+    futures = {fanout_pool.submit(forward_mutation, sec, path, payload): sec for sec in secondaries}
+    acked, failed = [], []
+    try:
+        for f in as_completed(futures, timeout=REPLICA_TIMEOUT * 2):
+            (acked if f.result() else failed).append(futures[f])
+            if len(acked) >= needed or len(secondaries) - len(failed) < needed:
+                break
+    except FuturesTimeout:
+        pass
+
+    pending = [sec for f, sec in futures.items() if sec not in acked and sec not in failed]
+    for f, sec in futures.items():
+        if sec in pending:
+            repair_in_background(f, handle, sec, path, payload)
+    for sec in failed:
+        report_failure(handle, sec, payload.get('assigned_version', 0))
+    return acked, failed, pending
 
 @app.route('/chunk/commit', methods=['POST'])
 def commit_chunk():
-    """Phase 2: Write to DB and propagate."""
+    """
+    Phase 2: Write to DB and propagate.
+    CHUNK VERSIONING: The primary assigns version = its current version + 1 and
+    secondaries store exactly that version. The client passes the version the master
+    reported; a primary behind it is stale and refuses the mutation.
+    Fan-out happens under the chunk lock so secondaries see mutations in primary order.
+    """
     data = request.json
     handle = data['handle']
+    data_id = data.get('data_id')
+    assigned = data.get('assigned_version')  # Set when a primary forwards to us
     
-    if handle not in staging_buffer:
+    content = staging.get(handle, data_id)
+    if content is None:
         return jsonify({"error": "No data staged"}), 400
     
-    content = staging_buffer[handle]
+    with chunk_lock(handle):
+        local = current_version(handle)
+        if assigned is None:
+            if local < data.get('version', 0):
+                return jsonify({"error": "Stale primary", "version": local}), 409
+            version = local + 1
+            mutated_as_primary.add(handle)
+        elif assigned <= local:
+            # A newer mutation already reached us; never regress
+            staging.discard(handle, data_id)
+            return jsonify({"status": "committed", "version": local})
+        else:
+            version = assigned
+
+        try:
+            with metrics.store("commit"):
+                store.put(handle, content, version)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        read_cache.replace(handle, store.stat(handle), content)
     
+        # Clear buffer
+        staging.discard(handle, data_id)
+
+        # If Primary (secondaries provided), replicate concurrently
+        secondaries = data.get('secondaries', [])
+        policy = data.get('ack_policy', ACK_POLICY)
+        payload = {"handle": handle, "data_id": data_id, "secondaries": [], "assigned_version": version}
+        acked, failed, pending = replicate_to_secondaries(handle, secondaries, payload, policy)
+
+    result = {"status": "committed", "version": version, "acked": acked, "failed_secondaries": failed, "pending": pending}
+    if len(acked) < required_acks(policy, len(secondaries)):
+        result["status"] = "quorum_failed"
+        return jsonify(result), 503
+    return jsonify(result)
+
+def apply_ops(text, ops):
+    """
+    Applies [{offset, delete, insert}] edits in order; offsets are code points into
+    the text as left by the previous op. Raises ValueError on an out-of-range op.
+    """
+    for op in ops:
+        offset, delete, insert = int(op.get('offset', 0)), int(op.get('delete', 0)), op.get('insert', '')
+        if offset < 0 or delete < 0 or offset + delete > len(text):
+            raise ValueError(f"Op out of range: offset={offset} delete={delete} length={len(text)}")
+        text = text[:offset] + insert + text[offset + delete:]
+    return text
+
+@app.route('/chunk/patch', methods=['POST'])
+def patch_chunk():
+    """
+    DELTA MUTATION:
+    Applies a list of edits to the current version instead of replacing the whole
+    chunk, so bandwidth scales with the edit. Fails with 409 unless base_version is
+    the version we hold. The primary serializes patches per chunk, assigns the next
+    version and forwards the identical patch to the secondaries in that order.
+    A patch that would grow the chunk past max_size fails with 409 as well: the
+    client then saves the full document, which splits it across chunks again.
+    """
+    data = request.json
+    handle = data['handle']
+    base = data.get('base_version', 0)
+    assigned = data.get('assigned_version')  # Set when a primary forwards to us
+
+    with chunk_lock(handle):
+        local = current_version(handle)
+        if assigned is not None and assigned <= local:
+            return jsonify({"status": "patched", "version": local})  # Already applied
+        if base != local:
+            return jsonify({"error": "Version mismatch", "version": local}), 409
+
+        entry, payload = store.read(handle)
+        text = bytes(payload).decode() if entry else ""
+        try:
+            text = apply_ops(text, data.get('ops', []))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if assigned is None and len(text) > int(data.get('max_size', DEFAULT_CHUNK_CAPACITY)):
+            return jsonify({"error": "Chunk full", "version": local}), 409
+        content = text.encode()
+
+        version = assigned if assigned is not None else local + 1
+        if assigned is None:
+            mutated_as_primary.add(handle)
+        try:
+            with metrics.store("patch"):
+                store.put(handle, content, version)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        read_cache.replace(handle, store.stat(handle), content)
+
+        secondaries = data.get('secondaries', [])
+        policy = data.get('ack_policy', ACK_POLICY)
+        forward = {"handle": handle, "base_version": local, "assigned_version": version,
+                   "ops": data.get('ops', []), "secondaries": []}
+        acked, failed, pending = replicate_to_secondaries(handle, secondaries, forward, policy, path="/chunk/patch")
+
+    result = {"status": "patched", "version": version,
+              "acked": acked, "failed_secondaries": failed, "pending": pending}
+    if len(acked) < required_acks(policy, len(secondaries)):
+        result["status"] = "quorum_failed"
+        return jsonify(result), 503
+    return jsonify(result)
+
+def append_batch(handle, slots, secondaries, policy):
+    """
+    Applies a batch of queued appends in arrival order (caller holds the chunk lock).
+    Every slot in the batch names the same secondaries and ack policy; each brings its
+    own capacity. Records that do not fit seal the chunk: they and every later append
+    get chunk_full and the client retries on the next chunk. One version bump and one
+    forwarded message to each secondary cover the whole batch.
+    """
+    entry, payload = store.read(handle)
+    text = bytes(payload).decode() if entry else ""
+    local = entry['version'] if entry else 0
+    length = len(text)
+
+    placed = []
+    for slot in slots:
+        record = slot['record']
+        if handle in sealed_chunks or length + len(record) > slot['capacity']:
+            sealed_chunks.add(handle)
+            slot['result'] = ({"status": "chunk_full"}, 200)
+            continue
+        placed.append({"offset": length, "record": record})
+        slot['offset'] = length
+        length += len(record)
+
+    if not placed:
+        return
+    content = (text + "".join(p['record'] for p in placed)).encode()
+    version = local + 1
+    mutated_as_primary.add(handle)
     try:
-        conn = sqlite3.connect(DB_NAME, timeout=10)
-        c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO stored_chunks VALUES (?, ?, ?, ?)", 
-                  (handle, content, 1, get_simulated_time()))
-        conn.commit()
-        conn.close()
+        with metrics.store("append"):
+            store.put(handle, content, version)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    
-    # If Primary (secondaries provided), replicate
-    secondaries = data.get('secondaries', [])
-    for sec in secondaries:
-        try:
-            requests.post(f"http://localhost:{sec}/chunk/commit", 
-                          json={"handle": handle, "secondaries": []}, timeout=1)
-        except:
-            print(f"Failed to replicate to {sec}")
+        for slot in slots:
+            slot.setdefault('result', ({"error": str(e)}, 500))
+        return
+    read_cache.replace(handle, store.stat(handle), content)
+
+    forward = {"handle": handle, "base_version": local, "assigned_version": version,
+               "records": placed, "secondaries": []}
+    acked, failed, pending = replicate_to_secondaries(handle, secondaries, forward, policy, path="/chunk/append")
+    ok = len(acked) >= required_acks(policy, len(secondaries))
+    for slot in slots:
+        if 'result' not in slot:
+            result = {"status": "appended" if ok else "quorum_failed", "offset": slot['offset'], "version": version,
+                      "acked": acked, "failed_secondaries": failed, "pending": pending}
+            slot['result'] = (result, 200 if ok else 503)
+
+def apply_forwarded_append(handle, data):
+    """Secondary side: place the primary's records at exactly the offsets it chose."""
+    with chunk_lock(handle):
+        entry, payload = store.read(handle)
+        text = bytes(payload).decode() if entry else ""
+        local = entry['version'] if entry else 0
+        if data['assigned_version'] <= local:
+            return jsonify({"status": "appended", "version": local})  # Already applied
+        if data.get('base_version', 0) != local:
+            return jsonify({"error": "Version mismatch", "version": local}), 409
+        for r in data['records']:
+            if r['offset'] != len(text):
+                return jsonify({"error": "Offset mismatch", "length": len(text)}), 409
+            text += r['record']
+        content = text.encode()
+        with metrics.store("append"):
+            store.put(handle, content, data['assigned_version'])
+        read_cache.replace(handle, store.stat(handle), content)
+    return jsonify({"status": "appended", "version": data['assigned_version']})
+
+@app.route('/chunk/append', methods=['POST'])
+def append_record():
+    """
+    GFS RECORD APPEND:
+    The lease-holding primary picks the offset. Concurrent appenders to a chunk are
+    combined: whichever request gets the chunk lock applies every queued record in
+    one serialized order, and that order is replicated to the secondaries.
+    Returns the record's offset, or chunk_full when the client must move to a new chunk.
+    """
+    data = request.json
+    handle = data['handle']
+    if 'assigned_version' in data:
+        return apply_forwarded_append(handle, data)
+
+    record = data.get('record', '')
+    capacity = int(data.get('max_size', DEFAULT_CHUNK_CAPACITY))
+    if len(record) > capacity // MAX_RECORD_FRACTION:
+        return jsonify({"error": f"Record exceeds {capacity // MAX_RECORD_FRACTION} characters"}), 400
+
+    slot = {'record': record, 'version': data.get('version', 0), 'capacity': capacity,
+            'secondaries': tuple(data.get('secondaries', [])), 'policy': data.get('ack_policy', ACK_POLICY)}
+    with chunk_locks_guard:
+        append_queues.setdefault(handle, []).append(slot)
 
-    # Clear buffer
-    del staging_buffer[handle]
-    return jsonify({"status": "committed"})
+    with chunk_lock(handle):
+        if 'result' not in slot:
+            with chunk_locks_guard:
+                batch = [s for s in append_queues.pop(handle, []) if 'result' not in s]
+            # Each appender is checked against its own lookup, and replicated the way it
+            # asked: one batch per (secondaries, ack policy), in arrival order
+            local = current_version(handle)
+            groups = {}
+            for s in batch:
+                if local < s['version']:
+                    s['result'] = ({"error": "Stale primary", "version": local}, 409)
+                else:
+                    groups.setdefault((s['secondaries'], s['policy']), []).append(s)
+            for (secondaries, policy), group in groups.items():
+                append_batch(handle, group, list(secondaries), policy)
+    body, status = slot['result']
+    return jsonify(body), status
 
 @app.route('/chunk/read/<handle>', methods=['GET'])
 def read_chunk(handle):
+    """
+    Serves chunk bytes from the hot-chunk cache, else from the memory-mapped segment.
+    The ETag is the chunk version: a reader already holding it gets an empty 304.
+    A reader that accepts deflate gets a compressed chunk exactly as stored, with no
+    decompression here; the cache keeps that form too, so both kinds of reader hit it.
+    """
+    accepted = [e.split(";")[0].strip() for e in request.headers.get('Accept-Encoding', '').split(",")]
+    form = "stored" if "deflate" in accepted else "payload"
+
+    cached = read_cache.get(handle, form)
+    if cached is not None:
+        entry, data = cached
+    else:
+        entry, data = None, None
+        try:
+            entry = store.stat(handle)
+        except:
+            return jsonify({"error": "Storage Error"}), 500
+        if not entry:
+            return jsonify({"error": "Not found"}), 404
+
+    etag = f'"{entry["version"]}"'
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={"ETag": etag, "X-Chunk-Version": str(entry['version']),
+                                             "Vary": "Accept-Encoding"})
+
+    if data is None:
+        generation = read_cache.generation(handle)
+        try:
+            if form == "stored":
+                with metrics.store("read"):
+                    entry, data = store.read_stored(handle)
+                if entry:
+                    data = bytes(data)
+                    read_cache.put(handle, entry, data, generation, form)
+            elif not read_cache.admits(entry['size']):
+                entry, data = store.stream(handle)  # Too big to cache: stream from the segment
+            else:
+                with metrics.store("read"):
+                    entry, data = store.read(handle)
+                if entry:
+                    read_cache.put(handle, entry, data, generation)
+        except:
+            return jsonify({"error": "Storage Error"}), 500
+        if not entry:
+            return jsonify({"error": "Not found"}), 404
+
+    headers = {"ETag": f'"{entry["version"]}"', "X-Chunk-Version": str(entry['version']), "Vary": "Accept-Encoding"}
+    if form == "stored" and entry['codec'].startswith("zlib"):
+        wire_counters["compressed_reads"] += 1
+        wire_counters["wire_bytes_saved"] += entry['size'] - entry['length']
+        return Response(data, content_type="text/plain; charset=utf-8",
+                        headers={**headers, "Content-Encoding": "deflate", "Content-Length": str(entry['length'])})
+    # Stored uncompressed: the stored bytes are the text
+    return Response(data, content_type="text/plain; charset=utf-8",
+                    headers={**headers, "Content-Length": str(entry['size'])})
+
+@app.route('/chunk/clone', methods=['POST'])
+def clone_chunk():
+    """
+    REBALANCING / RE-REPLICATION: Copies a chunk from another replica (as the master
+    directs) to move it off a hot server or to restore a lost replica. Never replaces
+    a newer local version. Reports the bytes transferred so the master can throttle.
+    """
+    data = request.json
+    handle, source = data['handle'], data['source']
     try:
-        conn = sqlite3.connect(DB_NAME, timeout=10)
-        c = conn.cursor()
-        c.execute("SELECT data FROM stored_chunks WHERE handle=?", (handle,))
-        row = c.fetchone()
-        conn.close()
-        if row: return jsonify({"data": row[0]})
-        return jsonify({"error": "Not found"}), 404
-    except:
-        return jsonify({"error": "DB Error"}), 500
+        with metrics.rpc("clone", source):
+            r = peer_session.get(f"http://localhost:{source}/chunk/read/{handle}", timeout=PUSH_TIMEOUT)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        return jsonify({"error": f"Source {source} unavailable: {e}"}), 502
+    version = int(r.headers.get('X-Chunk-Version', 0))
+    transferred = int(r.headers.get('Content-Length', len(r.content)))
+
+    with chunk_lock(handle):
+        local = current_version(handle)
+        if local >= version:
+            return jsonify({"status": "cloned", "version": local, "bytes": transferred})
+        try:
+            with metrics.store("clone"):
+                store.put(handle, r.content, version)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        read_cache.replace(handle, store.stat(handle), r.content)
+    return jsonify({"status": "cloned", "version": version, "bytes": transferred})
+
+@app.route('/chunk/delete', methods=['POST'])
+def delete_chunk():
+    """Drops a replica the master moved elsewhere; compaction reclaims its space."""
+    handle = request.json['handle']
+    with chunk_lock(handle):
+        store.delete(handle)
+        read_cache.invalidate(handle)
+        sealed_chunks.discard(handle)
+    return jsonify({"status": "deleted"})
+
+@app.route('/chunk/version', methods=['POST'])
+def bump_version():
+    """
+    CHUNK VERSIONING: When the master grants a new lease it moves every replica on the
+    newest version to the next one, before any mutation under that lease. Only a replica
+    still on `expected` moves, so one that missed a mutation stays behind.
+    """
+    data = request.json
+    handle = data['handle']
+    with chunk_lock(handle):
+        local = current_version(handle)
+        if local != data['expected']:
+            return jsonify({"error": "Version changed", "version": local}), 409
+        store.set_version(handle, data['version'])
+        read_cache.invalidate(handle)  # Cached copies carry the old version as their ETag
+    return jsonify({"status": "bumped", "version": data['version']})
+
+@app.route('/chunk/checksum/<handle>', methods=['GET'])
+def chunk_checksum(handle):
+    """Lets writers skip chunks whose contents are unchanged."""
+    entry = store.stat(handle)
+    if entry:
+        return jsonify({"handle": handle, "checksum": entry['checksum'], "version": entry['version']})
+    return jsonify({"error": "Not found"}), 404
 
 # --- Admin & Algo Support ---
 
@@ -133,7 +761,14 @@ def get_status():
             "clock_offset": simulated_clock_offset,
             "active_threads": threading.active_count(),
             "total_requests": request_count,
-            "storage_usage": len(staging_buffer)
+            "storage_usage": staging.stats()["total_bytes"],
+            "staging": staging.stats(),
+            "read_cache": read_cache.stats(),
+            "storage": store.stats(),
+            "wire_compression": dict(wire_counters),
+            "serving": serving.stats(),
+            "profiler_running": metrics.profiler.running,
+            "routes": metrics.registry.route_summary()
         }
     })
 
@@ -160,5 +795,10 @@ def kill_node():
 if __name__ == '__main__':
     init_db()
     threading.Thread(target=send_heartbeat, daemon=True).start()
+    threading.Thread(target=store.compaction_loop, name='Compaction', daemon=True).start()
+    threading.Thread(target=staging.sweep_loop, name='StagingSweep', daemon=True).start()
     print(f"[CHUNKSERVER-{PORT}] Running.")
-    app.run(port=PORT, debug=False)
\ No newline at end of file
+    # The master's clock sync and status polls must get through even when we are saturated.
+    # So must peer fan-out (commit/patch/append forwards, chain pushes, clones): the client
+    # request behind it was already admitted by the primary, and a 429 here would fail it.
+    serving.serve(app, PORT, exempt=("/admin/", "/metrics", "/debug/"), exempt_header="X-Forwarded-By")
\ No newline at end of file
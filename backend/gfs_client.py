@@ -0,0 +1,420 @@
+import time
+import uuid
+import zlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Configuration ---
+MASTER_PORTS = [6001, 6002, 6003]
+TIMEOUT = 2.0
+POOL_SIZE = 32             # Pooled keep-alive connections per host
+LOCATION_TTL = 30          # Seconds a cached lookup serves reads without asking a master (at most until its access_expires)
+LEASE_MARGIN = 2           # A cached primary is only written to while its lease has this long left
+HEDGE_MIN_DELAY = 0.02     # Seconds before a slow read is also sent to the next replica...
+HEDGE_LATENCY_FACTOR = 2   # ...or this multiple of the replica's usual latency, if longer
+LATENCY_ALPHA = 0.2        # Weight of the newest sample in a replica's latency average
+FAILURE_PENALTY = 10       # Seconds a replica that failed a read is tried last
+CHUNK_CACHE_LIMIT = 1000   # Chunk contents kept for If-None-Match revalidation
+COMPRESS_MIN_BYTES = 256   # Pushes smaller than this go uncompressed
+
+
+class GFSError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ReplicaStats:
+    """
+    What this client has seen of each chunkserver: a latency average and the requests
+    it has outstanding there. Reads go to the replica expected to answer first.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}       # {port: EWMA seconds}
+        self.in_flight = {}     # {port: requests outstanding from this client}
+        self.failed_until = {}  # {port: timestamp}
+
+    def rank(self, ports):
+        now = time.time()
+        with self.lock:
+            known = list(self.latency.values())
+            default = min(known) if known else 0.0  # Unmeasured replicas get a fair first try
+            def expected(p):
+                return (self.failed_until.get(p, 0) > now,
+                        self.latency.get(p, default) * (1 + self.in_flight.get(p, 0)))
+            return sorted(ports, key=expected)
+
+    def hedge_delay(self, port):
+        with self.lock:
+            return max(HEDGE_MIN_DELAY, HEDGE_LATENCY_FACTOR * self.latency.get(port, 0.0))
+
+    def begin(self, port):
+        with self.lock:
+            self.in_flight[port] = self.in_flight.get(port, 0) + 1
+        return time.time()
+
+    def end(self, port, started, ok):
+        elapsed = time.time() - started
+        with self.lock:
+            self.in_flight[port] -= 1
+            if not ok:
+                self.failed_until[port] = time.time() + FAILURE_PENALTY
+                return
+            self.failed_until.pop(port, None)
+            previous = self.latency.get(port)
+            self.latency[port] = elapsed if previous is None else (
+                LATENCY_ALPHA * elapsed + (1 - LATENCY_ALPHA) * previous)
+
+
+class GFSClient:
+    """
+    GFS CLIENT:
+    Talks to masters only for metadata and caches what it learns: a file's chunk
+    locations serve reads until the lookup's access_expires (and for at most
+    LOCATION_TTL), and serve writes while the primary's lease lasts, so repeated reads
+    of a document rarely reach a master. Any error from a
+    chunkserver drops the cached locations and the next call looks them up again.
+    Chunk reads go to the replica expected to answer first and are hedged: if it is
+    slow, the next replica is asked too and the first answer wins.
+    """
+    def __init__(self, user_id, master_ports=MASTER_PORTS, host="localhost", location_ttl=LOCATION_TTL):
+        self.user_id = user_id
+        self.master_ports = list(master_ports)
+        self.host = host
+        self.location_ttl = location_ttl
+
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+        self.pool = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="gfs-chunk")
+        # Replica requests get their own pool so a chunk task never waits on its own pool
+        self.fetch_pool = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="gfs-fetch")
+
+        self.lock = threading.Lock()
+        self.leader = None
+        self.read_cursor = 0
+        self.locations = {}    # {file_id: {'chunks', 'size', 'chunk_size', 'authoritative', 'access_expires', 'fetched'}}
+        self.chunk_cache = {}  # {handle: (version, content)}, insertion ordered for eviction
+        self.replicas = ReplicaStats()
+        self.counters = {"lookups": 0, "location_hits": 0, "chunk_reads": 0, "not_modified": 0,
+                         "hedged": 0, "hedge_wins": 0, "invalidations": 0}
+
+    def url(self, port, path):
+        return f"http://{self.host}:{port}{path}"
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    # --- Masters ---
+    def find_leader(self):
+        for port in self.master_ports:
+            try:
+                r = self.session.get(self.url(port, "/health"), timeout=TIMEOUT)
+                if r.json().get('role') == 'leader':
+                    return port
+            except:
+                continue
+        return None
+
+    def leader_request(self, method, path, body=None):
+        """Sends a metadata mutation (or an authoritative lookup) to the leader, finding it again on failure."""
+        for _ in range(2 * len(self.master_ports)):
+            leader = self.leader or self.find_leader()
+            if leader is None:
+                time.sleep(0.5)  # Election in progress
+                continue
+            try:
+                r = self.session.request(method, self.url(leader, path), json=body, timeout=TIMEOUT)
+            except requests.RequestException:
+                self.leader = None
+                continue
+            if r.status_code == 400 and r.json().get('error') == "Not Leader":
+                self.leader = None
+                continue
+            self.leader = leader
+            return self.check(r)
+        raise GFSError("No leader available", 503)
+
+    def read_request(self, method, path, body=None):
+        """Sends a read to any master; a follower too stale to answer redirects to the leader."""
+        with self.lock:
+            port = self.master_ports[self.read_cursor % len(self.master_ports)]
+            self.read_cursor += 1
+        try:
+            r = self.session.request(method, self.url(port, path), json=body, timeout=TIMEOUT)
+            if r.status_code != 503:  # 503: the follower knows no leader to redirect to
+                return self.check(r)
+        except requests.RequestException:
+            pass
+        return self.leader_request(method, path, body)
+
+    def check(self, r):
+        if r.status_code >= 400:
+            try:
+                message = r.json().get('error', r.text)
+            except ValueError:
+                message = r.text
+            raise GFSError(message, r.status_code)
+        return r.json()
+
+    # --- Location Cache ---
+    def lookup(self, file_id, for_write=False):
+        """
+        Returns the file's lookup, from the cache when it is still good enough:
+        reads accept any master's answer until its access_expires; writes need
+        the leader's, with every primary's lease valid for LEASE_MARGIN more seconds.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.locations.get(file_id)
+        if entry and self.usable(entry, now, for_write):
+            self.count("location_hits")
+            return entry
+
+        self.count("lookups")
+        path, body = f"/file/lookup/{file_id}", {"user_id": self.user_id, "for_write": for_write}
+        data = self.leader_request("post", path, body) if for_write else self.read_request("post", path, body)
+        return self.remember(file_id, data)
+
+    def usable(self, entry, now, for_write):
+        if not for_write:
+            return now - entry['fetched'] < self.location_ttl and (entry['access_expires'] or 0) > now
+        if not entry['authoritative']:
+            return False
+        return all((c.get('lease_expires') or 0) > now + LEASE_MARGIN for c in entry['chunks'])
+
+    def remember(self, file_id, data):
+        entry = {
+            "chunks": data['chunks'],
+            "size": data.get('size'),
+            "chunk_size": data['chunk_size'],
+            "authoritative": data.get('authoritative', True),
+            "access_expires": data.get('access_expires'),  # Read access is re-checked once it passes
+            "fetched": time.time()
+        }
+        with self.lock:
+            self.locations[file_id] = entry
+        return entry
+
+    def invalidate(self, file_id):
+        with self.lock:
+            if self.locations.pop(file_id, None):
+                self.counters["invalidations"] += 1
+
+    # --- Reads ---
+    def read(self, file_id):
+        """Returns the document text, with its version (the chunk versions joined by '.')."""
+        for attempt in range(2):
+            entry = self.lookup(file_id)
+            try:
+                parts = list(self.pool.map(self.read_chunk, entry['chunks']))
+            except GFSError:
+                self.invalidate(file_id)  # Replicas moved or died: look them up again once
+                if attempt:
+                    raise
+                continue
+            return "".join(p[1] for p in parts), ".".join(p[0] for p in parts)
+
+    def read_chunk(self, chunk):
+        """Hedged read: asks the best replica, then the next one each time the last is slow."""
+        self.count("chunk_reads")
+        order = self.replicas.rank(chunk['replicas'])
+        if not order:
+            raise GFSError(f"Chunk {chunk['handle']} has no replicas", 503)
+        with self.lock:
+            cached = self.chunk_cache.get(chunk['handle'])
+
+        pending = {}
+        next_replica = 0
+        while True:
+            if next_replica < len(order):
+                port = order[next_replica]
+                pending[self.fetch_pool.submit(self.fetch_chunk, port, chunk['handle'], cached)] = port
+                if next_replica:
+                    self.count("hedged")
+                next_replica += 1
+            if not pending:
+                raise GFSError(f"Chunk {chunk['handle']} unavailable", 503)
+            delay = self.replicas.hedge_delay(order[next_replica - 1]) if next_replica < len(order) else None
+            done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                port = pending.pop(future)
+                result = future.result()
+                if result is not None:
+                    if port != order[0]:
+                        self.count("hedge_wins")
+                    return result
+
+    def fetch_chunk(self, port, handle, cached):
+        """Returns (version, content) from one replica, or None if it could not answer."""
+        headers = {"Accept-Encoding": "deflate"}
+        if cached:
+            headers["If-None-Match"] = f'"{cached[0]}"'
+        started = self.replicas.begin(port)
+        try:
+            r = self.session.get(self.url(port, f"/chunk/read/{handle}"), headers=headers, timeout=TIMEOUT)
+            ok = r.status_code in (200, 304)
+        except requests.RequestException:
+            ok = False
+        self.replicas.end(port, started, ok)
+        if not ok:
+            return None
+        if r.status_code == 304 and cached:
+            self.count("not_modified")
+            return cached
+        version = r.headers.get("X-Chunk-Version", "0")
+        content = r.content.decode("utf-8")  # requests inflates Content-Encoding: deflate
+        self.remember_chunk(handle, version, content)
+        return version, content
+
+    def remember_chunk(self, handle, version, content):
+        with self.lock:
+            self.chunk_cache.pop(handle, None)
+            self.chunk_cache[handle] = (version, content)
+            if len(self.chunk_cache) > CHUNK_CACHE_LIMIT:
+                self.chunk_cache.pop(next(iter(self.chunk_cache)))
+
+    # --- Writes ---
+    def create(self, filename, content=""):
+        """Creates a document and writes its content. Returns the file_id."""
+        data = self.leader_request("post", "/file/create",
+                                   {"filename": filename, "user_id": self.user_id, "size": len(content)})
+        entry = self.remember(data['file_id'], {**data, "authoritative": True})
+        slices = self.split(content, entry['chunk_size'], len(entry['chunks']))
+        list(self.pool.map(self.write_chunk, entry['chunks'], slices))
+        return data['file_id']
+
+    def write(self, file_id, content):
+        """Replaces a document's content, writing only the chunks that changed. Returns the number written."""
+        for attempt in range(2):
+            entry = self.lookup(file_id, for_write=True)
+            slices = self.split(content, entry['chunk_size'], len(entry['chunks']))
+            if len(slices) > len(entry['chunks']) or len(content) != entry['size']:
+                # Grow the file, or just record its new size: a rewrite may also truncate it
+                data = self.leader_request("post", f"/file/allocate/{file_id}",
+                                           {"user_id": self.user_id, "size": len(content)})
+                entry = self.remember(file_id, {**data, "authoritative": True})
+            try:
+                return sum(self.pool.map(self.write_if_changed, entry['chunks'], slices))
+            except GFSError:
+                self.invalidate(file_id)  # Lost lease, stale or dead primary: ask the leader again once
+                if attempt:
+                    raise
+
+    def write_if_changed(self, chunk, text):
+        with self.lock:
+            cached = self.chunk_cache.get(chunk['handle'])
+        if cached and cached[1] == text and cached[0] == str(chunk['version']):
+            return 0
+        if not cached and self.stored_checksum(chunk) == self.checksum(text):
+            return 0
+        self.write_chunk(chunk, text)
+        return 1
+
+    def write_chunk(self, chunk, text):
+        """Stage/commit pipeline: push the bytes along the replica chain, then commit at the primary."""
+        primary, handle = chunk['primary'], chunk['handle']
+        if primary is None:
+            raise GFSError(f"Chunk {handle} has no primary", 503)
+        data_id = str(uuid.uuid4())
+        raw = text.encode("utf-8")
+        body, headers = raw, {"Content-Type": "application/octet-stream",
+                              "X-Chunk-Handle": handle, "X-Data-Id": data_id}
+        if len(raw) >= COMPRESS_MIN_BYTES:
+            compressed = zlib.compress(raw)
+            if len(compressed) < len(raw):
+                body, headers["Content-Encoding"] = compressed, "deflate"
+
+        # 1. Push: the primary heads the chain and forwards to the secondaries while receiving
+        chain = [primary] + [p for p in chunk['replicas'] if p != primary]
+        headers["X-Forward-To"] = ",".join(str(p) for p in chain[1:])
+        try:
+            r = self.session.post(self.url(primary, "/chunk/stage"), data=body, headers=headers, timeout=TIMEOUT * 2)
+            staged = self.check(r).get('staged', [])
+        except requests.RequestException as e:
+            raise GFSError(f"Push to primary {primary} failed: {e}", 503)
+
+        # 2. Commit: the primary assigns the version and replicates to whoever staged
+        secondaries = [p for p in staged if p != primary]
+        try:
+            r = self.session.post(self.url(primary, "/chunk/commit"), timeout=TIMEOUT * 2, json={
+                "handle": handle,
+                "data_id": data_id,
+                "version": chunk['version'],
+                "secondaries": secondaries
+            })
+            result = self.check(r)
+        except requests.RequestException as e:
+            raise GFSError(f"Commit at primary {primary} failed: {e}", 503)
+        chunk['version'] = result['version']
+        self.remember_chunk(handle, str(result['version']), text)
+        return result
+
+    def append(self, file_id, record, max_rollovers=3):
+        """
+        GFS record append: returns the (chunk sequence, offset) the primary chose.
+        The file's size then grows to the record's end (earlier chunks are read for
+        their lengths, usually from the chunk cache).
+        """
+        entry = self.lookup(file_id, for_write=True)
+        for _ in range(max_rollovers + 1):
+            chunk = entry['chunks'][-1]
+            try:
+                r = self.session.post(self.url(chunk['primary'], "/chunk/append"), timeout=TIMEOUT * 2, json={
+                    "handle": chunk['handle'],
+                    "record": record,
+                    "version": chunk['version'],
+                    "max_size": entry['chunk_size'],
+                    "secondaries": [p for p in chunk['replicas'] if p != chunk['primary']]
+                })
+                result = self.check(r)
+            except (requests.RequestException, GFSError):
+                self.invalidate(file_id)
+                raise
+            if result.get('status') != "chunk_full":
+                chunk['version'] = result['version']
+                end = sum(len(p[1]) for p in self.pool.map(self.read_chunk, entry['chunks'][:-1]))
+                end += result['offset'] + len(record)
+                if end > (entry['size'] or 0):
+                    data = self.leader_request("post", f"/file/allocate/{file_id}", {"user_id": self.user_id, "min_size": end})
+                    entry['size'] = data['size']
+                return chunk['sequence'], result['offset']
+            data = self.leader_request("post", f"/file/allocate/{file_id}",
+                                       {"user_id": self.user_id, "chunk_count": len(entry['chunks']) + 1})
+            entry = self.remember(file_id, {**data, "authoritative": True})
+        raise GFSError("Append kept hitting full chunks", 503)
+
+    # --- Helpers ---
+    @staticmethod
+    def split(content, chunk_size, min_chunks=1):
+        slices = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        return slices + [""] * (min_chunks - len(slices))
+
+    @staticmethod
+    def checksum(content):
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def stored_checksum(self, chunk):
+        """The checksum a replica holds for the chunk (None if unknown or unreachable)."""
+        for port in self.replicas.rank(chunk['replicas']):
+            try:
+                r = self.session.get(self.url(port, f"/chunk/checksum/{chunk['handle']}"), timeout=TIMEOUT)
+                if r.status_code == 404:
+                    return None
+                return r.json()['checksum']
+            except:
+                continue
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "cached_files": len(self.locations), "cached_chunks": len(self.chunk_cache)}
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.fetch_pool.shutdown(wait=False)
+        self.session.close()
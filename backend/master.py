@@ -7,13 +7,332 @@ import requests
 import hashlib
 import uuid
 import statistics
-from flask import Flask, request, jsonify
+import queue
+import json
+import heapq
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+import serving
+import metrics
 
 # --- Configuration ---
 TIMEOUT = 2.0
 HEARTBEAT_INTERVAL = 5
 LEASE_DURATION = 60  # Seconds
+LEASE_VERSION_TIMEOUT = 0.5  # Seconds each replica gets to report, then bump, its chunk version on a new lease
+CHUNK_SIZE = int(os.environ.get("GFS_CHUNK_SIZE", 64 * 1024))  # Characters of document text per chunk
+REPLICATION_FACTOR = 3
+DB_POOL_SIZE = 8
+DB_CACHE_KB = 8 * 1024
+DB_STATEMENT_CACHE = 128
+REPLICATION_BATCH = 256         # Max log entries per /system/replicate call
+REPLICATION_PROBE_INTERVAL = 2  # Seconds between empty batches to an idle follower
+READ_STALENESS_BOUND = 5        # Default max seconds a follower may lag and still serve reads
+
+# --- Checkpoints ---
+CHECKPOINT_INTERVAL = 60        # Seconds between checks for a new checkpoint
+CHECKPOINT_MIN_ENTRIES = 1000   # ...taken once this many log entries arrived since the last one
+LOG_RETAIN = 1000               # Entries kept behind a checkpoint so briefly lagging followers replay instead
+CHECKPOINT_TABLES = ("files", "chunk_mapping", "chunk_versions", "users", "permissions")
+
+# --- Access Control ---
+ACL_CACHE_SIZE = 10000          # (file, user) decisions kept, least recently used evicted first
+ACCESS_TTL = 5                  # Seconds a lookup may be reused for reads, so also how long a revoked grant may still be honored
+FOOTPRINT_INTERVAL = 30         # Seconds between measurements of the metadata cache's memory (a full walk)
+
+# --- Replica Placement ---
+DISK_WEIGHT = 0.5          # Share of the placement score from stored bytes
+LOAD_WEIGHT = 0.5          # Share from request rate and in-flight requests
+LOAD_NOISE_FLOOR = 20      # Requests/second below which cluster-wide load differences are ignored
+OVERLOAD_IN_FLIGHT = 32    # A heartbeat above either limit marks the server overloaded...
+OVERLOAD_RATE = 200        # ...(requests/second)
+OVERLOAD_COOLDOWN = 30     # ...and keeps new replicas off it for this many seconds
+REBALANCE_INTERVAL = 30    # Seconds between rebalancer passes (one chunk moved per pass)
+REBALANCE_THRESHOLD = 0.2  # Move when the hottest server's score exceeds the coolest by this much
+REBALANCE_COOLDOWN = 10 * REBALANCE_INTERVAL  # A moved chunk stays put at least this long
+
+# --- Re-replication ---
+REREPLICATION_SCAN_INTERVAL = 5           # Seconds between scans for under-replicated chunks
+REREPLICATION_WORKERS = 2                 # Concurrent chunk copies
+REREPLICATION_BANDWIDTH = 8 * 1024 * 1024 # Bytes/second shared by all workers, so recovery leaves room for reads
+
+# --- Leader Election & Lease ---
+LEADER_HEARTBEAT_INTERVAL = float(os.environ.get("GFS_LEADER_HEARTBEAT", 0.25))  # Seconds between leader pushes
+LEADER_LEASE = float(os.environ.get("GFS_LEADER_LEASE", 1.5))  # Silence after which followers elect (detection bound)
+ELECTION_TIMEOUT = 0.5     # Seconds higher nodes get to answer an ELECTION
+COORDINATOR_WAIT = 1.5     # Seconds to wait for a higher node's victory before re-running the election
+FAILOVER_HISTORY = 20      # Failover durations kept for /system/status
+
+# --- Clock Sync (Berkeley) ---
+CLOCK_SYNC_INTERVAL = 10   # Seconds between sync rounds
+CLOCK_POLL_TIMEOUT = 1.0   # Seconds per clock poll / adjustment
+CLOCK_SYNC_WORKERS = 32    # Concurrent polls and adjustments
+CLOCK_MAX_RTT = 0.5        # Samples with a slower round trip are too uncertain to average
+CLOCK_OUTLIER_MADS = 3     # Offsets further than this many median absolute deviations are left out...
+CLOCK_OUTLIER_FLOOR = 0.05 # ...but never closer than this many seconds to the median
+
+# --- Metadata Writes ---
+# Every mutation of the metadata tables goes through one of these statements so the
+# in-memory cache can mirror it exactly (on the leader and on replicating followers).
+SQL_INSERT_USER = "INSERT INTO users (user_id, username, password_hash) VALUES (?, ?, ?)"
+SQL_INSERT_FILE = "INSERT INTO files (file_id, filename, size, owner_id) VALUES (?, ?, ?, ?)"
+SQL_UPDATE_FILE_SIZE = "UPDATE files SET size=? WHERE file_id=?"
+SQL_INSERT_CHUNK = "INSERT INTO chunk_mapping VALUES (?, ?, ?, ?, ?)"
+SQL_UPDATE_CHUNK_LOCATIONS = "UPDATE chunk_mapping SET primary_loc=?, locations=? WHERE chunk_handle=?"
+SQL_SET_CHUNK_VERSION = "INSERT OR REPLACE INTO chunk_versions VALUES (?, ?)"
+SQL_INSERT_PERMISSION = "INSERT INTO permissions VALUES (?, ?, ?, ?, 'PENDING')"
+SQL_UPDATE_PERMISSION = "UPDATE permissions SET status=? WHERE req_id=?"
+
+class ConnectionPool:
+    """
+    Keeps SQLite connections open across requests instead of connecting per statement.
+    The dev server runs each request on a fresh thread, so connections are checked
+    out of a shared LIFO queue rather than pinned to threads; a connection is still
+    only ever used by one thread at a time.
+    """
+    def __init__(self, db_name, size=DB_POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self.created = 0
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=10, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL; fsync only at checkpoints
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.connect()
+        return self.idle.get()
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+class MetadataCache:
+    """
+    GFS MASTER STATE:
+    In-memory index of files, chunk mappings, users and ACLs so read paths never
+    touch SQLite. Loaded once at startup and kept coherent by apply(), which is
+    called after every committed write (SQLite stays the durable copy).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.measured_bytes = 0
+        self.measured_at = 0
+        self.clear()
+
+    def clear(self):
+        self.chunk_count = 0
+        self.files = {}        # {file_id: {'filename', 'size', 'owner_id'}}
+        self.chunks = {}       # {file_id: {sequence: {'handle', 'primary', 'replicas'}}}
+        self.handles = {}      # {chunk_handle: (file_id, sequence)}
+        self.versions = {}     # {chunk_handle: version set by its last lease grant}
+        self.owned = {}        # {user_id: [file_id, ...]}
+        self.users = {}        # {user_id: username}
+        self.logins = {}       # {username: [(user_id, password_hash), ...]}
+        self.permissions = {}  # {req_id: {'file_id', 'user_id', 'access_type', 'status'}}
+        self.requests = {}     # {(file_id, user_id): [req_id, ...]}
+        self.pending = {}      # {file_id: [req_id, ...]}
+        self.approved = {}     # {user_id: [file_id, ...]}
+
+    def load(self, run_query):
+        with self.lock:
+            self.clear()
+            for r in run_query("SELECT user_id, username, password_hash FROM users"):
+                self.put_user(*r)
+            for r in run_query("SELECT file_id, filename, size, owner_id FROM files"):
+                self.put_file(*r)
+            for r in run_query("SELECT chunk_handle, file_id, sequence, primary_loc, locations FROM chunk_mapping"):
+                self.put_chunk(*r)
+            for handle, version in run_query("SELECT chunk_handle, version FROM chunk_versions"):
+                self.versions[handle] = version
+            for r in run_query("SELECT req_id, file_id, user_id, access_type, status FROM permissions"):
+                self.put_permission(*r)
+
+    def apply(self, query, params):
+        """Mirrors a committed write. Returns False if the statement is not recognised."""
+        with self.lock:
+            if query == SQL_INSERT_USER:
+                self.put_user(*params)
+            elif query == SQL_INSERT_FILE:
+                self.put_file(*params)
+            elif query == SQL_UPDATE_FILE_SIZE:
+                size, file_id = params
+                if file_id in self.files:
+                    self.files[file_id]['size'] = size
+            elif query == SQL_INSERT_CHUNK:
+                self.put_chunk(*params)
+            elif query == SQL_UPDATE_CHUNK_LOCATIONS:
+                primary, locations, chunk_handle = params
+                if chunk_handle in self.handles:
+                    file_id, sequence = self.handles[chunk_handle]
+                    self.put_chunk(chunk_handle, file_id, sequence, primary, locations)
+            elif query == SQL_SET_CHUNK_VERSION:
+                chunk_handle, version = params
+                self.versions[chunk_handle] = version
+            elif query == SQL_INSERT_PERMISSION:
+                self.put_permission(*params, 'PENDING')
+            elif query == SQL_UPDATE_PERMISSION:
+                status, req_id = params
+                perm = self.permissions.get(req_id)
+                if perm:
+                    self.drop_permission(req_id)
+                    self.put_permission(req_id, perm['file_id'], perm['user_id'], perm['access_type'], status)
+            else:
+                return False
+            return True
+
+    # --- Index maintenance ---
+    def put_user(self, user_id, username, password_hash):
+        self.users[user_id] = username
+        self.logins.setdefault(username, []).append((user_id, password_hash))
+
+    def put_file(self, file_id, filename, size, owner_id):
+        self.files[file_id] = {'filename': filename, 'size': size or 0, 'owner_id': owner_id}
+        self.owned.setdefault(owner_id, []).append(file_id)
+
+    def put_chunk(self, chunk_handle, file_id, sequence, primary, locations):
+        if chunk_handle not in self.handles:
+            self.chunk_count += 1
+        self.chunks.setdefault(file_id, {})[int(sequence)] = {
+            'handle': chunk_handle,
+            'primary': int(primary) if primary is not None else None,
+            'replicas': [int(x) for x in str(locations).split(",")]
+        }
+        self.handles[chunk_handle] = (file_id, int(sequence))
+
+    def put_permission(self, req_id, file_id, user_id, access_type, status):
+        self.permissions[req_id] = {'file_id': file_id, 'user_id': user_id,
+                                    'access_type': access_type, 'status': status}
+        self.requests.setdefault((file_id, user_id), []).append(req_id)
+        if status == 'PENDING':
+            self.pending.setdefault(file_id, []).append(req_id)
+        elif status == 'APPROVED':
+            shared = self.approved.setdefault(user_id, [])
+            if file_id not in shared:
+                shared.append(file_id)
+
+    def drop_permission(self, req_id):
+        perm = self.permissions.pop(req_id)
+        self.requests[(perm['file_id'], perm['user_id'])].remove(req_id)
+        if perm['status'] == 'PENDING':
+            self.pending[perm['file_id']].remove(req_id)
+        elif perm['status'] == 'APPROVED' and not self.is_approved(perm['file_id'], perm['user_id']):
+            self.approved[perm['user_id']].remove(perm['file_id'])
+
+    # --- Queries ---
+    def is_approved(self, file_id, user_id):
+        return self.approved_access(file_id, user_id) is not None
+
+    def approved_access(self, file_id, user_id):
+        """Access type of the user's first approved request for the file, or None."""
+        for r in self.requests.get((file_id, user_id), []):
+            if self.permissions[r]['status'] == 'APPROVED':
+                return self.permissions[r]['access_type']
+        return None
+
+    def footprint(self):
+        """
+        Entry counts, and the approximate memory held by the cache in bytes. Counts are
+        kept as writes apply; bytes need a walk of every index, so they are measured at
+        most every FOOTPRINT_INTERVAL seconds, without the lock (writers never wait on it).
+        """
+        now = time.time()
+        if now - self.measured_at >= FOOTPRINT_INTERVAL:
+            self.measured_at = now
+            self.measured_bytes = self.measure()
+        return {
+            "files": len(self.files),
+            "chunks": self.chunk_count,
+            "users": len(self.users),
+            "permissions": len(self.permissions),
+            "bytes": self.measured_bytes,
+            "bytes_measured_at": self.measured_at
+        }
+
+    def measure(self):
+        def size_of(obj):
+            # list() copies a container in one step, so concurrent writers cannot break the walk
+            total = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                total += sum(size_of(k) + size_of(v) for k, v in list(obj.items()))
+            elif isinstance(obj, (list, tuple, set)):
+                total += sum(size_of(x) for x in list(obj))
+            return total
+
+        indexes = [self.files, self.chunks, self.handles, self.versions, self.owned, self.users, self.logins,
+                   self.permissions, self.requests, self.pending, self.approved]
+        return sum(size_of(i) for i in indexes)
+
+class AccessCache:
+    """
+    ACL DECISIONS:
+    LRU of (file_id, user_id) -> access level ('OWNER', the approved access type, or
+    None for denied), so repeated checks skip the metadata lock. Entries are dropped
+    precisely when a permission for that pair is written; a decision computed while
+    such a write landed is not stored (the generation check), so it can never outlive it.
+    """
+    def __init__(self, size=ACL_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns (found, access, generation); pass the generation back to put()."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key], self.generation
+            self.misses += 1
+            return False, None, self.generation
+
+    def put(self, key, access, generation):
+        with self.lock:
+            if generation != self.generation:
+                return  # A permission changed since the decision was computed
+            self.entries[key] = access
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, file_id, user_id):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.pop((file_id, user_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "capacity": self.size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                    "invalidations": self.invalidations}
 
 class MasterNode:
     request_count = 0
@@ -25,191 +344,1295 @@ class MasterNode:
         # Election State
         self.leader_id = None
         self.election_in_progress = False
+        self.election_lock = threading.Lock()
+        self.coordinator_event = threading.Event()
+        self.election_pool = ThreadPoolExecutor(max_workers=max(1, len(peers)), thread_name_prefix="election")
+        self.heartbeat_session = requests.Session()
+        self.leader_lease_expires = 0  # Followers: until when the leader is presumed alive; leader: its own lease
+        self.leader_lost_at = None     # Last heartbeat from a leader that then went silent
+        self.failovers = []            # [{'at', 'seconds', 'leader'}] most recent last
         
         # GFS State
         self.active_chunkservers = {}  # {port: last_seen_timestamp}
         self.chunkserver_clocks = {}   # {port: simulated_time}
+        self.clock_sync = {}           # Last Berkeley round: duration, average and per-node offset/RTT
+        self.clock_pool = ThreadPoolExecutor(max_workers=CLOCK_SYNC_WORKERS, thread_name_prefix="clock")
+        self.clock_session = requests.Session()
+        self.clock_session.mount("http://", HTTPAdapter(pool_maxsize=CLOCK_SYNC_WORKERS))
         self.leases = {}               # {chunk_handle: {'primary': port, 'expires': timestamp}}
+        self.lease_heap = []           # [(expires, chunk_handle)]; entries for extended leases are skipped on pop
+        self.lease_counts = {}         # {port: live leases held}
+        self.lease_lock = threading.Lock()
+        self.grant_locks = {}          # {chunk_handle: Lock} one lease grant (and version bump) at a time per chunk
+        self.grant_locks_guard = threading.Lock()
+        self.lease_extensions = 0
+        self.failed_replicas = {}      # {chunk_handle: {port: version}} replicas that missed a mutation, to repair
+        self.chunk_reports = {}        # {port: {chunk_handle: version}} from chunkserver heartbeats
+        self.lease_pool = ThreadPoolExecutor(max_workers=2 * REPLICATION_FACTOR, thread_name_prefix="lease")
+        self.chunk_versions = {}       # {chunk_handle: highest version any replica has reported}
+        self.stale_reports = {}        # {port: set(chunk_handle)} chunks its last report held behind the newest version
+        self.reported_at = {}          # {port: when its last chunk report arrived}
+        self.version_first_seen = {}   # {chunk_handle: when a written version of it was first reported}
+        self.chunkserver_stats = {}    # {port: {'stored_bytes', 'chunk_count', 'in_flight', 'request_rate'}}
+        self.overloaded_until = {}     # {port: timestamp} servers kept out of placement after a load spike
+        self.placed_since_report = {}  # {port: chunks placed since its last heartbeat}
+        self.rebalance_moves = 0
+        self.last_moved = {}           # {chunk_handle: timestamp} so the rebalancer does not bounce a chunk
+        self.repair_queue = queue.PriorityQueue()  # (live replicas, arrival, chunk_handle): fewest replicas first
+        self.repair_queued = set()     # Handles queued or being repaired
+        self.repair_lock = threading.Lock()
+        self.repair_arrivals = 0
+        self.repair_stats = {"completed": 0, "failed": 0, "bytes": 0, "lost": 0, "under_replicated": 0, "last_scan": None}
         
         self.db_name = f"master_{port}.db"
+        if not os.path.exists(self.db_name):
+            # A deleted database starts over empty: SQLite would replay its leftover WAL into the new file
+            for leftover in (self.db_name + "-wal", self.db_name + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self.db_pool = ConnectionPool(self.db_name)
+        self.cache = MetadataCache()
+        self.acl_cache = AccessCache()
+
+        # Replication State
+        self.last_applied = 0          # Highest replication log index applied locally
+        self.log_cond = threading.Condition()
+        self.peer_match_index = {}     # {peer: last index the follower acknowledged}
+        self.leader_index = 0          # Followers: the leader's last applied index, from its latest batch
+        self.caught_up_at = None       # Followers: when we last held everything the leader had applied
+        self.log_floor = 0             # Entries up to this index were folded into a checkpoint and dropped
+        self.term = 0                  # Highest leader term seen (persisted); each victory starts a new one
+        self.last_term = 0             # Term of our last log entry: with last_applied, how fresh our log is
+        self.term_lock = threading.Lock()
+        self.leader_ready = False      # Leader: our log caught up with every peer's, so writes may start
+        self.checkpoint_path = f"master_{port}.ckpt"
+        self.checkpoint = {"index": 0, "term": 0, "taken_at": None, "bytes": 0, "seconds": None}
+        self.checkpoint_lock = threading.Lock()
+        self.catch_up_lock = threading.Lock()  # One catch-up (log replay or bootstrap) at a time
+        self.counter_lock = threading.Lock()
+        self.allocation_lock = threading.Lock()  # Concurrent appenders roll over to the same new chunk
 
         # Flask App Setup
         self.app = Flask(__name__)
         CORS(self.app)
+        metrics.install(self.app)
+        self.register_gauges()
         self.setup_routes()
         self.init_db()
+        self.cache.load(self.run_query)
 
     # --- Database Management ---
     def init_db(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.db_pool.acquire()
         c = conn.cursor()
         # Metadata Tables
         c.execute('''CREATE TABLE IF NOT EXISTS files 
                      (file_id TEXT PRIMARY KEY, filename TEXT, size INT, owner_id TEXT)''')
         c.execute('''CREATE TABLE IF NOT EXISTS chunk_mapping 
                      (chunk_handle TEXT, file_id TEXT, sequence INT, primary_loc TEXT, locations TEXT)''')
+        # Chunk versions as of their last lease grant, so replicas that missed one stay stale across restarts
+        c.execute('''CREATE TABLE IF NOT EXISTS chunk_versions 
+                     (chunk_handle TEXT PRIMARY KEY, version INT)''')
         # User & Auth Tables
         c.execute('''CREATE TABLE IF NOT EXISTS users 
                      (user_id TEXT PRIMARY KEY, username TEXT, password_hash TEXT)''')
         # Permissions: status = 'PENDING' | 'APPROVED' | 'REJECTED'
         c.execute('''CREATE TABLE IF NOT EXISTS permissions 
                      (req_id TEXT PRIMARY KEY, file_id TEXT, user_id TEXT, access_type TEXT, status TEXT)''')
+        # Covering indexes for the hot lookup/list/login/ACL predicates
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_chunk_mapping_file 
+                     ON chunk_mapping (file_id, sequence, chunk_handle, primary_loc, locations)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_permissions_file_user 
+                     ON permissions (file_id, user_id, status)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_permissions_user 
+                     ON permissions (user_id, status, file_id)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_users_username 
+                     ON users (username, password_hash, user_id)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_files_owner 
+                     ON files (owner_id, file_id, filename)''')
+        # Replication Log: every metadata write, in leader-assigned order, tagged with the leader's term
+        c.execute('''CREATE TABLE IF NOT EXISTS replication_log 
+                     (log_index INTEGER PRIMARY KEY, query TEXT, params TEXT, term INTEGER DEFAULT 0)''')
+        # Checkpoint: the log index (and its entry's term) our newest checkpoint (taken or installed) covers
+        c.execute('''CREATE TABLE IF NOT EXISTS checkpoint_state
+                     (id INTEGER PRIMARY KEY CHECK (id = 0), log_index INTEGER, taken_at REAL, term INTEGER DEFAULT 0)''')
+        # Election: the highest leader term seen, so a restarted master never follows an older leader
+        c.execute('''CREATE TABLE IF NOT EXISTS election_state
+                     (id INTEGER PRIMARY KEY CHECK (id = 0), term INTEGER)''')
+        # Databases from before terms: their entries count as term 0
+        for table in ("replication_log", "checkpoint_state"):
+            if "term" not in [col[1] for col in c.execute(f"PRAGMA table_info({table})")]:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN term INTEGER DEFAULT 0")
         conn.commit()
-        conn.close()
+        first, last = c.execute("SELECT MIN(log_index), MAX(log_index) FROM replication_log").fetchone()
+        row = c.execute("SELECT log_index, taken_at, term FROM checkpoint_state").fetchone()
+        term = c.execute("SELECT term FROM election_state").fetchone()
+        self.db_pool.release(conn)
+        if row:
+            self.checkpoint.update(index=row[0], taken_at=row[1], term=row[2])
+            if os.path.exists(self.checkpoint_path):
+                self.checkpoint["bytes"] = os.path.getsize(self.checkpoint_path)
+        elif os.path.exists(self.checkpoint_path):
+            # Left from a database that is gone: serving it to a bootstrapping peer would hand
+            # it state we no longer hold. /system/checkpoint takes a fresh one on demand.
+            os.remove(self.checkpoint_path)
+        self.last_applied = max(last or 0, self.checkpoint["index"])
+        self.log_floor = first - 1 if first is not None else self.last_applied
+        self.last_term = self.term_at(self.last_applied) or 0
+        self.term = max(term[0] if term else 0, self.last_term)
 
     def run_query(self, query, params=(), commit=False):
-        """Executes a SQL query on the local SQLite DB."""
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
+        """Executes a SQL query on the local SQLite DB using a pooled connection."""
+        conn = self.db_pool.acquire()
         try:
-            c.execute(query, params)
-            if commit:
-                conn.commit()
-            return c.fetchall()
+            with metrics.sql(query):
+                c = conn.execute(query, params)
+                rows = c.fetchall()
+                if commit:
+                    conn.commit()
+            return rows
         except Exception as e:
+            conn.rollback()
             print(f"[DB Error] {e}")
             raise e
         finally:
-            conn.close()
+            self.db_pool.release(conn)
 
-    def replicate_to_peers(self, query, params):
+    # --- Replication Log ---
+    def apply_write(self, query, params, log_index=None, term=None):
         """
         FAULT TOLERANCE:
-        Broadcasts state changes (Metadata updates) to all other Masters.
-        This ensures if the Leader dies, followers have the latest User/File lists.
+        Commits a metadata write together with its replication log entry in one
+        SQLite transaction, then mirrors it into the in-memory cache.
+        The leader assigns the next sequence number and its term; followers pass the leader's.
+        Returns the entry's index, or None if a follower already applied it.
         """
-        for peer in self.peers:
+        with self.log_cond:
+            if log_index is None:
+                log_index, term = self.last_applied + 1, self.term
+            elif log_index <= self.last_applied:
+                return None
+            elif log_index != self.last_applied + 1:
+                raise ValueError(f"Log gap: expected {self.last_applied + 1}, got {log_index}")
+
+            conn = self.db_pool.acquire()
+            try:
+                with metrics.sql(query):  # The statement, its log entry and the commit
+                    conn.execute(query, params)
+                    conn.execute("INSERT INTO replication_log (log_index, query, params, term) VALUES (?, ?, ?, ?)",
+                                 (log_index, query, json.dumps(params), term or 0))
+                    conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"[DB Error] {e}")
+                raise e
+            finally:
+                self.db_pool.release(conn)
+
+            self.last_applied, self.last_term = log_index, term or 0
+            if not self.cache.apply(query, params):
+                self.cache.load(self.run_query)  # Unknown statement: rebuild from disk
+                self.acl_cache.clear()
+            elif query == SQL_INSERT_PERMISSION:
+                self.acl_cache.invalidate(params[1], params[2])
+            elif query == SQL_UPDATE_PERMISSION:
+                perm = self.cache.permissions.get(params[1])
+                if perm:
+                    self.acl_cache.invalidate(perm['file_id'], perm['user_id'])
+            self.log_cond.notify_all()  # Wake the replication senders
+            return log_index
+
+    def read_log(self, after, limit=REPLICATION_BATCH):
+        rows = self.run_query("SELECT log_index, term, query, params FROM replication_log WHERE log_index>? ORDER BY log_index LIMIT ?",
+                              (after, limit))
+        return [{"index": r[0], "term": r[1], "query": r[2], "params": json.loads(r[3])} for r in rows]
+
+    def term_at(self, index):
+        """Term of our log entry at `index`: 0 before the first, None if it was dropped behind a checkpoint."""
+        if index == 0:
+            return 0
+        rows = self.run_query("SELECT term FROM replication_log WHERE log_index=?", (index,))
+        if rows:
+            return rows[0][0]
+        if index == self.checkpoint["index"]:
+            return self.checkpoint["term"]
+        return None
+
+    def apply_entries(self, entries, prev_index=None, prev_term=None):
+        """
+        Applies shipped log entries in order, stopping at the first gap.
+        Returns (last applied index, conflict). Conflict: our log diverged from the
+        sender's, at the entry before the batch (prev_index) or at one we already hold,
+        because a deposed leader left us entries the sender never had.
+        """
+        if prev_index is not None and prev_term is not None and prev_index <= self.last_applied \
+                and self.term_at(prev_index) not in (None, prev_term):
+            return self.last_applied, True
+        for e in entries:
+            if e['index'] <= self.last_applied:
+                if self.term_at(e['index']) not in (None, e.get('term', 0)):
+                    return self.last_applied, True
+                continue
             try:
-                requests.post(f"http://localhost:{peer}/system/replicate", 
-                              json={"query": query, "params": params}, 
-                              timeout=0.5)
+                self.apply_write(e['query'], e['params'], log_index=e['index'], term=e.get('term', 0))
+            except ValueError:
+                break
+        return self.last_applied, False
+
+    def set_term(self, term):
+        """Raises our leader term; persisted so a restarted master keeps refusing older leaders."""
+        with self.term_lock:
+            if term <= self.term:
+                return
+            self.term = term
+            self.run_query("INSERT OR REPLACE INTO election_state (id, term) VALUES (0, ?)", (term,), commit=True)
+
+    def replication_sender(self, peer):
+        """
+        Background shipper for one follower. Sends batches of log entries starting
+        at the follower's next index, with our term and the term of the entry before
+        the batch; the follower acks with its last applied index and term, which also
+        rewinds us after it restarts or misses a batch.
+        FAULT TOLERANCE: a follower whose log diverged (it holds entries of a deposed
+        leader, so it is ahead of us or disagrees with us on a term) is told to reset:
+        it replaces its state with our checkpoint and replays our log from there.
+        """
+        session = requests.Session()
+        next_index, reset = None, None
+        while True:
+            with self.log_cond:
+                while self.leader_id != self.port or not self.leader_ready:
+                    next_index, reset = None, None
+                    self.log_cond.wait(1)
+                if next_index is None:
+                    next_index = self.last_applied + 1
+                if next_index > self.last_applied:
+                    self.log_cond.wait(REPLICATION_PROBE_INTERVAL)
+
+            # A follower behind our log floor gets no entries: the log_floor tells it to
+            # bootstrap from our checkpoint, and we probe until it has
+            behind = next_index <= self.log_floor
+            entries = [] if behind else self.read_log(next_index - 1)
+            try:
+                with metrics.rpc("replication", peer):
+                    r = session.post(f"http://localhost:{peer}/system/replicate",
+                                     json={"leader": self.port, "term": self.term, "entries": entries,
+                                           "prev_index": next_index - 1,
+                                           "prev_term": None if behind else self.term_at(next_index - 1),
+                                           "log_floor": self.log_floor, "leader_index": self.last_applied,
+                                           "reset": reset}, timeout=TIMEOUT)
+                data = r.json()
+                if r.status_code == 409 and data.get('term', 0) > self.term:
+                    self.step_down(data['term'])
+                    continue
+                acked = data['applied_index']
+                # Our log only grows while we lead, so a follower past its end holds entries we never had
+                reset = [acked, data.get('last_term', 0)] if acked > self.last_applied else None
+                self.peer_match_index[peer] = acked
+                next_index = min(acked, self.last_applied) + 1
+                if behind or reset:
+                    time.sleep(0.5)  # Bootstrapping; probe again soon to resume shipping entries
             except:
-                pass  # Best-effort replication (Eventual Consistency)
+                self.peer_match_index.pop(peer, None)
+                time.sleep(0.5)  # Follower down; retry from the same index
+
+    def catch_up(self, reset=False):
+        """
+        Pulls missed log entries from the leader, starting after our last applied index.
+        If the leader already folded them into a checkpoint, installs that first.
+        reset: our log diverged from the leader's; start over from its checkpoint.
+        """
+        leader = self.leader_id
+        if leader is None or leader == self.port:
+            return
+        if not self.catch_up_lock.acquire(blocking=False):
+            return
+        try:
+            self.replay_from(leader, reset)
+        finally:
+            self.catch_up_lock.release()
+
+    def replay_from(self, source, reset=False):
+        """
+        Pulls entries from `source` (the leader, or the freshest peer while we are being
+        elected) until we hold its whole log. Each pull names the term of our last entry:
+        if the source disagrees there, our log diverged and is replaced by its checkpoint.
+        """
+        resets = 0
+        while True:
+            if reset:
+                if resets or not self.bootstrap_from(source, force=True):
+                    return  # A reset that did not resolve the conflict is retried by the next probe
+                reset, resets = False, resets + 1
+            try:
+                with metrics.rpc("catch_up", source):
+                    r = requests.get(f"http://localhost:{source}/system/log",
+                                     params={"after": self.last_applied, "term": self.last_term}, timeout=TIMEOUT)
+                if r.status_code != 200:
+                    return  # A new leader still catching up itself; its replication probes reach us later
+                data = r.json()
+            except:
+                return
+            if data.get('conflict'):
+                print(f"[Node-{self.port}] Log diverged from {source} after index {self.last_applied}; resetting")
+                reset = True
+                continue
+            if data.get('truncated'):
+                if not self.bootstrap_from(source):
+                    return
+                continue
+            entries = data['entries']
+            if not entries:
+                return
+            before = self.last_applied
+            _, conflict = self.apply_entries(entries)
+            if conflict:
+                reset = True
+                continue
+            if self.last_applied == before:
+                return
+            print(f"[Node-{self.port}] Caught up to log index {self.last_applied}")
+
+    # --- Checkpoints ---
+    def checkpoint_loop(self):
+        while True:
+            time.sleep(CHECKPOINT_INTERVAL)
+            if self.last_applied - self.checkpoint["index"] < CHECKPOINT_MIN_ENTRIES:
+                continue
+            try:
+                self.take_checkpoint()
+            except Exception as e:
+                print(f"[Checkpoint] Failed: {e}")
+
+    def take_checkpoint(self):
+        """
+        FAULT TOLERANCE:
+        Writes the whole metadata state as of one log index to a compressed file, then
+        drops the log behind it (keeping LOG_RETAIN entries for briefly lagging followers).
+        The tables are read in one SQLite read transaction: WAL gives it a consistent
+        snapshot while writes keep committing, so a checkpoint never blocks them.
+        """
+        with self.checkpoint_lock:
+            started = time.time()
+            conn = self.db_pool.acquire()
+            try:
+                conn.execute("BEGIN")
+                index = max(conn.execute("SELECT COALESCE(MAX(log_index), 0) FROM replication_log").fetchone()[0],
+                            self.checkpoint["index"])
+                row = conn.execute("SELECT term FROM replication_log WHERE log_index=?", (index,)).fetchone()
+                term = row[0] if row else self.checkpoint["term"]
+                tables = {t: [list(row) for row in conn.execute(f"SELECT * FROM {t}")] for t in CHECKPOINT_TABLES}
+            finally:
+                conn.rollback()
+                self.db_pool.release(conn)
+            with self.lease_lock:
+                leases = {h: dict(l) for h, l in self.leases.items()}
+
+            self.write_checkpoint(zlib.compress(json.dumps({
+                "index": index, "term": term, "taken_at": started, "tables": tables, "leases": leases
+            }).encode(), 6), index, started, term)
+            self.checkpoint["seconds"] = round(time.time() - started, 4)
+
+        floor = index - LOG_RETAIN
+        if floor > self.log_floor:
+            self.log_floor = floor  # Before the delete: never serve a log with a hole in it
+            self.run_query("DELETE FROM replication_log WHERE log_index <= ?", (floor,), commit=True)
+        print(f"[Checkpoint] Index {index}: {self.checkpoint['bytes']} bytes in {self.checkpoint['seconds']}s")
+        return index
+
+    def write_checkpoint(self, payload, index, taken_at, term, force=False):
+        """
+        Atomically replaces our checkpoint file and records the index it covers. Never moves
+        back, unless forced: a reset replaces a diverged history, checkpoint included.
+        """
+        if index < self.checkpoint["index"] and not force:
+            return
+        temp = self.checkpoint_path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.checkpoint_path)
+        self.run_query("INSERT OR REPLACE INTO checkpoint_state (id, log_index, taken_at, term) VALUES (0, ?, ?, ?)",
+                       (index, taken_at, term), commit=True)
+        self.checkpoint.update(index=index, term=term, taken_at=taken_at, bytes=len(payload))
+
+    def bootstrap_from(self, source, force=False):
+        """
+        Fetches a peer's latest checkpoint and installs it. Returns True if we moved forward
+        (or, forced, replaced our diverged state with it).
+        """
+        try:
+            with metrics.rpc("checkpoint", source):
+                r = requests.get(f"http://localhost:{source}/system/checkpoint", timeout=TIMEOUT * 10)
+            r.raise_for_status()
+            snapshot = json.loads(zlib.decompress(r.content))
+        except Exception as e:
+            print(f"[Checkpoint] Bootstrap from {source} failed: {e}")
+            return False
+        if not self.install_checkpoint(snapshot, force):
+            return False
+        with self.checkpoint_lock:  # Ours to serve if elected
+            self.write_checkpoint(r.content, snapshot["index"], snapshot["taken_at"], snapshot.get("term", 0), force)
+        print(f"[Node-{self.port}] Installed checkpoint {snapshot['index']} from {source} ({len(r.content)} bytes)")
+        return True
+
+    def install_checkpoint(self, snapshot, force=False):
+        """
+        Replaces all metadata with a checkpoint's in one transaction; the log resumes after its index.
+        Forced, this also goes back: the entries we drop were never on the leader.
+        """
+        index = snapshot["index"]
+        with self.log_cond:
+            if index <= self.last_applied and not force:
+                return False
+            conn = self.db_pool.acquire()
+            try:
+                for table in CHECKPOINT_TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+                    rows = snapshot["tables"].get(table, [])  # Checkpoints from before chunk_versions
+                    if rows:
+                        conn.executemany(f"INSERT INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows)
+                conn.execute("DELETE FROM replication_log")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"[DB Error] {e}")
+                raise e
+            finally:
+                self.db_pool.release(conn)
+            self.last_applied = self.log_floor = index
+            self.last_term = snapshot.get("term", 0)
+            self.cache.load(self.run_query)
+            self.acl_cache.clear()
+            self.log_cond.notify_all()
+        self.adopt_leases(snapshot.get("leases", {}))
+        return True
+
+    def adopt_leases(self, leases):
+        """Leases from an installed checkpoint, honored until they expire should we become leader."""
+        now = time.time()
+        with self.lease_lock:
+            for handle, lease in leases.items():
+                if lease["expires"] > now and handle not in self.leases:
+                    self.leases[handle] = {"primary": lease["primary"], "expires": lease["expires"]}
+                    heapq.heappush(self.lease_heap, (lease["expires"], handle))
+                    self.lease_counts[lease["primary"]] = self.lease_counts.get(lease["primary"], 0) + 1
 
     # --- Berkeley Algorithm (Clock Sync) ---
     def sync_clocks(self):
         """
-        Runs periodically on the Leader.
-        1. Polls Chunkservers for their simulated time.
-        2. Calculates average time difference.
-        3. Sends adjustments to align everyone.
+        BERKELEY ALGORITHM (runs on the Leader, the time daemon):
+        1. Polls all live chunkservers concurrently; each offset is Cristian-corrected by
+           assuming the reply was stamped half a round trip before it arrived.
+        2. Averages the offsets (our own clock counts as 0), ignoring samples whose RTT
+           is too long to trust and offsets far from the median.
+        3. Sends every polled server its adjustment towards that average, concurrently.
         """
         while True:
-            time.sleep(10)
+            time.sleep(CLOCK_SYNC_INTERVAL)
             if self.leader_id != self.port:
                 continue  # Only Leader acts as Time Daemon
-            
-            # Find live chunkservers
-            now = time.time()
-            active_ports = [p for p, t in self.active_chunkservers.items() if now - t < 10]
+            active_ports = self.live_chunkservers()
             if not active_ports:
                 continue
+            try:
+                self.sync_round(active_ports)
+            except Exception as e:
+                print(f"[Clock Sync] Error: {e}")
 
-            server_offsets = []
-            my_time = time.time()
-            valid_ports = []
-
-            # 1. Poll
-            for port in active_ports:
-                try:
-                    r = requests.get(f"http://localhost:{port}/admin/clock", timeout=1)
-                    data = r.json()
-                    # Calculate diff: (Their Time - My Time)
-                    diff = data['simulated_time'] - my_time
-                    server_offsets.append(diff)
-                    valid_ports.append(port)
-                except:
-                    pass
-            
-            if not server_offsets:
-                continue
+    def poll_clock(self, port):
+        """Returns (offset, rtt) of a chunkserver's clock relative to ours, or None."""
+        try:
+            sent = time.time()
+            with metrics.rpc("clock_sync", port):
+                r = self.clock_session.get(f"http://localhost:{port}/admin/clock", timeout=CLOCK_POLL_TIMEOUT)
+            received = time.time()
+            rtt = received - sent
+            return r.json()['simulated_time'] + rtt / 2 - received, rtt
+        except:
+            return None
 
-            # 2. Average the differences
-            avg_diff = statistics.mean(server_offsets)
-            
-            # 3. Adjust
-            # If a server is +10s ahead, and avg is +5s ahead.
-            # Adjustment = Avg - Current = 5 - 10 = -5s.
-            for i, port in enumerate(valid_ports):
-                adjustment = avg_diff - server_offsets[i]
-                try:
-                    requests.post(f"http://localhost:{port}/admin/adjust-clock", 
-                                  json={"offset": adjustment}, timeout=0.5)
-                except:
-                    pass
+    def sync_round(self, ports):
+        started = time.time()
+        # 1. Poll
+        samples = {p: s for p, s in zip(ports, self.clock_pool.map(self.poll_clock, ports)) if s}
+        if not samples:
+            return
+
+        # 2. Fault-tolerant average
+        trusted = {p: off for p, (off, rtt) in samples.items() if rtt <= CLOCK_MAX_RTT}
+        offsets = list(trusted.values()) + [0.0]  # The daemon's own clock takes part
+        median = statistics.median(offsets)
+        spread = statistics.median(abs(o - median) for o in offsets)
+        limit = max(CLOCK_OUTLIER_FLOOR, CLOCK_OUTLIER_MADS * spread)
+        kept = [o for o in offsets if abs(o - median) <= limit]
+        avg_diff = statistics.mean(kept)
+
+        # 3. Adjust
+        # If a server is +10s ahead, and avg is +5s ahead.
+        # Adjustment = Avg - Current = 5 - 10 = -5s.
+        def adjust(port):
+            try:
+                with metrics.rpc("clock_adjust", port):
+                    self.clock_session.post(f"http://localhost:{port}/admin/adjust-clock",
+                                            json={"offset": avg_diff - samples[port][0]}, timeout=CLOCK_POLL_TIMEOUT)
+                return True
+            except:
+                return False
+        adjusted = dict(zip(samples, self.clock_pool.map(adjust, samples)))
+
+        self.clock_sync = {
+            "round_duration": round(time.time() - started, 4),
+            "last_round": started,
+            "average_offset": avg_diff,
+            "polled": len(ports),
+            "nodes": {p: {"offset": round(off, 6), "rtt": round(rtt, 6),
+                          "adjustment": round(avg_diff - off, 6),
+                          "outlier": p not in trusted or abs(off - median) > limit,
+                          "adjusted": adjusted[p]}
+                      for p, (off, rtt) in samples.items()}
+        }
 
     # --- Lease Management ---
-    def grant_lease(self, chunk_handle, replicas):
+    def grant_lease(self, chunk_handle, replicas, stale=()):
         """
         GFS CONSISTENCY:
         Ensures one replica holds a valid lease to act as Primary for mutations.
+        New leases go to the replica holding the fewest leases (then the least loaded),
+        so primaries, and the mutation serialization they do, spread across servers.
+        The version RPCs of a new grant run outside lease_lock, under a per-chunk lock,
+        so other chunks' grants and heartbeat lease extensions do not wait on them.
+        Replicas flagged `stale` by their last report are asked too: one found on the
+        newest version only lagged, and is moved to the new version with the others.
         """
-        now = time.time()
-        
-        # Check existing lease
-        if chunk_handle in self.leases:
-            lease = self.leases[chunk_handle]
-            # If lease is valid and the primary is still in the replica list
-            if lease['expires'] > now and lease['primary'] in replicas:
-                return lease['primary']
-        
-        # Grant new lease
-        if not replicas:
-            return None
-            
-        primary = replicas[0]  # Simple strategy: Pick first
-        self.leases[chunk_handle] = {
-            'primary': primary,
-            'expires': now + LEASE_DURATION
-        }
+        with self.grant_lock(chunk_handle):
+            with self.lease_lock:
+                self.reclaim_expired_leases(time.time())
+
+                # Check existing lease
+                lease = self.leases.get(chunk_handle)
+                # If lease is valid and the primary is still in the replica list
+                if lease and lease['primary'] in replicas:
+                    return lease['primary']
+                if lease:
+                    self.release_lease(chunk_handle)
+
+            # Grant new lease
+            if not replicas and not stale:
+                return None
+
+            # CHUNK VERSIONING: only replicas moved to the lease's new version may be primary
+            bumped = self.bump_version(chunk_handle, list(replicas) + [p for p in stale if p not in replicas])
+            if bumped is not None:
+                replicas = bumped
+            if not replicas:
+                return None
+
+            now = time.time()
+            with self.lease_lock:
+                scores = self.placement_scores(replicas)
+                primary = min(replicas, key=lambda p: (self.overloaded_until.get(p, 0) > now,
+                                                       self.lease_counts.get(p, 0), scores[p]))
+                self.leases[chunk_handle] = {'primary': primary, 'expires': now + LEASE_DURATION}
+                heapq.heappush(self.lease_heap, (now + LEASE_DURATION, chunk_handle))
+                self.lease_counts[primary] = self.lease_counts.get(primary, 0) + 1
         print(f"[Lease] Granted lease for {chunk_handle} to Node {primary}")
         return primary
 
-    # --- Bully Election Algorithm ---
-    def start_election(self):
-        print(f"[Node-{self.port}] Starting Election...")
-        self.election_in_progress = True
-        higher_nodes = [p for p in self.peers if p > self.port]
-        
-        if not higher_nodes:
-            self.declare_victory()
-            return
+    def grant_lock(self, chunk_handle):
+        """Lock serializing lease grants (and so version bumps) of one chunk."""
+        with self.grant_locks_guard:
+            return self.grant_locks.setdefault(chunk_handle, threading.Lock())
+
+    def current_lease(self, chunk_handle, replicas):
+        """The chunk's unexpired lease if its primary is still a fresh replica, else None. Grants nothing."""
+        with self.lease_lock:
+            lease = self.leases.get(chunk_handle)
+            if lease and lease['expires'] > time.time() and lease['primary'] in replicas:
+                return dict(lease)
+        return None
 
-        found_higher = False
-        for p in higher_nodes:
+    def bump_version(self, chunk_handle, replicas):
+        """
+        CHUNK VERSIONING (GFS: a new lease starts a new chunk version):
+        Asks each replica for its version, moves those on the newest to the next one, then
+        records it in the log. A replica that was down through the grant is then stale even
+        if this master restarts before it reports again; had we crashed before recording,
+        the replicas' higher reports win (chunk_versions keeps the highest seen).
+        Returns the replicas on the new version, or None for a chunk never written (nothing
+        can be stale yet). Caller holds the chunk's grant_lock: this only runs when a lease is granted.
+        """
+        if self.known_version(chunk_handle) == 0:
+            return None
+
+        def ask(method, port, path, body=None):
             try:
-                requests.post(f"http://localhost:{p}/election/msg", 
-                              json={"type": "ELECTION", "sender": self.port}, 
-                              timeout=1)
-                found_higher = True
-            except:
+                r = requests.request(method, f"http://localhost:{port}{path}", json=body, timeout=LEASE_VERSION_TIMEOUT)
+                return r.json().get('version') if r.status_code == 200 else None
+            except (requests.RequestException, ValueError):
+                return None
+
+        current = dict(zip(replicas, self.lease_pool.map(
+            lambda p: ask('get', p, f"/chunk/checksum/{chunk_handle}"), replicas)))
+        newest = max([v for v in current.values() if v] + [self.known_version(chunk_handle)])
+        on_newest = [p for p, v in current.items() if v == newest]
+        body = {"handle": chunk_handle, "expected": newest, "version": newest + 1}
+        acks = self.lease_pool.map(lambda p: ask('post', p, "/chunk/version", body), on_newest)
+        bumped = [p for p, v in zip(on_newest, acks) if v == newest + 1]
+        if bumped:
+            for port in bumped:
+                self.chunk_reports.setdefault(port, {})[chunk_handle] = newest + 1
+                self.stale_reports.get(port, set()).discard(chunk_handle)
+                failed = self.failed_replicas.get(chunk_handle, {})
+                if failed.get(port, newest + 1) <= newest:
+                    del failed[port]  # Holds the version it missed: caught up
+                    if not failed:
+                        self.failed_replicas.pop(chunk_handle, None)
+            self.chunk_versions[chunk_handle] = max(self.chunk_versions.get(chunk_handle, 0), newest + 1)
+            self.apply_write(SQL_SET_CHUNK_VERSION, (chunk_handle, newest + 1))
+            print(f"[Lease] {chunk_handle} moved to version {newest + 1} on {bumped}")
+        return bumped
+
+    def known_version(self, chunk_handle):
+        """Newest version of the chunk: reported by a replica, or recorded at its last lease grant."""
+        return max(self.chunk_versions.get(chunk_handle, 0), self.cache.versions.get(chunk_handle, 0))
+
+    def extend_leases(self, port, handles):
+        """
+        Called with the chunks a primary mutated since its last heartbeat: their leases
+        are extended in place instead of expiring and being re-granted.
+        Returns {chunk_handle: new expiry} for the leases extended.
+        """
+        now = time.time()
+        extended = {}
+        with self.lease_lock:
+            for handle in handles:
+                lease = self.leases.get(handle)
+                if lease and lease['primary'] == port and lease['expires'] > now:
+                    lease['expires'] = now + LEASE_DURATION
+                    heapq.heappush(self.lease_heap, (lease['expires'], handle))
+                    extended[handle] = lease['expires']
+            self.lease_extensions += len(extended)
+        return extended
+
+    def reclaim_expired_leases(self, now):
+        """Pops every expired lease off the heap (caller holds lease_lock)."""
+        while self.lease_heap and self.lease_heap[0][0] <= now:
+            expires, handle = heapq.heappop(self.lease_heap)
+            lease = self.leases.get(handle)
+            if lease and lease['expires'] == expires:
+                self.release_lease(handle)
+
+    def lease_stats(self):
+        with self.lease_lock:
+            self.reclaim_expired_leases(time.time())
+            return {
+                "active": len(self.leases),
+                "per_server": {p: n for p, n in self.lease_counts.items() if n},
+                "heap_size": len(self.lease_heap),
+                "extensions": self.lease_extensions
+            }
+
+    def release_lease(self, chunk_handle):
+        lease = self.leases.pop(chunk_handle)
+        self.lease_counts[lease['primary']] -= 1
+
+    # --- Chunk Allocation ---
+    def live_chunkservers(self):
+        now = time.time()
+        return [p for p, t in self.active_chunkservers.items() if now - t < 10]
+
+    def allocate_chunks(self, file_id, count):
+        """
+        GFS CHUNKING:
+        Ensures chunks 0..count-1 exist for a file. Missing chunks are placed on
+        live chunkservers and recorded in chunk_mapping with their sequence.
+        Returns False if no chunkserver is available to host a new chunk.
+        """
+        with self.allocation_lock:
+            existing = self.cache.chunks.get(file_id, {})
+            missing = [seq for seq in range(count) if seq not in existing]
+            if not missing:
+                return True
+
+            if not self.live_chunkservers():
+                return False
+
+            for seq in missing:
+                replicas = self.place_replicas(REPLICATION_FACTOR)
+                chunk_handle = f"chunk_{file_id}_{seq}"
+                primary = self.grant_lease(chunk_handle, replicas)
+                q = SQL_INSERT_CHUNK
+                p = (chunk_handle, file_id, seq, primary, ",".join(map(str, replicas)))
+                self.apply_write(q, p)
+            return True
+
+    # --- Replica Placement ---
+    def record_stats(self, port, stats):
+        self.chunkserver_stats[port] = stats
+        self.placed_since_report[port] = 0
+        if stats.get('in_flight', 0) > OVERLOAD_IN_FLIGHT or stats.get('request_rate', 0) > OVERLOAD_RATE:
+            self.overloaded_until[port] = time.time() + OVERLOAD_COOLDOWN
+
+    def placement_scores(self, ports):
+        """
+        Lower is better. Each server's share of the cluster's stored bytes and of its
+        load, weighted. Chunks placed since the last heartbeat count as average-sized,
+        so a burst of allocations does not all land on the server that looked emptiest.
+        """
+        stats = {p: self.chunkserver_stats.get(p, {}) for p in ports}
+        chunks = sum(s.get('chunk_count', 0) for s in stats.values())
+        avg_chunk = sum(s.get('stored_bytes', 0) for s in stats.values()) / chunks if chunks else 1
+        disk = {p: s.get('stored_bytes', 0) + self.placed_since_report.get(p, 0) * avg_chunk
+                for p, s in stats.items()}
+        load = {p: s.get('request_rate', 0) + s.get('in_flight', 0) for p, s in stats.items()}
+        total_disk, total_load = sum(disk.values()) or 1, max(sum(load.values()), LOAD_NOISE_FLOOR)
+        return {p: DISK_WEIGHT * disk[p] / total_disk + LOAD_WEIGHT * load[p] / total_load for p in ports}
+
+    def place_replicas(self, count, exclude=()):
+        """
+        PLACEMENT POLICY:
+        Picks `count` live servers with the lowest placement score, skipping recently
+        overloaded ones unless there are not enough others.
+        """
+        now = time.time()
+        live = [p for p in self.live_chunkservers() if p not in exclude]
+        scores = self.placement_scores(live)
+        calm = [p for p in live if self.overloaded_until.get(p, 0) <= now]
+        busy = [p for p in live if p not in calm]
+        chosen = (sorted(calm, key=scores.get) + sorted(busy, key=scores.get))[:count]
+        for p in chosen:
+            self.placed_since_report[p] = self.placed_since_report.get(p, 0) + 1
+        return chosen
+
+    def rebalance_loop(self):
+        """Leader only: slowly moves chunks off the hottest server."""
+        while True:
+            time.sleep(REBALANCE_INTERVAL)
+            if not self.is_leader():
                 continue
-        
-        if not found_higher:
-            self.declare_victory()
+            try:
+                self.rebalance_once()
+            except Exception as e:
+                print(f"[Rebalance] Error: {e}")
+
+    def rebalance_once(self):
+        """
+        Moves one chunk from the hottest live server that has a movable chunk to the
+        coolest server that does not hold it. Chunks whose lease the hot server holds,
+        and chunks moved recently, are left alone.
+        """
+        live = self.live_chunkservers()
+        if len(live) < 2:
+            return False
+        scores = self.placement_scores(live)
+        coolest = min(scores.values())
+        now = time.time()
+
+        for hot in sorted(live, key=scores.get, reverse=True):
+            if scores[hot] - coolest < REBALANCE_THRESHOLD and self.overloaded_until.get(hot, 0) <= now:
+                return False
+            with self.cache.lock:
+                candidates = [dict(e) for chunks in self.cache.chunks.values()
+                              for e in chunks.values() if hot in e['replicas']]
+            for entry in candidates:
+                handle = entry['handle']
+                lease = self.leases.get(handle)
+                if lease and lease['primary'] == hot and lease['expires'] > now:
+                    continue
+                if now - self.last_moved.get(handle, 0) < REBALANCE_COOLDOWN:
+                    continue
+                targets = [p for p in live if p not in entry['replicas'] and self.overloaded_until.get(p, 0) <= now]
+                if not targets:
+                    continue
+                target = min(targets, key=scores.get)
+                if scores[target] < scores[hot] and self.move_chunk(entry, hot, target):
+                    return True
+        return False
+
+    def move_chunk(self, entry, source, target):
+        """The target clones the chunk, the mapping is switched, then the source deletes its copy."""
+        handle = entry['handle']
+        try:
+            with metrics.rpc("rebalance", target):
+                r = requests.post(f"http://localhost:{target}/chunk/clone",
+                                  json={"handle": handle, "source": source}, timeout=TIMEOUT * 5)
+            r.raise_for_status()
+            if r.json().get('version', 0) < self.known_version(handle):
+                return False  # Mutated while copying; try again next pass
+        except:
+            return False
+
+        replicas = [target if p == source else p for p in entry['replicas']]
+        primary = entry['primary'] if entry['primary'] != source else replicas[0]
+        self.apply_write(SQL_UPDATE_CHUNK_LOCATIONS, (primary, ",".join(map(str, replicas)), handle))
+        try:
+            requests.post(f"http://localhost:{source}/chunk/delete", json={"handle": handle}, timeout=TIMEOUT)
+        except:
+            pass  # The orphaned copy is harmless: it is no longer in the mapping
+
+        # Count the move now; the next heartbeats replace these estimates with real stats
+        self.placed_since_report[target] = self.placed_since_report.get(target, 0) + 1
+        self.placed_since_report[source] = self.placed_since_report.get(source, 0) - 1
+        self.last_moved[handle] = time.time()
+        self.rebalance_moves += 1
+        print(f"[Rebalance] Moved {handle} from {source} to {target}")
+        return True
+
+    # --- Re-replication ---
+    def under_replicated(self):
+        """
+        [(live up-to-date replicas, chunk_handle)] for chunks below the replication target.
+        Chunks with data but no live up-to-date replica cannot be repaired and are only counted.
+        """
+        live = set(self.live_chunkservers())
+        target = min(REPLICATION_FACTOR, len(live))
+        with self.cache.lock:
+            entries = [dict(e) for chunks in self.cache.chunks.values() for e in chunks.values()]
+        found, lost = [], 0
+        for entry in entries:
+            fresh, _ = self.split_stale(entry['handle'], [p for p in entry['replicas'] if p in live])
+            if len(fresh) >= target:
+                continue
+            if not fresh and self.known_version(entry["handle"]) > 0:
+                lost += 1
+                continue
+            found.append((len(fresh), entry['handle']))
+        self.repair_stats["lost"] = lost
+        self.repair_stats["under_replicated"] = len(found)
+        self.repair_stats["last_scan"] = time.time()
+        return found
+
+    def rereplication_scan_loop(self):
+        """Leader only: queues under-replicated chunks, most endangered first."""
+        while True:
+            time.sleep(REREPLICATION_SCAN_INTERVAL)
+            if not self.is_leader():
+                continue
+            try:
+                for live_count, handle in self.under_replicated():
+                    self.queue_repair(live_count, handle)
+            except Exception as e:
+                print(f"[Re-replication] Scan error: {e}")
+
+    def queue_repair(self, live_count, handle):
+        with self.repair_lock:
+            if handle in self.repair_queued:
+                return
+            self.repair_queued.add(handle)
+            self.repair_arrivals += 1
+            self.repair_queue.put((live_count, self.repair_arrivals, handle))
+
+    def record_replica_failure(self, handle, port, version):
+        """
+        GFS REPLICATION:
+        A primary reported that `port` never applied `version` of the chunk. The replica
+        is stale from now on (no reads, no lease) until it reports that version or newer,
+        or re-replication refreshes it; the leader queues that repair right away.
+        """
+        failed = self.failed_replicas.setdefault(handle, {})
+        failed[port] = max(failed.get(port, 0), version)
+        if self.is_leader():
+            self.queue_repair(REPLICATION_FACTOR - 1, handle)  # One replica behind
+
+    def rereplication_worker(self):
+        while True:
+            _, _, handle = self.repair_queue.get()
+            copied = 0
+            try:
+                copied = self.repair_chunk(handle)
+            except Exception as e:
+                self.repair_stats["failed"] += 1
+                print(f"[Re-replication] {handle} failed: {e}")
+            finally:
+                with self.repair_lock:
+                    self.repair_queued.discard(handle)
+            # Throttle: this worker's share of the recovery bandwidth
+            if copied:
+                time.sleep(copied / (REREPLICATION_BANDWIDTH / REREPLICATION_WORKERS))
+
+    def repair_chunk(self, handle):
+        """
+        GFS RE-REPLICATION:
+        Brings a chunk back to the replication target. Live but stale replicas are
+        refreshed in place first, then new servers chosen by placement copy it from the
+        least loaded up-to-date replica. A copy counts once its checksum matches the
+        source; chunk_mapping then drops dead replicas and adds the new ones.
+        Returns the bytes copied.
+        """
+        with self.cache.lock:
+            file_id, sequence = self.cache.handles.get(handle, (None, None))
+            entry = dict(self.cache.chunks[file_id][sequence]) if file_id is not None else None
+        if not entry or not self.is_leader():
+            return 0
+
+        live = set(self.live_chunkservers())
+        present = [p for p in entry['replicas'] if p in live]
+        fresh, stale = self.split_stale(handle, present)
+        missing = min(REPLICATION_FACTOR, len(live)) - len(fresh)
+        if missing <= 0:
+            return 0
+        targets = stale[:missing]
+        targets += self.place_replicas(missing - len(targets), exclude=entry['replicas'])
+
+        version = self.known_version(handle)
+        scores = self.placement_scores(fresh)
+        copied, added = 0, []
+        for target in targets:
+            if version == 0:
+                added.append(target)  # Never written: nothing to copy
+                continue
+            source = min(fresh, key=scores.get)
+            try:
+                with metrics.rpc("rereplication", target):
+                    r = requests.post(f"http://localhost:{target}/chunk/clone",
+                                      json={"handle": handle, "source": source}, timeout=TIMEOUT * 5)
+                r.raise_for_status()
+                copied += r.json().get('bytes', 0)
+                got = requests.get(f"http://localhost:{target}/chunk/checksum/{handle}", timeout=TIMEOUT).json()
+                want = requests.get(f"http://localhost:{source}/chunk/checksum/{handle}", timeout=TIMEOUT).json()
+                if got.get('checksum') != want.get('checksum') or got.get('version', 0) < version:
+                    raise ValueError(f"verification failed on {target}")
+            except Exception as e:
+                self.repair_stats["failed"] += 1
+                print(f"[Re-replication] Copy of {handle} to {target} failed: {e}")
+                continue
+            self.chunk_reports.setdefault(target, {})[handle] = got['version']
+            self.stale_reports.get(target, set()).discard(handle)
+            added.append(target)
+
+        replicas = present + [p for p in added if p not in present]
+        if replicas != entry['replicas'] and replicas:
+            primary = entry['primary'] if entry['primary'] in replicas else replicas[0]
+            self.apply_write(SQL_UPDATE_CHUNK_LOCATIONS, (primary, ",".join(map(str, replicas)), handle))
+        if handle in self.failed_replicas:
+            for port in added:
+                self.failed_replicas[handle].pop(port, None)
+            if not self.failed_replicas[handle]:
+                del self.failed_replicas[handle]
+        if added:
+            self.repair_stats["completed"] += 1
+            self.repair_stats["bytes"] += copied
+            print(f"[Re-replication] {handle}: copied to {added}, replicas now {replicas}")
+        return copied
+
+    def record_chunk_report(self, port, versions):
+        """
+        CHUNK VERSIONING:
+        Decides, once per report, which of the port's chunks are stale: those reported
+        behind the newest version known as the report arrives. The verdict stands until
+        the port's next report, so later reports from other replicas cannot flip it.
+        """
+        now = time.time()
+        self.stale_reports[port] = {h for h, v in versions.items() if v < self.known_version(h)}
+        self.chunk_reports[port] = versions
+        self.reported_at[port] = now
+        for handle, version in versions.items():
+            if version > self.chunk_versions.get(handle, 0):
+                self.chunk_versions[handle] = version
+            if version > 0:
+                self.version_first_seen.setdefault(handle, now)
+            failed = self.failed_replicas.get(handle)
+            if failed and version >= failed.get(port, version + 1):
+                del failed[port]  # Caught up (a primary's background retry got through)
+                if not failed:
+                    self.failed_replicas.pop(handle, None)
+
+    def split_stale(self, chunk_handle, replicas):
+        """
+        CHUNK VERSIONING:
+        A replica whose last report held an older version than the newest one known
+        (or lacked a chunk already written when it reported) missed mutations and must
+        not serve it, as must one a primary reported failing a mutation. Replicas that
+        have not reported yet are given the benefit of the doubt.
+        """
+        latest = self.known_version(chunk_handle)
+        written_at = self.version_first_seen.get(chunk_handle, 0)
+        failed = self.failed_replicas.get(chunk_handle, {})
+        fresh, stale = [], []
+        for port in replicas:
+            report = self.chunk_reports.get(port)
+            if port in failed:
+                stale.append(port)
+            elif report is None:
+                fresh.append(port)
+            elif chunk_handle in report:
+                (stale if chunk_handle in self.stale_reports.get(port, ()) else fresh).append(port)
+            elif latest > 0 and written_at < self.reported_at.get(port, 0):
+                stale.append(port)
+            else:
+                fresh.append(port)
+        return fresh, stale
+
+    def describe_chunks(self, file_id, for_write=False):
+        """
+        Returns the file's chunks in sequence order with their current primary and its lease expiry.
+        Only a lookup for a mutation (for_write) grants leases, and so bumps chunk versions:
+        a read just reports the lease already held, so ETags and chunkserver caches survive it.
+        """
+        with self.cache.lock:
+            entries = sorted(self.cache.chunks.get(file_id, {}).items())
+        chunks = []
+        for sequence, entry in entries:
+            handle = entry['handle']
+            replicas, stale = self.split_stale(handle, entry['replicas'])
+
+            # If I am a ready leader, ensure active lease (only an up-to-date replica may hold it).
+            # A follower (or a leader not yet caught up) only knows the mapping's primary:
+            # readers try it first, so it must not be a replica known to be stale
+            current_primary, lease_expires = entry['primary'], None
+            if current_primary not in replicas:
+                current_primary = replicas[0] if replicas else None
+            if self.is_leader():
+                if for_write:
+                    current_primary = self.grant_lease(handle, replicas, stale)
+                    replicas, stale = self.split_stale(handle, entry['replicas'])
+                lease = self.current_lease(handle, replicas)
+                if lease:
+                    current_primary, lease_expires = lease['primary'], lease['expires']
+
+            chunks.append({
+                "handle": handle,
+                "sequence": sequence,
+                "version": self.known_version(handle),
+                "primary": current_primary,
+                "replicas": replicas,
+                "stale_replicas": stale,
+                "lease_expires": lease_expires  # Only the leader knows; clients cache writes until then
+            })
+        return chunks
+
+    # --- Follower Reads ---
+    def read_staleness(self):
+        """Seconds our metadata may lag the leader: 0 on the leader, None if never caught up."""
+        if self.leader_id == self.port:
+            return 0.0
+        if self.caught_up_at is None:
+            return None
+        return time.time() - self.caught_up_at
+
+    def read_guard(self):
+        """
+        BOUNDED-STALENESS READS:
+        Followers serve lookups and listings from their replicated cache while they
+        were caught up with the leader within `max_staleness` seconds (request param,
+        default READ_STALENESS_BOUND). Otherwise they answer 307 to the leader.
+        Returns None to serve locally, else the redirect response.
+        """
+        params = request.get_json(silent=True) or {}
+        bound = float(request.args.get('max_staleness', params.get('max_staleness', READ_STALENESS_BOUND)))
+        staleness = self.read_staleness()
+        if staleness is not None and staleness <= bound:
+            return None
+        if self.leader_id is None:
+            return jsonify({"error": "No leader; follower too stale to serve"}), 503
+        response = jsonify({"error": "Follower too stale", "leader": self.leader_id, "staleness": staleness})
+        response.status_code = 307
+        response.headers['Location'] = f"http://localhost:{self.leader_id}{request.full_path.rstrip('?')}"
+        return response
+
+    def check_access(self, file_id, user_id):
+        """Returns (file, None) if user may access the file, else (None, error_response)."""
+        file = self.cache.files.get(file_id)
+        if not file: return None, (jsonify({"error": "Not found"}), 404)
+        if self.access_level(file_id, user_id) is None:
+            return None, (jsonify({"error": "Permission Denied"}), 403)
+        return dict(file), None
+
+    def access_level(self, file_id, user_id):
+        """'OWNER', the approved access type, or None; served from the ACL cache when possible."""
+        key = (file_id, user_id)
+        found, access, generation = self.acl_cache.get(key)
+        if found:
+            return access
+        with self.cache.lock:
+            file = self.cache.files.get(file_id)
+            if not file:
+                return None  # Not cached: the file may be created yet
+            # Owner, or ANY approved permission (handles duplicate requests)
+            access = "OWNER" if file['owner_id'] == user_id else self.cache.approved_access(file_id, user_id)
+        self.acl_cache.put(key, access, generation)
+        return access
 
-    def declare_victory(self):
-        print(f"[Node-{self.port}] I am the LEADER!")
+    # --- Bully Election Algorithm ---
+    def start_election(self):
+        """
+        Concurrent, time-bounded Bully round: every higher node is asked at once and
+        given ELECTION_TIMEOUT to answer. If none answers we lead. If one does, we wait
+        COORDINATOR_WAIT for its victory (or adopt the live leader it names), then retry.
+        FAULT TOLERANCE: before winning, we poll every peer's log position and need a
+        majority of masters (us included) to answer; if one is fresher than us we pull
+        its log (or checkpoint) first. A restarted or emptied master therefore never
+        leads with a log behind the entries a majority acknowledged.
+        """
+        if not self.election_lock.acquire(blocking=False):
+            return  # A round is already running on this node
+        try:
+            self.election_in_progress = True
+            while self.leader_id is None:
+                print(f"[Node-{self.port}] Starting Election...")
+                self.coordinator_event.clear()
+                higher_nodes = [p for p in self.peers if p > self.port]
+                replies = [r for r in self.election_pool.map(self.send_election, higher_nodes) if r]
+                if not replies:
+                    states = self.peer_states()
+                    if 2 * (len(states) + 1) <= len(self.peers) + 1:
+                        print(f"[Node-{self.port}] No majority reachable; not taking over")
+                    elif not self.catch_up_with(states):
+                        print(f"[Node-{self.port}] Could not catch up with the freshest peer; not taking over")
+                    else:
+                        self.declare_victory(states)
+                        break
+                    if self.coordinator_event.wait(COORDINATOR_WAIT):
+                        break
+                    continue
+                known = [r['leader'] for r in replies if r.get('leader')]
+                if known:
+                    self.follow(max(known))  # A higher node still holds a valid leader lease
+                    break
+                if self.coordinator_event.wait(COORDINATOR_WAIT):
+                    break
+        finally:
+            self.election_in_progress = False
+            self.election_lock.release()
+
+    def send_election(self, peer):
+        try:
+            with metrics.rpc("election", peer):
+                r = requests.post(f"http://localhost:{peer}/election/msg",
+                                  json={"type": "ELECTION", "sender": self.port}, timeout=ELECTION_TIMEOUT)
+            return r.json()
+        except:
+            return None
+
+    def declare_victory(self, states):
+        """
+        FAULT TOLERANCE:
+        Takes a term above every peer's in `states` (polled by the election), announces
+        it, then holds writes back (leader_ready) until our log holds every entry a peer
+        has. The election already pulled the bulk; this picks up what the old leader
+        took since, which it has stopped doing once it saw our announcement.
+        """
+        self.set_term(max([self.term] + [s['term'] for s in states]) + 1)
+        print(f"[Node-{self.port}] I am the LEADER! (term {self.term})")
+        self.leader_ready = False
         self.leader_id = self.port
         self.election_in_progress = False
+        self.record_failover()
         
         # Start Clock Sync thread
         if not any(t.name == 'ClockSync' for t in threading.enumerate()):
             t = threading.Thread(target=self.sync_clocks, name='ClockSync', daemon=True)
             t.start()
+        # The first heartbeat round doubles as the COORDINATOR announcement
+        self.send_leader_heartbeats("COORDINATOR")
+
+        if not self.catch_up_with(self.peer_states()):
+            print(f"[Node-{self.port}] Could not catch up with the freshest peer; stepping down")
+            self.step_down(self.term)
+            return
+        self.leader_ready = True
+        with self.log_cond:
+            self.log_cond.notify_all()  # Start the replication senders
 
-        for p in self.peers:
+    def peer_states(self):
+        """Log positions of the reachable peers: [{'port', 'term', 'last_term', 'last_applied'}]."""
+        def poll(peer):
             try:
-                requests.post(f"http://localhost:{p}/election/msg", 
-                              json={"type": "COORDINATOR", "sender": self.port}, 
-                              timeout=0.5)
+                with metrics.rpc("election", peer):
+                    h = requests.get(f"http://localhost:{peer}/health", timeout=ELECTION_TIMEOUT).json()
+                return {"port": peer, "term": h.get("term", 0), "last_term": h.get("last_term", 0),
+                        "last_applied": h.get("last_applied", 0)}
             except:
-                pass
+                return None
+        return [s for s in self.election_pool.map(poll, self.peers) if s]
+
+    def catch_up_with(self, states):
+        """
+        Pulls from the peer with the freshest log (highest last term, then index) until we
+        hold everything it did when polled. Returns False if that failed.
+        """
+        ahead = [s for s in states if (s['last_term'], s['last_applied']) > (self.last_term, self.last_applied)]
+        if not ahead:
+            return True
+        freshest = max(ahead, key=lambda s: (s['last_term'], s['last_applied']))
+        print(f"[Node-{self.port}] Catching up from {freshest['port']} (index {freshest['last_applied']})")
+        with self.catch_up_lock:
+            self.replay_from(freshest['port'])
+        return (self.last_term, self.last_applied) >= (freshest['last_term'], freshest['last_applied'])
+
+    def step_down(self, term):
+        """A peer knows a newer term (or we could not catch up): stop leading, let an election sort it out."""
+        self.set_term(term)
+        if self.leader_id == self.port:
+            print(f"[Node-{self.port}] Stepping down (term {self.term})")
+            self.leader_ready = False
+            self.leader_lease_expires = 0
+            self.leader_id = None
+
+    def follow(self, leader):
+        """Adopts `leader` and starts its lease; catches up on its log if it is new to us."""
+        changed = self.leader_id != leader
+        last_heard = self.leader_lease_expires - LEADER_LEASE
+        if changed and self.leader_id not in (None, self.port) and self.leader_lost_at is None \
+                and time.time() - last_heard > 2 * LEADER_HEARTBEAT_INTERVAL:
+            self.leader_lost_at = last_heard  # The new leader reached us before we noticed the old one died
+        self.leader_id = leader
+        self.leader_lease_expires = time.time() + LEADER_LEASE
+        self.coordinator_event.set()
+        if changed:
+            print(f"[Node-{self.port}] Acknowledged Leader: {leader}")
+            self.record_failover()
+            threading.Thread(target=self.catch_up, daemon=True).start()
+
+    def record_failover(self):
+        """Failover time: from the last heartbeat of the previous leader to a new one being known."""
+        if self.leader_lost_at is None:
+            return
+        elapsed = time.time() - self.leader_lost_at
+        self.leader_lost_at = None
+        self.failovers.append({"at": time.time(), "seconds": round(elapsed, 3), "leader": self.leader_id})
+        del self.failovers[:-FAILOVER_HISTORY]
+        print(f"[Node-{self.port}] Failover completed in {elapsed:.3f}s")
+
+    # --- Leader Lease ---
+    def send_leader_heartbeats(self, msg_type="HEARTBEAT"):
+        """
+        Pushes one heartbeat to every peer at once. The leader's own lease runs from
+        when the round started and is only renewed if a majority of masters (us
+        included) acknowledge, so it always ends before any follower's lease does.
+        """
+        started = time.time()
+        def push(peer):
+            try:
+                with metrics.rpc("leader_heartbeat", peer):
+                    r = self.heartbeat_session.post(f"http://localhost:{peer}/election/msg",
+                                                    json={"type": msg_type, "sender": self.port, "term": self.term},
+                                                    timeout=LEADER_HEARTBEAT_INTERVAL * 2)
+                if r.status_code == 409 and r.json().get('term', 0) > self.term:
+                    self.step_down(r.json()['term'])  # Deposed while we were away
+                return r.ok
+            except:
+                return False
+        acks = 1 + sum(self.election_pool.map(push, self.peers))
+        if acks * 2 > len(self.peers) + 1:
+            self.leader_lease_expires = started + LEADER_LEASE
+
+    def leader_heartbeat_loop(self):
+        while True:
+            time.sleep(LEADER_HEARTBEAT_INTERVAL)
+            if self.leader_id == self.port:
+                self.send_leader_heartbeats()
+
+    def is_leader(self):
+        """Leader with a valid lease and a caught-up log: only then may it change metadata."""
+        return self.leader_id == self.port and self.leader_ready and time.time() < self.leader_lease_expires
 
     def monitor_leader(self):
-        """Daemon thread to check if the leader is alive."""
+        """Daemon thread: a follower that hears no leader heartbeat for LEADER_LEASE starts an election."""
         while True:
-            time.sleep(3)
+            time.sleep(LEADER_HEARTBEAT_INTERVAL)
             if self.leader_id == self.port:
                 continue
 
@@ -217,24 +1640,61 @@ class MasterNode:
                 self.start_election()
                 continue
 
-            try:
-                requests.get(f"http://localhost:{self.leader_id}/health", timeout=1)
-            except:
+            if time.time() > self.leader_lease_expires:
                 print(f"[Node-{self.port}] Leader {self.leader_id} is dead.")
+                self.leader_lost_at = self.leader_lease_expires - LEADER_LEASE
                 self.leader_id = None
                 self.start_election()
 
+    # --- Metrics ---
+    def register_gauges(self):
+        """Point-in-time values read on every /metrics scrape."""
+        metrics.gauge("gfs_is_leader", "1 while this master holds a valid leader lease",
+                      lambda: int(self.is_leader()))
+        metrics.gauge("gfs_leases_active", "Chunk leases currently granted", lambda: len(self.leases))
+        metrics.gauge("gfs_leases_held", "Chunk leases held, by primary chunkserver",
+                      lambda: {(("chunkserver", str(p)),): n for p, n in self.lease_counts.items()})
+        metrics.gauge("gfs_live_chunkservers", "Chunkservers heard from recently", lambda: len(self.live_chunkservers()))
+        metrics.gauge("gfs_replication_last_applied", "Highest metadata log index applied here", lambda: self.last_applied)
+        metrics.gauge("gfs_replication_staleness_seconds", "How far this master's metadata may lag the leader (NaN: never caught up)",
+                      lambda: self.read_staleness() if self.read_staleness() is not None else float("nan"))
+        metrics.gauge("gfs_checkpoint_index", "Log index covered by our newest checkpoint", lambda: self.checkpoint["index"])
+        metrics.gauge("gfs_replication_log_floor", "Log entries up to this index were dropped after a checkpoint",
+                      lambda: self.log_floor)
+        metrics.gauge("gfs_acl_cache_entries", "Cached (file, user) access decisions", lambda: len(self.acl_cache.entries))
+        metrics.gauge("gfs_acl_cache_hits", "ACL checks answered from the decision cache", lambda: self.acl_cache.hits)
+        metrics.gauge("gfs_acl_cache_misses", "ACL checks that read the permission index", lambda: self.acl_cache.misses)
+        metrics.gauge("gfs_rereplication_queued", "Chunks waiting for re-replication", lambda: self.repair_queue.qsize())
+        metrics.gauge("gfs_threads", "Live Python threads", threading.active_count)
+        metrics.gauge("gfs_requests_received", "Requests received since start", lambda: self.request_count)
+
     # --- API Routes ---
     def setup_routes(self):
         @self.app.before_request
         def count_requests():
-            self.request_count += 1
+            with self.counter_lock:
+                self.request_count += 1
+
+        @self.app.after_request
+        def staleness_header(response):
+            staleness = self.read_staleness()
+            if staleness is not None:
+                response.headers['X-GFS-Staleness'] = f"{staleness:.3f}"
+            return response
 
         @self.app.route('/health', methods=['GET'])
         def health():
+            # Routing hint: clients may spread reads over every master whose staleness fits their bound
+            staleness = self.read_staleness()
             return jsonify({
                 "status": "alive", 
-                "role": "leader" if self.leader_id == self.port else "follower"
+                "role": "leader" if self.is_leader() else "follower",
+                "leader_id": self.leader_id,
+                "term": self.term,
+                "last_term": self.last_term,
+                "last_applied": self.last_applied,
+                "staleness": None if staleness is None else round(staleness, 3),
+                "serves_reads": staleness is not None and staleness <= READ_STALENESS_BOUND
             })
 
         @self.app.route('/election/msg', methods=['POST'])
@@ -244,15 +1704,28 @@ class MasterNode:
             sender = data.get("sender")
 
             if msg_type == "ELECTION":
+                # A leader that is still heartbeating stays: tell the sender who it is
+                if self.is_leader():
+                    return jsonify({"status": "OK", "leader": self.port})
+                if self.leader_id is not None and time.time() < self.leader_lease_expires:
+                    return jsonify({"status": "OK", "leader": self.leader_id})
                 # If I am higher or same, I should take over, but Bully says send OK and hold election
                 if not self.election_in_progress and self.leader_id != self.port:
                      threading.Thread(target=self.start_election).start()
                 return jsonify({"status": "OK"})
             
-            elif msg_type == "COORDINATOR":
-                self.leader_id = sender
+            elif msg_type in ("COORDINATOR", "HEARTBEAT"):
+                if sender < self.port:
+                    # Bully: a lower node must not lead while we are up
+                    if self.leader_id != self.port and not self.election_in_progress:
+                        self.leader_id = None
+                        threading.Thread(target=self.start_election, daemon=True).start()
+                    return jsonify({"status": "Rejected", "term": self.term}), 409
+                if data.get("term", 0) < self.term:
+                    return jsonify({"status": "Rejected", "term": self.term}), 409  # A deposed leader
+                self.set_term(data.get("term", 0))
                 self.election_in_progress = False
-                print(f"[Node-{self.port}] Acknowledged Leader: {sender}")
+                self.follow(sender)
                 return jsonify({"status": "Ack"})
             
             return jsonify({}), 400
@@ -261,7 +1734,16 @@ class MasterNode:
         def heartbeat():
             data = request.json
             self.active_chunkservers[data.get('port')] = time.time()
-            return jsonify({"status": "ok"})
+            for f in data.get('replica_failures', []):
+                self.record_replica_failure(f['handle'], f['port'], f.get('version', 0))
+            if 'chunk_versions' in data:
+                self.record_chunk_report(data['port'], data['chunk_versions'])
+            if 'stats' in data:
+                self.record_stats(data['port'], data['stats'])
+            extended = {}
+            if data.get('lease_extensions') and self.leader_id == self.port:
+                extended = self.extend_leases(data['port'], data['lease_extensions'])
+            return jsonify({"status": "ok", "leases": extended})
         
         @self.app.route('/system/status', methods=['GET'])
         def system_status():
@@ -270,39 +1752,113 @@ class MasterNode:
                 "leader_id": self.leader_id,
                 "is_leader": self.leader_id == self.port,
                 "active_chunkservers": list(self.active_chunkservers.keys()),
+                "live_chunkservers": self.live_chunkservers(),
                 # --- NEW METRICS ---
                 "algo_status": {
                     "election_state": "VOTING" if self.election_in_progress else "IDLE",
+                    "leader_lease_remaining": round(max(0.0, self.leader_lease_expires - time.time()), 3),
+                    "failovers": self.failovers,
                     "active_threads": threading.active_count(),
                     "total_requests": self.request_count,
+                    "serving": serving.stats(),
+                    "profiler_running": metrics.profiler.running,
                     "clock_sync_role": "DAEMON" if self.leader_id == self.port else "CLIENT"
+                },
+                "routes": metrics.registry.route_summary(),
+                "metadata_cache": self.cache.footprint(),
+                "acl_cache": self.acl_cache.stats(),
+                "failed_replicas": {h: sorted(p) for h, p in self.failed_replicas.items()},
+                "leases": self.lease_stats(),
+                "clock_sync": self.clock_sync,
+                "rereplication": {"queued": self.repair_queue.qsize(),
+                                  "in_progress": len(self.repair_queued) - self.repair_queue.qsize(),
+                                  **self.repair_stats},
+                "placement": {
+                    "chunkserver_stats": dict(self.chunkserver_stats),
+                    "scores": {p: round(s, 3) for p, s in self.placement_scores(self.live_chunkservers()).items()},
+                    "overloaded": [p for p, t in self.overloaded_until.items() if t > time.time()],
+                    "rebalance_moves": self.rebalance_moves
+                },
+                "replication": {
+                    "term": self.term,
+                    "last_term": self.last_term,
+                    "leader_ready": self.leader_ready,
+                    "last_applied": self.last_applied,
+                    "leader_index": self.last_applied if self.leader_id == self.port else self.leader_index,
+                    "staleness": self.read_staleness(),
+                    "peer_match_index": dict(self.peer_match_index),
+                    "log_floor": self.log_floor,
+                    "checkpoint": self.checkpoint
                 }
             })
 
         @self.app.route('/system/replicate', methods=['POST'])
         def replicate():
-            """Used by followers to apply DB updates from Leader."""
+            """Used by followers to apply a batch of log entries from Leader. Acks by index and term."""
             data = request.json
+            if data.get('term', 0) < self.term:
+                return jsonify({"error": "Stale leader term", "term": self.term, "applied_index": self.last_applied}), 409
+            self.set_term(data.get('term', 0))
             try:
-                self.run_query(data['query'], data['params'], commit=True)
-                return jsonify({"status": "synced"})
+                # Diverged: we hold entries the leader lacks (it saw us past its log's end) or disagree on a term
+                reset = data.get('reset') == [self.last_applied, self.last_term]
+                applied, conflict = self.apply_entries(data.get('entries', []), data.get('prev_index'), data.get('prev_term'))
+                self.leader_index = data.get('leader_index', applied)
+                reset = reset or conflict
+                if reset:
+                    self.caught_up_at = None  # Stop serving reads until we hold the leader's history
+                if reset or applied < data.get('log_floor', 0):
+                    threading.Thread(target=self.catch_up, args=(reset,), daemon=True).start()  # Needs the checkpoint
+                elif applied >= self.leader_index:
+                    self.caught_up_at = time.time()
+                return jsonify({"status": "synced", "applied_index": applied, "last_term": self.last_term})
             except:
-                return jsonify({"error": "Replication failed"}), 500
+                return jsonify({"error": "Replication failed", "applied_index": self.last_applied,
+                                "last_term": self.last_term}), 500
+
+        @self.app.route('/system/log', methods=['GET'])
+        def replication_log():
+            """Catch-up: returns log entries after a follower's last applied index."""
+            after = request.args.get('after', 0, type=int)
+            term = request.args.get('term', type=int)
+            if self.leader_id == self.port and not self.leader_ready:
+                return jsonify({"error": "Leader catching up"}), 503  # Our log may still lack the puller's entries
+            if term is not None and (after > self.last_applied or self.term_at(after) not in (None, term)):
+                # The puller's last entry is not ours: its log diverged, it must reset from our checkpoint
+                return jsonify({"entries": [], "last_index": self.last_applied, "conflict": True})
+            if after < self.log_floor:
+                # Those entries were folded into a checkpoint: fetch /system/checkpoint first
+                return jsonify({"entries": [], "last_index": self.last_applied, "truncated": True,
+                                "checkpoint_index": self.checkpoint["index"]})
+            return jsonify({"entries": self.read_log(after), "last_index": self.last_applied})
+
+        @self.app.route('/system/checkpoint', methods=['GET'])
+        def get_checkpoint():
+            """Bootstrap: our latest checkpoint (zlib-compressed JSON). Replay the log after X-Checkpoint-Index."""
+            with self.checkpoint_lock:
+                exists = os.path.exists(self.checkpoint_path)
+            if not exists:
+                self.take_checkpoint()
+            with self.checkpoint_lock:
+                with open(self.checkpoint_path, "rb") as f:
+                    payload = f.read()
+                index = self.checkpoint["index"]
+            return Response(payload, content_type="application/octet-stream",
+                            headers={"X-Checkpoint-Index": str(index)})
 
         # --- AUTHENTICATION ---
         @self.app.route('/auth/register', methods=['POST'])
         def register():
-            if self.leader_id != self.port: return jsonify({"error": "Not Leader"}), 400
+            if not self.is_leader(): return jsonify({"error": "Not Leader"}), 400
             data = request.json
             user_id = str(uuid.uuid4())
             pwd_hash = hashlib.sha256(data['password'].encode()).hexdigest()
             
-            q = "INSERT INTO users (user_id, username, password_hash) VALUES (?, ?, ?)"
+            q = SQL_INSERT_USER
             p = (user_id, data['username'], pwd_hash)
             
             try:
-                self.run_query(q, p, commit=True)
-                self.replicate_to_peers(q, p)
+                self.apply_write(q, p)
                 return jsonify({"user_id": user_id, "username": data['username']})
             except:
                 return jsonify({"error": "Username exists"}), 400
@@ -311,21 +1867,21 @@ class MasterNode:
         def login():
             data = request.json
             pwd_hash = hashlib.sha256(data['password'].encode()).hexdigest()
-            rows = self.run_query("SELECT user_id, username FROM users WHERE username=? AND password_hash=?", 
-                                  (data['username'], pwd_hash))
-            if rows:
-                return jsonify({"user_id": rows[0][0], "username": rows[0][1]})
+            with self.cache.lock:
+                matches = [uid for uid, h in self.cache.logins.get(data['username'], []) if h == pwd_hash]
+            if matches:
+                return jsonify({"user_id": matches[0], "username": data['username']})
             return jsonify({"error": "Invalid credentials"}), 401
 
         # --- FILE & GFS LOGIC ---
         @self.app.route('/file/create', methods=['POST'])
         def create_file():
-            if self.leader_id != self.port: return jsonify({"error": "Not Leader"}), 400
+            if not self.is_leader(): return jsonify({"error": "Not Leader"}), 400
             data = request.json
             filename = data.get('filename')
             owner_id = data.get('user_id')
-            file_id = f"file_{int(time.time())}"
-            chunk_handle = f"chunk_{file_id}_0"
+            size = int(data.get('size', 0))
+            file_id = f"file_{int(time.time())}_{uuid.uuid4().hex[:8]}"  # Unique even for creates in the same second
             
             # Warm-up
             retries = 8 
@@ -333,138 +1889,150 @@ class MasterNode:
                 time.sleep(0.5)
                 retries -= 1
 
-            now = time.time()
-            live_nodes = [p for p, t in self.active_chunkservers.items() if now - t < 10]
-            
-            if not live_nodes: 
+            if not self.live_chunkservers(): 
                 return jsonify({"error": "No Chunkservers Available"}), 503
 
-            replicas = live_nodes[:3]
-            primary = self.grant_lease(chunk_handle, replicas)
-
             # 1. Metadata
-            q1 = "INSERT INTO files (file_id, filename, size, owner_id) VALUES (?, ?, ?, ?)"
-            p1 = (file_id, filename, 0, owner_id)
-            self.run_query(q1, p1, commit=True)
-            self.replicate_to_peers(q1, p1)
+            q1 = SQL_INSERT_FILE
+            p1 = (file_id, filename, size, owner_id)
+            self.apply_write(q1, p1)
 
-            # 2. Chunk Mapping
-            q2 = "INSERT INTO chunk_mapping VALUES (?, ?, ?, ?, ?)"
-            p2 = (chunk_handle, file_id, 0, primary, ",".join(map(str, replicas)))
-            self.run_query(q2, p2, commit=True)
-            self.replicate_to_peers(q2, p2)
+            # 2. Chunk Mapping (one chunk per CHUNK_SIZE characters, at least one)
+            num_chunks = max(1, -(-size // CHUNK_SIZE))
+            if not self.allocate_chunks(file_id, num_chunks):
+                return jsonify({"error": "No Chunkservers Available"}), 503
 
+            chunks = self.describe_chunks(file_id, for_write=True)
             return jsonify({
                 "file_id": file_id, 
-                "chunk_handle": chunk_handle, 
-                "replicas": replicas, 
-                "primary": primary
+                "chunk_handle": chunks[0]["handle"], 
+                "replicas": chunks[0]["replicas"], 
+                "primary": chunks[0]["primary"],
+                "chunks": chunks,
+                "chunk_size": CHUNK_SIZE
             })
 
         @self.app.route('/file/lookup/<file_id>', methods=['POST'])
         def lookup_file(file_id):
+            stale = self.read_guard()
+            if stale: return stale
             data = request.json
             user_id = data.get('user_id')
             
-            # 1. Verify Existence
-            file_row = self.run_query("SELECT owner_id FROM files WHERE file_id=?", (file_id,))
-            if not file_row: return jsonify({"error": "Not found"}), 404
-            owner = file_row[0][0]
-
-            # 2. ACL Check - FIXED
-            if owner != user_id:
-                # Check for ANY approved permission (handles duplicate requests)
-                perm = self.run_query(
-                    "SELECT status FROM permissions WHERE file_id=? AND user_id=? AND status='APPROVED' LIMIT 1", 
-                    (file_id, user_id)
-                )
-                if not perm:
-                    return jsonify({"error": "Permission Denied"}), 403
+            # 1. Verify Existence + ACL Check (every lookup: a revoked grant is refused at once).
+            # access_expires lets the caller reuse this lookup for reads until then.
+            file = self.cache.files.get(file_id)
+            if not file: return jsonify({"error": "Not found"}), 404
+            access = self.access_level(file_id, user_id)
+            if access is None: return jsonify({"error": "Permission Denied"}), 403
+            file = dict(file)
             
-            # 3. Retrieve Locations
-            rows = self.run_query("SELECT chunk_handle, primary_loc, locations FROM chunk_mapping WHERE file_id=?", (file_id,))
-            chunks = []
-            for r in rows:
-                handle, db_primary, locs_str = r
-                replicas = [int(x) for x in locs_str.split(",")]
-                
-                # If I am leader, ensure active lease
-                current_primary = db_primary
-                if self.leader_id == self.port:
-                    current_primary = self.grant_lease(handle, replicas)
-
-                chunks.append({
-                    "handle": handle,
-                    "primary": current_primary,
-                    "replicas": replicas
-                })
-
-            return jsonify({"chunks": chunks})
+            # 2. Retrieve Locations. Only the leader knows current leases: writers must
+            # use an authoritative lookup (for_write, which grants them), readers can use any master's.
+            return jsonify({
+                "chunks": self.describe_chunks(file_id, for_write=bool(data.get('for_write'))),
+                "size": file['size'],
+                "chunk_size": CHUNK_SIZE,
+                "authoritative": self.is_leader(),
+                "access": access,
+                "access_expires": round(time.time() + ACCESS_TTL, 3)
+            })
+
+        @self.app.route('/file/allocate/<file_id>', methods=['POST'])
+        def allocate_file_chunks(file_id):
+            """
+            Grows a file: allocates chunks on demand so `size` characters fit, and records
+            `size` as the file's size, smaller than before after a truncating rewrite.
+            RECORD APPEND: `chunk_count` asks for at least that many chunks, which is how
+            appenders roll over once the last chunk reports chunk_full. `min_size` records
+            an append's end without ever shrinking the file, so racing appenders agree.
+            """
+            if not self.is_leader(): return jsonify({"error": "Not Leader"}), 400
+            data = request.json
+
+            file, error = self.check_access(file_id, data.get('user_id'))
+            if error: return error
+
+            size = int(data.get('size', file['size']))
+            if 'min_size' in data:
+                size = max(size, int(data['min_size']))
+            count = max(1, -(-size // CHUNK_SIZE), int(data.get('chunk_count', 0)))
+            if not self.allocate_chunks(file_id, count):
+                return jsonify({"error": "No Chunkservers Available"}), 503
+
+            if size != file['size']:
+                q = SQL_UPDATE_FILE_SIZE
+                p = (size, file_id)
+                self.apply_write(q, p)
+
+            return jsonify({
+                "chunks": self.describe_chunks(file_id, for_write=True),
+                "size": size,
+                "chunk_size": CHUNK_SIZE
+            })
 
         @self.app.route('/file/list/<user_id>', methods=['GET'])
         def list_files(user_id):
-            # Owned files
-            owned = self.run_query("SELECT file_id, filename, owner_id FROM files WHERE owner_id=?", (user_id,))
-            # Shared files
-            shared = self.run_query('''
-                SELECT DISTINCT f.file_id, f.filename, f.owner_id 
-                FROM files f 
-                JOIN permissions p ON f.file_id = p.file_id 
-                WHERE p.user_id=? AND p.status='APPROVED'
-            ''', (user_id,))
-            
+            stale = self.read_guard()
+            if stale: return stale
+            files = self.cache.files
             res = []
-            for r in owned: res.append({"id": r[0], "name": r[1], "owner": "Me", "access": "OWNER"})
-            for r in shared: res.append({"id": r[0], "name": r[1], "owner": r[2], "access": "SHARED"})
+            with self.cache.lock:
+                # Owned files
+                for fid in self.cache.owned.get(user_id, []):
+                    res.append({"id": fid, "name": files[fid]['filename'], "owner": "Me", "access": "OWNER"})
+                # Shared files
+                for fid in self.cache.approved.get(user_id, []):
+                    if fid in files:
+                        res.append({"id": fid, "name": files[fid]['filename'], "owner": files[fid]['owner_id'], "access": "SHARED"})
             return jsonify({"files": res})
 
         # --- PERMISSIONS ---
         @self.app.route('/access/request', methods=['POST'])
         def request_access():
-            if self.leader_id != self.port: return jsonify({"error": "Not Leader"}), 400
+            if not self.is_leader(): return jsonify({"error": "Not Leader"}), 400
             data = request.json
             req_id = str(uuid.uuid4())
             
             # Check file exists
-            f = self.run_query("SELECT owner_id FROM files WHERE file_id=?", (data['file_id'],))
-            if not f: return jsonify({"error": "File not found"}), 404
+            if data['file_id'] not in self.cache.files: return jsonify({"error": "File not found"}), 404
             
             # Check for existing pending/approved requests to prevent duplicates
-            existing = self.run_query("SELECT req_id FROM permissions WHERE file_id=? AND user_id=?", 
-                                      (data['file_id'], data['user_id']))
-            if existing:
+            if self.cache.requests.get((data['file_id'], data['user_id'])):
                 return jsonify({"error": "Request already exists"}), 200 # Return 200 to satisfy frontend toast
 
-            q = "INSERT INTO permissions VALUES (?, ?, ?, ?, 'PENDING')"
+            q = SQL_INSERT_PERMISSION
             p = (req_id, data['file_id'], data['user_id'], data['access_type'])
             try:
-                self.run_query(q, p, commit=True)
-                self.replicate_to_peers(q, p)
+                self.apply_write(q, p)
                 return jsonify({"status": "requested"})
             except:
                 return jsonify({"error": "Request failed"}), 400
 
         @self.app.route('/access/pending/<user_id>', methods=['GET'])
         def get_pending_requests(user_id):
-            rows = self.run_query('''
-                SELECT p.req_id, p.file_id, f.filename, p.user_id, u.username, p.access_type
-                FROM permissions p
-                JOIN files f ON p.file_id = f.file_id
-                JOIN users u ON p.user_id = u.user_id
-                WHERE f.owner_id=? AND p.status='PENDING'
-            ''', (user_id,))
-            
-            return jsonify([{"req_id": r[0], "file_id": r[1], "filename": r[2], 
-                             "requestor_id": r[3], "requestor_name": r[4], "type": r[5]} for r in rows])
+            stale = self.read_guard()
+            if stale: return stale
+            cache = self.cache
+            res = []
+            with cache.lock:
+                for fid in cache.owned.get(user_id, []):
+                    for req_id in cache.pending.get(fid, []):
+                        perm = cache.permissions[req_id]
+                        if perm['user_id'] not in cache.users:
+                            continue
+                        res.append({"req_id": req_id, "file_id": fid, "filename": cache.files[fid]['filename'],
+                                    "requestor_id": perm['user_id'], "requestor_name": cache.users[perm['user_id']],
+                                    "type": perm['access_type']})
+            return jsonify(res)
 
         @self.app.route('/access/approve', methods=['POST'])
         def approve_access():
-            if self.leader_id != self.port: return jsonify({"error": "Not Leader"}), 400
+            if not self.is_leader(): return jsonify({"error": "Not Leader"}), 400
             data = request.json
-            q = "UPDATE permissions SET status=? WHERE req_id=?"
+            q = SQL_UPDATE_PERMISSION
             p = (data['action'], data['req_id'])
-            self.run_query(q, p, commit=True)
-            self.replicate_to_peers(q, p)
+            self.apply_write(q, p)
             return jsonify({"status": "updated"})
 
         # --- ADMIN / FAULT INJECTION ---
@@ -479,8 +2047,18 @@ class MasterNode:
 
     def run(self):
         threading.Thread(target=self.monitor_leader, daemon=True).start()
+        threading.Thread(target=self.leader_heartbeat_loop, name='LeaderHeartbeat', daemon=True).start()
+        threading.Thread(target=self.rebalance_loop, name='Rebalancer', daemon=True).start()
+        threading.Thread(target=self.checkpoint_loop, name='Checkpoint', daemon=True).start()
+        threading.Thread(target=self.rereplication_scan_loop, name='ReReplicationScan', daemon=True).start()
+        for i in range(REREPLICATION_WORKERS):
+            threading.Thread(target=self.rereplication_worker, name=f'ReReplication-{i}', daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.replication_sender, args=(peer,), name=f'Replicator-{peer}', daemon=True).start()
         print(f"[Node-{self.port}] Master Node running (DB: {self.db_name})")
-        self.app.run(port=self.port, debug=False)
+        # Liveness and control traffic bypasses admission control: a rejected heartbeat
+        # or election message would look like a dead node
+        serving.serve(self.app, self.port, exempt=("/heartbeat", "/health", "/election/", "/system/", "/metrics", "/debug/"))
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
@@ -0,0 +1,314 @@
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import request, g, jsonify, Response
+
+# --- Configuration ---
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds
+PROFILE_INTERVAL = 0.005   # Default seconds between profiler samples
+PROFILE_MAX_DEPTH = 64     # Frames kept per sampled stack
+PROFILE_TOP = 200          # Stacks returned by GET /debug/profile
+
+HELP = {
+    "gfs_http_requests_total": ("counter", "HTTP requests handled, by route, method and status"),
+    "gfs_http_request_errors_total": ("counter", "HTTP requests that failed with a 5xx status"),
+    "gfs_http_request_duration_seconds": ("histogram", "Time to produce an HTTP response, by route"),
+    "gfs_sqlite_query_duration_seconds": ("histogram", "SQLite statement time including commit, by statement"),
+    "gfs_rpc_duration_seconds": ("histogram", "Outbound RPC time, by kind and peer"),
+    "gfs_rpc_errors_total": ("counter", "Outbound RPCs that failed to get a response"),
+    "gfs_store_duration_seconds": ("histogram", "Chunk store operation time, by operation"),
+}
+
+
+class Registry:
+    """
+    Thread-safe counters and fixed-bucket histograms, plus gauges read at scrape time.
+    Rendered as Prometheus text by /metrics and summarized as JSON for the status pages.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [per-bucket counts..., +Inf count, sum]}
+        self.gauges = {}      # {name: (help, fn)}; fn returns a number or {labels: number}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(LATENCY_BUCKETS)] += 1
+            hist[-1] += seconds
+
+    def gauge(self, name, help_text, fn):
+        self.gauges[name] = (help_text, fn)
+
+    @contextmanager
+    def timer(self, name, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines, described = [], set()
+
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, *HELP.get(name, ("counter", name)))
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), hist in sorted(histograms.items()):
+            describe(name, *HELP.get(name, ("histogram", name)))
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), hist[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {hist[-1]:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for name, (help_text, fn) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue  # A gauge whose subsystem is not up yet is left out of this scrape
+            describe(name, "gauge", help_text)
+            for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+                lines.append(f"{name}{format_labels(labels)} {v}")
+        return "\n".join(lines) + "\n"
+
+    def route_summary(self):
+        """{route: {'count', 'errors', 'mean_ms', 'p50_ms', 'p99_ms'}} for JSON status endpoints."""
+        with self.lock:
+            histograms = {k: list(v) for k, v in self.histograms.items() if k[0] == "gfs_http_request_duration_seconds"}
+            errors = {k[1]: v for k, v in self.counters.items() if k[0] == "gfs_http_request_errors_total"}
+        summary = {}
+        for (_, labels), hist in histograms.items():
+            count = sum(hist[:-1])
+            route = dict(labels)["route"]
+            summary[route] = {
+                "count": count,
+                "errors": errors.get(labels, 0),
+                "mean_ms": round(1000 * hist[-1] / count, 2) if count else None,
+                "p50_ms": bucket_quantile(hist, 0.5),
+                "p99_ms": bucket_quantile(hist, 0.99)
+            }
+        return summary
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def bucket_quantile(hist, q):
+    """Upper bound (ms) of the bucket holding the q-quantile; None past the largest bucket."""
+    count = sum(hist[:-1])
+    if not count:
+        return None
+    target, seen = q * count, 0
+    for bound, n in zip(LATENCY_BUCKETS, hist):
+        seen += n
+        if seen >= target:
+            return bound * 1000
+    return None
+
+
+# --- SQLite ---
+statement_labels = {}
+
+
+def statement_label(query):
+    """'INSERT INTO files ...' -> 'insert files'. Statements are constants, so labels are memoized."""
+    label = statement_labels.get(query)
+    if label is None:
+        words = query.replace("(", " ").split()
+        verb = words[0].lower() if words else "?"
+        upper = [w.upper() for w in words]
+        table = "?"
+        for keyword in ("INTO", "FROM", "UPDATE"):
+            if keyword in upper and upper.index(keyword) + 1 < len(words):
+                table = words[upper.index(keyword) + 1]
+                break
+        label = statement_labels[query] = f"{verb} {table}"
+    return label
+
+
+# --- Process Registry ---
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+gauge = registry.gauge
+
+
+def sql(query):
+    """Times a SQLite statement (through its commit) under its statement label."""
+    return registry.timer("gfs_sqlite_query_duration_seconds", (("statement", statement_label(query)),))
+
+
+def store(operation):
+    return registry.timer("gfs_store_duration_seconds", (("operation", operation),))
+
+
+@contextmanager
+def rpc(kind, peer):
+    """Times an outbound request to a peer; one that raises is also counted as an error."""
+    labels = (("kind", kind), ("peer", str(peer)))
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc("gfs_rpc_errors_total", labels)
+        raise
+    finally:
+        registry.observe("gfs_rpc_duration_seconds", labels, time.perf_counter() - started)
+
+
+# --- Sampling Profiler ---
+class SamplingProfiler:
+    """
+    Off by default. While on, a background thread snapshots the stacks of threads that
+    are serving a request every `interval` seconds and counts them in folded form
+    ("outer;...;inner count", what flame graph tools read). Nothing runs while off.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_requests = set()  # Thread idents inside a request
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = PROFILE_INTERVAL
+        self.all_threads = False
+        self.started_at = None
+        self.stop_event = None
+
+    @property
+    def running(self):
+        return self.stop_event is not None
+
+    def start(self, interval=PROFILE_INTERVAL, all_threads=False, reset=True):
+        with self.lock:
+            if self.running:
+                return
+            if reset:
+                self.stacks, self.samples = Counter(), 0
+            self.interval, self.all_threads = interval, all_threads
+            self.started_at = time.time()
+            self.stop_event = threading.Event()
+            threading.Thread(target=self.sample_loop, args=(self.stop_event,), name="Profiler", daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            if self.stop_event:
+                self.stop_event.set()
+            self.stop_event = None
+
+    def sample_loop(self, stop_event):
+        me = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                watched = None if self.all_threads else set(self.active_requests)
+                for ident, frame in frames.items():
+                    if ident == me or (watched is not None and ident not in watched):
+                        continue
+                    self.stacks[fold(frame)] += 1
+                self.samples += 1
+
+    def report(self, top=PROFILE_TOP):
+        with self.lock:
+            return {
+                "running": self.running,
+                "interval": self.interval,
+                "all_threads": self.all_threads,
+                "started_at": self.started_at,
+                "samples": self.samples,
+                "stacks": [{"stack": s, "count": n} for s, n in self.stacks.most_common(top)]
+            }
+
+
+def fold(frame):
+    names = []
+    while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+profiler = SamplingProfiler()
+
+
+# --- Flask ---
+def install(app):
+    """
+    Instruments every route of `app` (count, 5xx errors and latency by route template,
+    so /chunk/read/<handle> is one series) and adds:
+      GET  /metrics        Prometheus text
+      GET  /debug/profile  profiler state and folded stacks (?format=folded for plain text)
+      POST /debug/profile  {"enabled": bool, "interval": seconds, "all_threads": bool}
+    Latency is measured until the view returns, not until a streamed body is sent.
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        with profiler.lock:
+            profiler.active_requests.add(threading.get_ident())
+
+    @app.teardown_request
+    def end_profiling(exc):
+        with profiler.lock:
+            profiler.active_requests.discard(threading.get_ident())
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        registry.observe("gfs_http_request_duration_seconds", (("route", route),), time.perf_counter() - started)
+        registry.inc("gfs_http_requests_total", (("route", route), ("method", request.method),
+                                                 ("status", str(response.status_code))))
+        if response.status_code >= 500:
+            registry.inc("gfs_http_request_errors_total", (("route", route),))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_text():
+        return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.route('/debug/profile', methods=['GET', 'POST'])
+    def profile():
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            if data.get('enabled', True):
+                profiler.start(float(data.get('interval', PROFILE_INTERVAL)), bool(data.get('all_threads', False)),
+                               reset=data.get('reset', True))
+            else:
+                profiler.stop()
+        report = profiler.report(request.args.get('top', PROFILE_TOP, type=int))
+        if request.args.get('format') == 'folded':
+            return Response("".join(f"{s['stack']} {s['count']}\n" for s in report['stacks']),
+                            content_type="text/plain; charset=utf-8")
+        return jsonify(report)
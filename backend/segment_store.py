@@ -0,0 +1,314 @@
+import os
+import mmap
+import time
+import struct
+import sqlite3
+import zlib
+import hashlib
+import threading
+
+# --- Configuration ---
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024  # Roll over to a new segment file past this size
+COMPACTION_INTERVAL = 30              # Seconds between compaction passes
+COMPACTION_THRESHOLD = 0.5            # Rewrite sealed segments with less than this fraction live
+STREAM_BLOCK = 64 * 1024              # Bytes per piece when streaming a chunk out
+COMPRESS_MIN_BYTES = 256              # Smaller payloads are stored raw; headers would eat the gain
+
+# --- Codecs ---
+# {name: (compress, decompress)}. The name is recorded per chunk in the index, so the
+# configured codec can change without rewriting chunks stored under another one.
+CODECS = {
+    "none": (bytes, bytes),
+    "zlib-1": (lambda b: zlib.compress(b, 1), zlib.decompress),
+    "zlib-6": (lambda b: zlib.compress(b, 6), zlib.decompress),
+    "zlib-9": (lambda b: zlib.compress(b, 9), zlib.decompress),
+}
+
+# Record layout: [handle_len:u32][payload_len:u32][version:u64][handle][payload]
+RECORD_HEADER = struct.Struct(">IIQ")
+
+
+def record_size(handle, length):
+    return RECORD_HEADER.size + len(handle.encode()) + length
+
+
+class SegmentStore:
+    """
+    CHUNK STORAGE ENGINE:
+    Chunk payloads are appended to segment files and never rewritten in place.
+    A small SQLite index maps handle -> (segment, offset, length, version, checksum)
+    and is mirrored in memory. Reads go through memory-mapped segments; overwritten
+    versions become dead space that background compaction reclaims.
+    COMPRESSION: payloads are stored under the configured codec (raw when that does not
+    shrink them); `length` is the stored size, `size` the uncompressed one.
+    """
+    def __init__(self, directory, index_db, codec="none"):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}; expected one of {', '.join(CODECS)}")
+        self.directory = directory
+        self.codec = codec
+        self.lock = threading.RLock()
+        self.maps = {}        # {segment_id: mmap} (remapped when the active segment grows)
+        self.live_bytes = {}  # {segment_id: bytes referenced by the index}
+        self.index = {}       # {handle: {'segment', 'offset', 'length', 'version', 'checksum', 'last_mod', 'codec', 'size'}}
+        self.codec_counters = {"compress_seconds": 0.0, "decompress_seconds": 0.0,
+                               "compressed_in": 0, "compressed_out": 0}
+        os.makedirs(directory, exist_ok=True)
+
+        self.db = sqlite3.connect(index_db, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute('''CREATE TABLE IF NOT EXISTS chunk_index
+                           (handle TEXT PRIMARY KEY, segment INT, offset INT, length INT,
+                            version INT, checksum TEXT, last_mod FLOAT, codec TEXT, size INT)''')
+        columns = [r[1] for r in self.db.execute("PRAGMA table_info(chunk_index)")]
+        if "codec" not in columns:
+            # Indexes written before compression: every record is raw
+            self.db.execute("ALTER TABLE chunk_index ADD COLUMN codec TEXT")
+            self.db.execute("ALTER TABLE chunk_index ADD COLUMN size INT")
+        self.db.commit()
+
+        for row in self.db.execute("SELECT handle, segment, offset, length, version, checksum, last_mod, codec, size FROM chunk_index"):
+            handle, segment, offset, length, version, checksum, last_mod, codec, size = row
+            self.index[handle] = {'segment': segment, 'offset': offset, 'length': length,
+                                  'version': version, 'checksum': checksum, 'last_mod': last_mod,
+                                  'codec': codec or "none", 'size': length if size is None else size}
+            self.live_bytes[segment] = self.live_bytes.get(segment, 0) + record_size(handle, length)
+
+        segments = self.list_segments()
+        self.active_id = segments[-1] if segments else 1
+        self.active = open(self.segment_path(self.active_id), "ab")
+
+    # --- Segment Files ---
+    def segment_path(self, segment_id):
+        return os.path.join(self.directory, f"segment_{segment_id:06d}.log")
+
+    def list_segments(self):
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment_") and name.endswith(".log"):
+                ids.append(int(name[8:-4]))
+        return sorted(ids)
+
+    def roll_segment(self):
+        self.active.close()
+        self.active_id += 1
+        self.active = open(self.segment_path(self.active_id), "ab")
+
+    def get_map(self, segment_id, end):
+        """Returns an mmap of the segment covering at least `end` bytes."""
+        mm = self.maps.get(segment_id)
+        if mm is None or len(mm) < end:
+            with open(self.segment_path(segment_id), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Old maps are dropped, not closed: an in-flight stream may still hold one
+            self.maps[segment_id] = mm
+        return mm
+
+    # --- Writes ---
+    def append_record(self, handle, payload, version):
+        """Appends one record to the active segment. Returns (segment_id, payload_offset)."""
+        if self.active.tell() >= SEGMENT_MAX_BYTES:
+            self.roll_segment()
+        name = handle.encode()
+        start = self.active.tell()
+        self.active.write(RECORD_HEADER.pack(len(name), len(payload), version))
+        self.active.write(name)
+        self.active.write(payload)
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        return self.active_id, start + RECORD_HEADER.size + len(name)
+
+    def put(self, handle, payload, version, checksum=None):
+        """Stores a new version of a chunk and points the index at it."""
+        checksum = checksum or hashlib.sha256(payload).hexdigest()  # Always over the raw bytes
+        codec, stored = self.encode(payload)
+        with self.lock:
+            self.put_stored(handle, stored, version, checksum, codec, len(payload))
+
+    def put_stored(self, handle, stored, version, checksum, codec, size):
+        """Writes an already-encoded payload (caller holds the lock)."""
+        now = time.time()
+        segment, offset = self.append_record(handle, stored, version)
+        self.db.execute("INSERT OR REPLACE INTO chunk_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (handle, segment, offset, len(stored), version, checksum, now, codec, size))
+        self.db.commit()
+        self.set_entry(handle, {'segment': segment, 'offset': offset, 'length': len(stored),
+                                'version': version, 'checksum': checksum, 'last_mod': now,
+                                'codec': codec, 'size': size})
+
+    def set_version(self, handle, version):
+        """Moves a chunk to a new version without rewriting its payload (a lease grant, not a mutation)."""
+        with self.lock:
+            self.index[handle]['version'] = version
+            self.db.execute("UPDATE chunk_index SET version=? WHERE handle=?", (version, handle))
+            self.db.commit()
+
+    # --- Codecs ---
+    def encode(self, payload):
+        """Returns (codec, stored bytes), falling back to raw when compression does not pay."""
+        if self.codec == "none" or len(payload) < COMPRESS_MIN_BYTES:
+            return "none", payload
+        started = time.thread_time()
+        stored = CODECS[self.codec][0](payload)
+        with self.lock:
+            self.codec_counters["compress_seconds"] += time.thread_time() - started
+            self.codec_counters["compressed_in"] += len(payload)
+            self.codec_counters["compressed_out"] += len(stored)
+        if len(stored) >= len(payload):
+            return "none", payload
+        return self.codec, stored
+
+    def decode(self, codec, stored):
+        if codec == "none":
+            return stored
+        started = time.thread_time()
+        payload = CODECS[codec][1](stored)
+        with self.lock:
+            self.codec_counters["decompress_seconds"] += time.thread_time() - started
+        return payload
+
+    def delete(self, handle):
+        """Removes a chunk from the index; its record becomes dead space."""
+        with self.lock:
+            old = self.index.pop(handle, None)
+            if not old:
+                return False
+            self.live_bytes[old['segment']] -= record_size(handle, old['length'])
+            self.db.execute("DELETE FROM chunk_index WHERE handle=?", (handle,))
+            self.db.commit()
+            return True
+
+    def set_entry(self, handle, entry):
+        old = self.index.get(handle)
+        if old:
+            self.live_bytes[old['segment']] -= record_size(handle, old['length'])
+        self.index[handle] = entry
+        self.live_bytes[entry['segment']] = self.live_bytes.get(entry['segment'], 0) + record_size(handle, entry['length'])
+
+    # --- Reads ---
+    def stat(self, handle):
+        with self.lock:
+            entry = self.index.get(handle)
+            return dict(entry) if entry else None
+
+    def get(self, handle):
+        """Returns the chunk payload as bytes, or None if the chunk is unknown."""
+        entry, payload = self.read(handle)
+        return payload
+
+    def read_stored(self, handle):
+        """Returns (entry, bytes as stored under entry['codec']), or (None, None)."""
+        with self.lock:
+            entry = self.index.get(handle)
+            if not entry:
+                return None, None
+            entry = dict(entry)
+            mm = self.get_map(entry['segment'], entry['offset'] + entry['length'])
+        return entry, mm[entry['offset']:entry['offset'] + entry['length']]
+
+    def read(self, handle):
+        """Returns (entry, payload bytes) from one consistent index lookup, or (None, None)."""
+        entry, stored = self.read_stored(handle)
+        if not entry:
+            return None, None
+        return entry, self.decode(entry['codec'], stored)
+
+    def stream(self, handle):
+        """Returns (entry, generator of payload pieces) without copying the whole chunk at once."""
+        with self.lock:
+            entry = self.index.get(handle)
+            if not entry:
+                return None, None
+            entry = dict(entry)
+            mm = self.get_map(entry['segment'], entry['offset'] + entry['length'])
+        if entry['codec'] != "none":
+            payload = self.decode(entry['codec'], mm[entry['offset']:entry['offset'] + entry['length']])
+            return entry, (payload[i:i + STREAM_BLOCK] for i in range(0, len(payload), STREAM_BLOCK))
+
+        def pieces():
+            pos, end = entry['offset'], entry['offset'] + entry['length']
+            while pos < end:
+                yield mm[pos:min(pos + STREAM_BLOCK, end)]
+                pos += STREAM_BLOCK
+        return entry, pieces()
+
+    def versions(self):
+        """{handle: version} for every stored chunk (reported to the master)."""
+        with self.lock:
+            return {h: e['version'] for h, e in self.index.items()}
+
+    # --- Compaction ---
+    def compact_once(self):
+        """Rewrites the live records of mostly-dead sealed segments, then deletes them."""
+        reclaimed = 0
+        for segment_id in self.list_segments():
+            with self.lock:
+                if segment_id == self.active_id:
+                    continue
+                size = os.path.getsize(self.segment_path(segment_id))
+                if size and self.live_bytes.get(segment_id, 0) / size >= COMPACTION_THRESHOLD:
+                    continue
+                handles = [h for h, e in self.index.items() if e['segment'] == segment_id]
+
+            for handle in handles:
+                with self.lock:
+                    entry = self.index.get(handle)
+                    if not entry or entry['segment'] != segment_id:
+                        continue  # Overwritten since we listed it
+                    _, stored = self.read_stored(handle)
+                    self.put_stored(handle, stored, entry['version'], entry['checksum'], entry['codec'], entry['size'])
+
+            with self.lock:
+                if any(e['segment'] == segment_id for e in self.index.values()):
+                    continue
+                self.maps.pop(segment_id, None)
+                self.live_bytes.pop(segment_id, None)
+                os.remove(self.segment_path(segment_id))
+                reclaimed += size
+        return reclaimed
+
+    def compaction_loop(self):
+        while True:
+            time.sleep(COMPACTION_INTERVAL)
+            try:
+                reclaimed = self.compact_once()
+                if reclaimed:
+                    print(f"[Compaction] Reclaimed {reclaimed} bytes")
+            except Exception as e:
+                print(f"[Compaction] Error: {e}")
+
+    # --- Migration & Stats ---
+    def import_legacy(self, conn):
+        """One-time move of chunks stored as TEXT rows in stored_chunks into segments."""
+        tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stored_chunks'").fetchall()
+        if not tables:
+            return 0
+        rows = conn.execute("SELECT handle, data, version FROM stored_chunks").fetchall()
+        for handle, data, version in rows:
+            if handle not in self.index:
+                self.put(handle, (data or "").encode(), version or 1)
+        conn.execute("DROP TABLE stored_chunks")
+        conn.commit()
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            segments = self.list_segments()
+            disk = sum(os.path.getsize(self.segment_path(s)) for s in segments)
+            live = sum(self.live_bytes.values())
+            stored = sum(e['length'] for e in self.index.values())
+            raw = sum(e['size'] for e in self.index.values())
+            return {
+                "chunks": len(self.index),
+                "segments": len(segments),
+                "disk_bytes": disk,
+                "live_bytes": live,
+                "dead_bytes": disk - live,
+                "compression": {
+                    "codec": self.codec,
+                    "raw_bytes": raw,
+                    "stored_bytes": stored,
+                    "ratio": round(raw / stored, 3) if stored else 1.0,
+                    **self.codec_counters
+                }
+            }
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
+
+# --- Configuration ---
+SERVING_MODE = os.environ.get("GFS_SERVING_MODE", "dev")  # "dev": Flask's dev server | "production": PooledWSGIServer
+WORKERS = 64               # Connections served at once (a keep-alive connection holds a worker)
+BACKLOG = 256              # Accepted connections that may wait for a worker before we answer 503
+MAX_IN_FLIGHT = 32         # Requests executing at once before new ones are answered 429
+ADMISSION_WAIT = 0.5       # Seconds a request waits for an in-flight slot before the 429
+KEEPALIVE_TIMEOUT = 5      # Seconds an idle keep-alive connection may hold its worker
+GRACE_PERIOD = 5           # Seconds to finish in-flight requests on SIGTERM/SIGINT
+
+current_server = None  # The PooledWSGIServer of this process, for stats()
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def log_request(self, code="-", size="-"):
+        pass  # Per-request access logs cost more than the requests at our rates; errors still log
+
+
+class AdmissionControl:
+    """
+    WSGI middleware bounding the requests executing at once. Over the limit, a request
+    waits briefly for a slot and is then answered 429 with Retry-After. Paths in `exempt`
+    (heartbeats, elections, health checks) always run: rejecting them would make a busy
+    node look dead. So do requests carrying `exempt_header` (traffic forwarded by a peer).
+    """
+    def __init__(self, app, limit=MAX_IN_FLIGHT, exempt=(), exempt_header=None):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(limit)
+        self.exempt = tuple(exempt)
+        self.exempt_key = "HTTP_" + exempt_header.upper().replace("-", "_") if exempt_header else None
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(self.exempt) or self.exempt_key in environ:
+            return self.app(environ, start_response)
+        if not self.slots.acquire(timeout=ADMISSION_WAIT):
+            with self.lock:
+                self.rejected += 1
+            body = json.dumps({"error": "Too many requests in flight"}).encode()
+            start_response("429 Too Many Requests", [("Content-Type", "application/json"),
+                                                     ("Content-Length", str(len(body))),
+                                                     ("Retry-After", "1")])
+            return [body]
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self.slots.release()
+            raise
+        # Held until the response (possibly a streamed chunk) has been fully sent
+        return ClosingIterator(result, self.slots.release)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    HTTP/1.1 keep-alive server on a bounded thread pool. Connections beyond the pool and
+    its backlog are answered 503 immediately instead of piling up as unbounded threads.
+    """
+    multithread = True
+    request_queue_size = BACKLOG  # listen() backlog
+
+    def __init__(self, host, port, app, workers=WORKERS, backlog=BACKLOG):
+        super().__init__(host, port, app, handler=KeepAliveHandler)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.counters = {"accepted": 0, "rejected_503": 0}
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.counters["rejected_503"] += 1
+            self.reject(request)
+            return
+        with self.lock:
+            self.active += 1
+            self.counters["accepted"] += 1
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+    def reject(self, request):
+        body = b'{"error": "Server saturated"}'
+        try:
+            request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                            b"Retry-After: 1\r\nConnection: close\r\n"
+                            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def drain(self, grace):
+        """Waits up to `grace` seconds for in-flight connections to finish."""
+        deadline = time.time() + grace
+        while self.active and time.time() < deadline:
+            time.sleep(0.05)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(app, port, mode=None, exempt=(), exempt_header=None, on_shutdown=None):
+    """
+    Runs a Flask app until the process is told to stop.
+    dev: Flask's threaded development server (one thread per connection, unbounded).
+    production: PooledWSGIServer + AdmissionControl, with graceful shutdown on SIGTERM/SIGINT:
+    stop accepting, let in-flight requests finish for up to GRACE_PERIOD, run `on_shutdown`.
+    """
+    global current_server
+    mode = mode or SERVING_MODE
+    if mode == "dev":
+        app.run(port=port, debug=False, use_reloader=False)
+        return
+    if mode != "production":
+        raise ValueError(f"Unknown serving mode {mode}; expected dev or production")
+
+    admission = AdmissionControl(app.wsgi_app, exempt=exempt, exempt_header=exempt_header)
+    app.wsgi_app = admission
+    server = PooledWSGIServer("127.0.0.1", port, app)
+    server.admission = admission
+    current_server = server
+
+    def stop(signum, frame):
+        print(f"[Serving] Signal {signum}: draining for up to {GRACE_PERIOD}s")
+        threading.Thread(target=server.shutdown, daemon=True).start()  # Not from serve_forever's thread
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"[Serving] Production server on port {port}: {WORKERS} workers, backlog {BACKLOG}, "
+          f"{MAX_IN_FLIGHT} requests in flight")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.drain(GRACE_PERIOD)
+        if on_shutdown:
+            on_shutdown()
+
+
+def stats():
+    """Serving metrics for status endpoints."""
+    server = current_server
+    if server is None:
+        return {"mode": "dev"}
+    return {
+        "mode": "production",
+        "active_connections": server.active,
+        "workers": WORKERS,
+        "rejected_429": server.admission.rejected,
+        **server.counters
+    }
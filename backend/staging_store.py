@@ -0,0 +1,125 @@
+import os
+import time
+import shutil
+import threading
+from collections import OrderedDict
+
+# --- Configuration ---
+STAGING_TTL = 60                             # Seconds before an uncommitted write is dropped
+STAGING_MEMORY_WATERMARK = 64 * 1024 * 1024  # Spill to disk above this many in-memory bytes
+STAGING_MAX_BYTES = 512 * 1024 * 1024        # Hard cap (memory + disk); LRU entries are evicted past it
+SWEEP_INTERVAL = 5                           # Seconds between TTL sweeps
+
+
+class StagingFull(Exception):
+    pass
+
+
+class StagingStore:
+    """
+    TWO-PHASE COMMIT BUFFER:
+    Holds pushed-but-uncommitted chunk data keyed by (handle, write_id) so concurrent
+    writers to one chunk never overwrite each other. Usage is bounded: entries expire
+    after a TTL, the least recently used are evicted past the hard cap, and the
+    oldest in-memory entries spill to temp files above the memory watermark.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {(handle, write_id): {'data', 'path', 'size', 'created'}} in LRU order
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.counters = {"evictions": 0, "expirations": 0, "spills": 0}
+
+        # Spill files from a previous run belong to writes that can never commit
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Public API ---
+    def put(self, handle, write_id, data):
+        size = len(data)
+        if size > STAGING_MAX_BYTES:
+            raise StagingFull(f"{size} bytes exceeds staging capacity")
+        key = (handle, write_id)
+        with self.lock:
+            self.remove(key)
+            self.expire()
+            while self.entries and self.memory_bytes + self.disk_bytes + size > STAGING_MAX_BYTES:
+                self.remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+            self.entries[key] = {'data': data, 'path': None, 'size': size, 'created': time.time()}
+            self.memory_bytes += size
+            self.spill()
+
+    def get(self, handle, write_id):
+        """Returns the staged bytes, or None if they were never staged, expired or evicted."""
+        key = (handle, write_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            self.entries.move_to_end(key)
+            if entry['data'] is not None:
+                return entry['data']
+            path = entry['path']
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None  # Expired or evicted while we were reading
+
+    def discard(self, handle, write_id):
+        with self.lock:
+            self.remove((handle, write_id))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes,
+                "total_bytes": self.memory_bytes + self.disk_bytes,
+                **self.counters
+            }
+
+    def sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            with self.lock:
+                self.expire()
+
+    # --- Internals (caller holds the lock) ---
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if not entry:
+            return
+        if entry['data'] is not None:
+            self.memory_bytes -= entry['size']
+        else:
+            self.disk_bytes -= entry['size']
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+
+    def expire(self):
+        cutoff = time.time() - STAGING_TTL
+        stale = [k for k, e in self.entries.items() if e['created'] < cutoff]
+        for key in stale:
+            self.remove(key)
+        self.counters["expirations"] += len(stale)
+
+    def spill(self):
+        """Moves the least recently used in-memory entries to disk until under the watermark."""
+        for key, entry in self.entries.items():
+            if self.memory_bytes <= STAGING_MEMORY_WATERMARK:
+                break
+            if entry['data'] is None:
+                continue
+            path = os.path.join(self.directory, f"spill_{self.counters['spills']}.stage")
+            with open(path, "wb") as f:
+                f.write(entry['data'])
+            entry['data'], entry['path'] = None, path
+            self.memory_bytes -= entry['size']
+            self.disk_bytes += entry['size']
+            self.counters["spills"] += 1
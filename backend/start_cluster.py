@@ -4,6 +4,7 @@ import time
 import os
 import platform
 import signal
+import argparse
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
@@ -13,10 +14,6 @@ CORS(app)
 # Use the current python interpreter to ensure installed dependencies (Flask, etc.) are found
 PYTHON_EXE = sys.executable
 
-# Ensure logs directory exists to capture output from nodes
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
 # --- Cluster Configuration ---
 # Defines the topology of the distributed system
 NODES_CONFIG = {
@@ -34,6 +31,12 @@ NODES_CONFIG = {
     5004: {"type": "chunk", "args": ["6001,6002,6003"]},
 }
 
+# --- Serving Mode ---
+# "production": bounded thread pool with keep-alive, 429/503 backpressure and graceful
+# shutdown (serving.py). "dev": Flask's development server. Override with --serving.
+SERVING_MODE = os.environ.get("GFS_SERVING_MODE", "production")
+STOP_TIMEOUT = 6  # Seconds a node gets to drain after SIGTERM before it is killed
+
 # Store active subprocess objects: { port: subprocess.Popen }
 processes = {}
 
@@ -86,7 +89,8 @@ def launch_node(port):
         stderr = open(f"logs/node_{port}.err", "w")
         
         # Launch process non-blocking
-        p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr)
+        env = {**os.environ, "GFS_SERVING_MODE": SERVING_MODE}
+        p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
         processes[port] = p
         return True
     except Exception as e:
@@ -138,9 +142,9 @@ def stop_node(port):
             if sys.platform == 'win32':
                 subprocess.call(['taskkill', '/F', '/T', '/PID', str(p.pid)])
             else:
-                p.terminate() # Gentle signal
+                p.terminate() # Gentle signal: production nodes finish in-flight requests first
                 try:
-                    p.wait(timeout=1)
+                    p.wait(timeout=STOP_TIMEOUT)
                 except subprocess.TimeoutExpired:
                     p.kill() # Force kill if stuck
         except Exception as e:
@@ -176,8 +180,17 @@ def cleanup():
     print("[MANAGER] All nodes stopped.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Starts the GFS cluster and its manager API.")
+    parser.add_argument("--serving", choices=["production", "dev"], default=SERVING_MODE,
+                        help="HTTP server used by every node (default: %(default)s)")
+    SERVING_MODE = parser.parse_args().serving
+
     print(f"[MANAGER] Initializing Cluster with interpreter: {PYTHON_EXE}")
+    print(f"[MANAGER] Serving mode: {SERVING_MODE}")
     print("[MANAGER] Logs will be written to backend/logs/")
+    # Ensure logs directory exists to capture output from nodes
+    if not os.path.exists('logs'):
+        os.makedirs('logs')
     
     # 1. Launch all nodes immediately
     for port in NODES_CONFIG:
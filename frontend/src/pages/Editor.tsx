@@ -19,6 +19,21 @@ import {
     CheckCircle2
 } from "lucide-react";
 
+// Smallest single-range edit turning `before` into `after` (code point offsets)
+function diffOps(before: string, after: string) {
+    const a = Array.from(before), b = Array.from(after);
+    let prefix = 0;
+    while (prefix < a.length && prefix < b.length && a[prefix] === b[prefix]) prefix++;
+    let suffix = 0;
+    while (suffix < a.length - prefix && suffix < b.length - prefix &&
+           a[a.length - 1 - suffix] === b[b.length - 1 - suffix]) suffix++;
+    return [{
+        offset: prefix,
+        delete: a.length - prefix - suffix,
+        insert: b.slice(prefix, b.length - suffix).join("")
+    }];
+}
+
 export default function Editor() {
     const { id } = useParams();
     const { user } = useAuth();
@@ -35,6 +50,10 @@ export default function Editor() {
     
     // Ref to track editing state inside intervals without dependencies
     const isEditingRef = useRef(false);
+    // Version of the content we hold; lets the server answer polls with 304 Not Modified
+    const versionRef = useRef<string | null>(null);
+    // Content as of versionRef; edits are diffed against it so saves send only the change
+    const baseContentRef = useRef<string | null>(null);
 
     // --- Data Fetching ---
 
@@ -44,9 +63,16 @@ export default function Editor() {
         
         try {
             const res = await axios.post(`http://localhost:3000/api/docs/read/${id}`, {
-                user_id: user?.user_id
+                user_id: user?.user_id,
+                if_version: versionRef.current
+            }, {
+                validateStatus: (s) => s === 200 || s === 304
             });
-            setContent(res.data.content);
+            if (res.status === 200) {
+                setContent(res.data.content);
+                versionRef.current = res.data.version;
+                baseContentRef.current = res.data.content;
+            }
             setError(null);
             setPermissionDenied(false);
         } catch (err: any) {
@@ -65,6 +91,8 @@ export default function Editor() {
 
     // Initial Load
     useEffect(() => {
+        versionRef.current = null;
+        baseContentRef.current = null;
         if (user) fetchContent();
     }, [id, user]);
 
@@ -76,15 +104,39 @@ export default function Editor() {
 
     // --- Handlers ---
 
+    const saveDocument = async () => {
+        const base = baseContentRef.current;
+        if (versionRef.current !== null && base !== null) {
+            try {
+                const res = await axios.post("http://localhost:3000/api/docs/patch", {
+                    file_id: id,
+                    user_id: user?.user_id,
+                    base_version: versionRef.current,
+                    ops: diffOps(base, content)
+                });
+                versionRef.current = res.data.version;
+                baseContentRef.current = content;
+                return;
+            } catch (e: any) {
+                // Document changed underneath us or the edit spans chunks: send the full text
+                if (e.response?.status !== 409) throw e;
+            }
+        }
+        const res = await axios.post("http://localhost:3000/api/docs/update", {
+            file_id: id,
+            content: content,
+            user_id: user?.user_id
+        });
+        // The full text is now the base the next save patches against
+        versionRef.current = res.data.version;
+        baseContentRef.current = content;
+    };
+
     const handleSave = async () => {
         if (!content) return;
         setSaving(true);
         try {
-            await axios.post("http://localhost:3000/api/docs/update", {
-                file_id: id,
-                content: content,
-                user_id: user?.user_id
-            });
+            await saveDocument();
             
             toast.success("Changes saved to cluster.");
             setIsEditing(false);
@@ -1,6 +1,8 @@
 import express from "express";
 import cors from "cors";
 import axios from "axios";
+import { createHash, randomUUID } from "crypto";
+import { deflateSync } from "zlib";
 
 const app = express();
 app.use(cors());
@@ -69,6 +71,63 @@ async function forwardToLeader(method: 'get' | 'post', path: string, data: any =
     }
 }
 
+// --- HELPER: Follower Reads ---
+// Every master's /health says whether its replicated metadata is fresh enough to serve
+// reads. Read-only lookups rotate over those masters to take load off the leader; a
+// follower that has fallen behind since answers 307 and the read goes to the leader.
+// Writers keep using forwardToLeader: only the leader's lookups carry current leases.
+const READ_TARGET_REFRESH_MS = 2000;
+let readTargets: number[] = [];
+let readCursor = 0;
+
+async function refreshReadTargets() {
+    const ready = await Promise.all(MASTER_PORTS.map(async (port) => {
+        try {
+            const r = await axios.get(`http://localhost:${port}/health`, { timeout: 500 });
+            return r.data.serves_reads ? port : null;
+        } catch {
+            return null;
+        }
+    }));
+    readTargets = ready.filter((p): p is number => p !== null);
+}
+refreshReadTargets();
+setInterval(refreshReadTargets, READ_TARGET_REFRESH_MS);
+
+async function readFromMasters(method: 'get' | 'post', path: string, data: any = {}) {
+    if (readTargets.length > 0) {
+        const url = `http://localhost:${readTargets[readCursor++ % readTargets.length]}${path}`;
+        const options = { timeout: 1500, maxRedirects: 0 };
+        try {
+            return method === 'get' ? await axios.get(url, options) : await axios.post(url, data, options);
+        } catch (error: any) {
+            const status = error.response?.status;
+            if (status === 403 || status === 404) throw error; // A real answer, not a routing problem
+        }
+    }
+    return forwardToLeader(method, path, data);
+}
+
+// Read lookups: a lookup vouches for this user's access until access_expires (a few
+// seconds). Until then, reads of that file by that user reuse the lookup and never
+// reach a master. Lookups are dropped when they expire, when a read fails, on any
+// approve/reject, and when this middleware changes the file, so a changed decision
+// or a new chunk list is picked up on the next read.
+const readLookups = new Map<string, { lookup: any; expires: number }>();
+
+function cachedLookup(key: string) {
+    const entry = readLookups.get(key);
+    if (entry && entry.expires * 1000 > Date.now()) return entry.lookup;
+    readLookups.delete(key);
+    return undefined;
+}
+
+function forgetLookups(fileId: string) {
+    for (const key of readLookups.keys()) {
+        if (key.startsWith(`${fileId}:`)) readLookups.delete(key);
+    }
+}
+
 // ==========================================
 // ADMIN & VISUALIZATION ROUTES
 // ==========================================
@@ -163,19 +222,41 @@ app.post("/api/auth/login", async (req, res) => {
 // DOCUMENT MANAGEMENT
 // ==========================================
 
-// Helper: The GFS Write Pipeline (Stage -> Commit)
-async function performWritePipeline(chunk_handle: string, content: string, replicas: number[], primary: number) {
-    console.log(`[MW] Write Pipeline: ${chunk_handle} -> [${replicas}] (Pri: ${primary})`);
-    
-    // 1. Stage Data (Fan-out)
-    const stagePromises = replicas.map((port) => 
-        axios.post(`http://localhost:${port}/chunk/stage`, { handle: chunk_handle, content }, { timeout: 2000 })
-            .then(() => ({ status: 'fulfilled', port }))
-            .catch((e) => ({ status: 'rejected', port, error: e.message }))
-    );
+// Helper: The GFS Write Pipeline (Push -> Commit)
+const COMPRESS_MIN_BYTES = 256;
 
-    const results = await Promise.all(stagePromises);
-    const successfulPorts = results.filter((r: any) => r.status === 'fulfilled').map((r: any) => r.port);
+// Returns the chunk version the primary committed the content as.
+async function performWritePipeline(chunk_handle: string, content: string, replicas: number[], primary: number, version: number = 0): Promise<string> {
+    console.log(`[MW] Write Pipeline: ${chunk_handle} -> [${replicas}] (Pri: ${primary})`);
+    const dataId = randomUUID();
+    // Text compresses well: deflate it once here and every hop of the chain carries
+    // the compressed body (tiny chunks go raw, the zlib header would outweigh the gain).
+    const raw = Buffer.from(content, "utf8");
+    const compressed = raw.length >= COMPRESS_MIN_BYTES ? deflateSync(raw) : null;
+    const body = compressed && compressed.length < raw.length ? compressed : raw;
+
+    // 1. Push Data (Chain): send the bytes once to the nearest replica, which streams
+    // them on to the next one while still receiving. If the head of the chain is
+    // unreachable, the next replica becomes the head.
+    const chain = [primary, ...replicas.filter((p: number) => p !== primary)];
+    let successfulPorts: number[] = [];
+    for (let i = 0; i < chain.length && successfulPorts.length === 0; i++) {
+        try {
+            const r = await axios.post(`http://localhost:${chain[i]}/chunk/stage`, body, {
+                timeout: 5000,
+                headers: {
+                    "Content-Type": "application/octet-stream",
+                    "X-Chunk-Handle": chunk_handle,
+                    "X-Data-Id": dataId,
+                    "X-Forward-To": chain.slice(i + 1).join(","),
+                    ...(body === raw ? {} : { "Content-Encoding": "deflate" }),
+                },
+            });
+            successfulPorts = r.data.staged;
+        } catch (e: any) {
+            console.warn(`[MW] Push to ${chain[i]} failed: ${e.message}`);
+        }
+    }
 
     // Integrity Checks
     if (successfulPorts.length === 0) throw new Error("Write Failed: All replicas failed to stage data.");
@@ -191,15 +272,108 @@ async function performWritePipeline(chunk_handle: string, content: string, repli
     // We only tell the primary to replicate to nodes that successfully staged the data
     const secondaries = successfulPorts.filter((p: number) => p !== primary);
     
-    await axios.post(`http://localhost:${primary}/chunk/commit`, {
+    // `version` is what the master last saw; a primary behind it refuses (409 Stale primary)
+    const r = await axios.post(`http://localhost:${primary}/chunk/commit`, {
         handle: chunk_handle,
+        data_id: dataId,
+        version: version,
         secondaries: secondaries
     });
+    return String(r.data.version);
+}
+
+// Helper: Split a document into fixed-size chunk slices.
+// Slicing is by code point so a multi-byte character never straddles two chunks.
+// Allocated chunks beyond the end of the content get an empty slice (truncation).
+function splitIntoChunks(content: string, chunkSize: number, minChunks: number = 1): string[] {
+    const chars = Array.from(content);
+    const slices: string[] = [];
+    for (let i = 0; i < chars.length; i += chunkSize) {
+        slices.push(chars.slice(i, i + chunkSize).join(""));
+    }
+    while (slices.length < minChunks) slices.push("");
+    return slices;
+}
+
+function checksum(content: string): string {
+    return createHash("sha256").update(content).digest("hex");
+}
+
+// Helper: Ask a replica for the stored chunk's checksum and version (null if unknown/unreachable)
+async function fetchChunkChecksum(chunk: any): Promise<{ checksum: string, version: number } | null> {
+    const order = [chunk.primary, ...chunk.replicas.filter((p: number) => p !== chunk.primary)];
+    for (const port of order) {
+        try {
+            const r = await axios.get(`http://localhost:${port}/chunk/checksum/${chunk.handle}`, { timeout: 1000 });
+            return r.data;
+        } catch (e: any) {
+            if (e.response?.status === 404) return null;
+        }
+    }
+    return null;
+}
+
+// Helper: Write only the chunks whose contents changed. Returns the number of chunks written.
+// Returns how many chunks were written and the document version (chunk versions
+// joined by ".") the new content has, so an editor can keep patching from it.
+async function writeChangedChunks(chunks: any[], slices: string[]): Promise<{ written: number, version: string }> {
+    const writes = chunks.map(async (chunk: any, i: number) => {
+        const slice = slices[i] ?? "";
+        const stored = await fetchChunkChecksum(chunk);
+        if (stored && stored.checksum === checksum(slice)) return { written: 0, version: String(stored.version) };
+        const version = await performWritePipeline(chunk.handle, slice, chunk.replicas, chunk.primary, chunk.version);
+        rememberChunk(chunk.handle, version, slice);
+        return { written: 1, version };
+    });
+    const results = await Promise.all(writes);
+    return {
+        written: results.reduce((a: number, r) => a + r.written, 0),
+        version: results.map((r) => r.version).join(".")
+    };
+}
+
+// Chunk contents we have already fetched, by handle. Revalidated with If-None-Match
+// so an unchanged chunk costs the chunkserver an empty 304 instead of the full text.
+const CHUNK_CACHE_LIMIT = 1000;
+const chunkCache = new Map<string, { version: string, content: string }>();
+
+function rememberChunk(handle: string, version: string, content: string) {
+    chunkCache.delete(handle);
+    chunkCache.set(handle, { version, content });
+    if (chunkCache.size > CHUNK_CACHE_LIMIT) chunkCache.delete(chunkCache.keys().next().value!);
+}
+
+// Helper: Read one chunk, trying primary first for consistency, then secondaries
+async function readChunk(chunk: any): Promise<{ content: string, version: string }> {
+    const readOrder = [chunk.primary, ...chunk.replicas.filter((p: number) => p !== chunk.primary)];
+    const cached = chunkCache.get(chunk.handle);
+    for (const port of readOrder) {
+        try {
+            // Chunkservers stream raw bytes; never let axios JSON-parse document text.
+            // Compressed chunks come back as stored (deflate) and axios inflates them.
+            const r = await axios.get(`http://localhost:${port}/chunk/read/${chunk.handle}`, {
+                timeout: 1500,
+                responseType: 'text',
+                headers: {
+                    "Accept-Encoding": "deflate",
+                    ...(cached ? { "If-None-Match": `"${cached.version}"` } : {}),
+                },
+                validateStatus: (s: number) => s === 200 || s === 304,
+            });
+            const version = r.headers["x-chunk-version"];
+            if (r.status === 304 && cached) return cached;
+            rememberChunk(chunk.handle, version, r.data);
+            return { content: r.data, version };
+        } catch {
+            console.warn(`[MW] Read of ${chunk.handle} failed from ${port}, trying next...`);
+        }
+    }
+    throw new Error(`Chunk ${chunk.handle} unavailable`);
 }
 
 app.get("/api/docs/list/:userId", async (req, res) => {
     try {
-        const r = await forwardToLeader('get', `/file/list/${req.params.userId}`);
+        const r = await readFromMasters('get', `/file/list/${req.params.userId}`);
         res.json(r.data);
     } catch (e) {
         res.status(500).json({ error: "Fetch Failed" });
@@ -209,13 +383,16 @@ app.get("/api/docs/list/:userId", async (req, res) => {
 app.post("/api/docs/create", async (req, res) => {
     const { filename, content, user_id } = req.body;
     try {
-        // 1. Metadata (Create entry on Leader)
-        const masterRes = await forwardToLeader('post', '/file/create', { filename, user_id });
-        const { file_id, chunk_handle, replicas, primary } = masterRes.data;
+        // 1. Metadata (Create entry on Leader, one chunk per chunk_size characters)
+        const size = Array.from(content || "").length;
+        const masterRes = await forwardToLeader('post', '/file/create', { filename, user_id, size });
+        const { file_id, chunks, chunk_size } = masterRes.data;
 
-        // 2. Data (Push to Chunkservers)
+        // 2. Data (Push every chunk to its Chunkservers)
         try {
-            await performWritePipeline(chunk_handle, content, replicas, primary);
+            const slices = splitIntoChunks(content || "", chunk_size, chunks.length);
+            await Promise.all(chunks.map((chunk: any, i: number) =>
+                performWritePipeline(chunk.handle, slices[i], chunk.replicas, chunk.primary, chunk.version)));
         } catch (writeError: any) {
             console.error("[MW] Data write failed:", writeError.message);
             // Note: File metadata exists but data is missing. 
@@ -233,14 +410,24 @@ app.post("/api/docs/create", async (req, res) => {
 app.post("/api/docs/update", async (req, res) => {
     const { file_id, content, user_id } = req.body;
     try {
-        // 1. Lookup (Check Perms + Get Locations)
-        const lookup = await forwardToLeader('post', `/file/lookup/${file_id}`, { user_id });
-        const targetChunk = lookup.data.chunks[0];
+        // 1. Lookup (Check Perms + Get Locations, with leases for the write)
+        const lookup = await forwardToLeader('post', `/file/lookup/${file_id}`, { user_id, for_write: true });
+        let { chunks, chunk_size } = lookup.data;
+
+        // 2. Grow the file if the new content needs more chunks, and record its new
+        // size either way (a rewrite may also truncate it)
+        const size = Array.from(content || "").length;
+        const slices = splitIntoChunks(content || "", chunk_size, chunks.length);
+        if (slices.length > chunks.length || size !== lookup.data.size) {
+            const alloc = await forwardToLeader('post', `/file/allocate/${file_id}`, { user_id, size });
+            chunks = alloc.data.chunks;
+        }
 
-        // 2. Write
-        await performWritePipeline(targetChunk.handle, content, targetChunk.replicas, targetChunk.primary);
+        // 3. Write only the chunks that changed
+        const { written, version } = await writeChangedChunks(chunks, slices);
+        forgetLookups(file_id);
 
-        res.json({ success: true });
+        res.json({ success: true, chunks_written: written, version });
     } catch (error: any) {
         if (error.response?.status === 403) return res.status(403).json({ error: "Denied" });
         console.error("Update Error:", error.message);
@@ -248,27 +435,163 @@ app.post("/api/docs/update", async (req, res) => {
     }
 });
 
-app.post("/api/docs/read/:fileId", async (req, res) => {
+// Helper: Apply [{ offset, delete, insert }] edits (code point offsets) to a string
+function applyOps(text: string, ops: any[]): string {
+    let chars = Array.from(text);
+    for (const op of ops) {
+        chars = [...chars.slice(0, op.offset), ...Array.from(op.insert || ""), ...chars.slice(op.offset + (op.delete || 0))];
+    }
+    return chars.join("");
+}
+
+// Delta save: the editor sends edits in document coordinates plus the document
+// version they were made against. Each edit is routed to the chunk holding it and
+// the chunk's primary applies and replicates just that patch.
+app.post("/api/docs/patch", async (req, res) => {
+    const { file_id, user_id, base_version, ops } = req.body;
     try {
-        // 1. Get Metadata from Leader
-        const lookup = await forwardToLeader('post', `/file/lookup/${req.params.fileId}`, { user_id: req.body.user_id });
-        const targetChunk = lookup.data.chunks[0];
+        // 1. Lookup (Check Perms + Get Locations). A plain lookup: granting leases may move
+        // the chunks to a new version, which must not fail the base_version check below.
+        const lookup = await forwardToLeader('post', `/file/lookup/${file_id}`, { user_id });
+        let chunks = lookup.data.chunks;
 
-        // 2. Read from Replicas (Load Balancing)
-        // Try primary first for consistency, then secondaries
-        const readOrder = [targetChunk.primary, ...targetChunk.replicas.filter((p:number) => p !== targetChunk.primary)];
-        
-        for (const port of readOrder) {
-            try {
-                const r = await axios.get(`http://localhost:${port}/chunk/read/${targetChunk.handle}`, { timeout: 1500 });
-                return res.json({ content: r.data.data });
-            } catch {
-                console.warn(`[MW] Read failed from ${port}, trying next...`);
+        // 2. Current chunk versions and lengths (usually 304s against our chunk cache)
+        const parts = await Promise.all(chunks.map(readChunk));
+        if (parts.map((p) => p.version).join(".") !== base_version) {
+            return res.status(409).json({ error: "Version mismatch" });
+        }
+
+        // 2b. Leases for the write. A chunk moved to a new version by the grant is re-read:
+        // unchanged text means only the lease changed and the edits still apply.
+        const leased = await forwardToLeader('post', `/file/lookup/${file_id}`, { user_id, for_write: true });
+        if (leased.data.chunks.length !== chunks.length) {
+            return res.status(409).json({ error: "Version mismatch" });
+        }
+        chunks = leased.data.chunks;
+        const current = await Promise.all(chunks.map((chunk: any, i: number) =>
+            String(chunk.version) === parts[i].version ? parts[i] : readChunk(chunk)));
+        if (current.some((p, i) => p.content !== parts[i].content)) {
+            return res.status(409).json({ error: "Version mismatch" });
+        }
+        parts.splice(0, parts.length, ...current);
+
+        // 3. Route each edit to the chunk that holds its range
+        const lengths = parts.map((p) => Array.from(p.content).length);
+        const perChunk: any[][] = chunks.map(() => []);
+        for (const op of ops) {
+            const del = op.delete || 0;
+            let offset = op.offset, i = 0;
+            while (i < lengths.length - 1 && (offset > lengths[i] || (offset === lengths[i] && del > 0))) {
+                offset -= lengths[i];
+                i++;
             }
+            if (offset < 0 || offset + del > lengths[i]) {
+                return res.status(409).json({ error: "Edit spans chunks; send full content" });
+            }
+            perChunk[i].push({ offset, delete: del, insert: op.insert || "" });
+            lengths[i] += Array.from(op.insert || "").length - del;
+        }
+
+        // 4. Patch the affected chunks in parallel
+        const versions = await Promise.all(chunks.map(async (chunk: any, i: number) => {
+            if (perChunk[i].length === 0) return parts[i].version;
+            const r = await axios.post(`http://localhost:${chunk.primary}/chunk/patch`, {
+                handle: chunk.handle,
+                base_version: Number(parts[i].version),
+                ops: perChunk[i],
+                max_size: lookup.data.chunk_size,
+                secondaries: chunk.replicas.filter((p: number) => p !== chunk.primary)
+            });
+            const version = String(r.data.version);
+            rememberChunk(chunk.handle, version, applyOps(parts[i].content, perChunk[i]));
+            return version;
+        }));
+
+        // 5. Record the new size (in code points, like the update route)
+        const size = lengths.reduce((a, b) => a + b, 0);
+        if (size !== lookup.data.size) {
+            await forwardToLeader('post', `/file/allocate/${file_id}`, { user_id, size });
+        }
+
+        forgetLookups(file_id);
+        res.json({ success: true, version: versions.join(".") });
+    } catch (error: any) {
+        const status = error.response?.status;
+        if (status === 403) return res.status(403).json({ error: "Denied" });
+        if (status === 409) return res.status(409).json({ error: error.response.data?.error || "Version mismatch" });
+        console.error("Patch Error:", error.message);
+        res.status(500).json({ error: "Patch Failed" });
+    }
+});
+
+// GFS record append: the primary of the last chunk picks the offset, so concurrent
+// appenders never overwrite each other. A full chunk makes us allocate the next one.
+const MAX_APPEND_ROLLOVERS = 3;
+
+app.post("/api/docs/append", async (req, res) => {
+    const { file_id, user_id, record } = req.body;
+    try {
+        let lookup = await forwardToLeader('post', `/file/lookup/${file_id}`, { user_id, for_write: true });
+        for (let attempt = 0; attempt <= MAX_APPEND_ROLLOVERS; attempt++) {
+            const chunks = lookup.data.chunks;
+            const chunk = chunks[chunks.length - 1];
+            const r = await axios.post(`http://localhost:${chunk.primary}/chunk/append`, {
+                handle: chunk.handle,
+                record,
+                version: chunk.version,
+                max_size: lookup.data.chunk_size,
+                secondaries: chunk.replicas.filter((p: number) => p !== chunk.primary)
+            });
+            if (r.data.status !== "chunk_full") {
+                // Record the file's new end (earlier chunks are usually 304s against our chunk cache)
+                const earlier = await Promise.all(chunks.slice(0, -1).map(readChunk));
+                const end = earlier.reduce((n, p) => n + Array.from(p.content).length, 0)
+                    + r.data.offset + Array.from(record || "").length;
+                if (end > lookup.data.size) {
+                    await forwardToLeader('post', `/file/allocate/${file_id}`, { user_id, min_size: end });
+                }
+                forgetLookups(file_id);
+                return res.json({ success: true, chunk: chunk.sequence, offset: r.data.offset, version: r.data.version });
+            }
+            // Roll over: ask the master for one more chunk (idempotent across racing appenders)
+            lookup = await forwardToLeader('post', `/file/allocate/${file_id}`, { user_id, chunk_count: chunks.length + 1 });
+        }
+        res.status(503).json({ error: "Append kept hitting full chunks" });
+    } catch (error: any) {
+        const status = error.response?.status;
+        if (status === 403) return res.status(403).json({ error: "Denied" });
+        if (status === 400) return res.status(400).json({ error: error.response.data.error });
+        console.error("Append Error:", error.message);
+        res.status(500).json({ error: "Append Failed" });
+    }
+});
+
+app.post("/api/docs/read/:fileId", async (req, res) => {
+    try {
+        // 1. Get Metadata from any Master, unless an unexpired lookup still vouches for it
+        const lookupKey = `${req.params.fileId}:${req.body.user_id}`;
+        let lookup = cachedLookup(lookupKey);
+        if (!lookup) {
+            lookup = await readFromMasters('post', `/file/lookup/${req.params.fileId}`, { user_id: req.body.user_id });
+            if (lookup.data.access_expires) {
+                readLookups.set(lookupKey, { lookup, expires: lookup.data.access_expires });
+            }
+        }
+
+        // 2. Read all chunks in parallel and stitch them back together in sequence order
+        try {
+            const parts = await Promise.all(lookup.data.chunks.map(readChunk));
+            // The document version is the list of chunk versions; an editor that
+            // already holds it gets a bodyless 304 instead of the whole text.
+            const version = parts.map((p) => p.version).join(".");
+            if (req.body.if_version === version) return res.status(304).end();
+            return res.json({ content: parts.map((p) => p.content).join(""), version });
+        } catch {
+            readLookups.delete(lookupKey); // Replicas moved or died: look them up again next time
+            res.status(503).json({ error: "Content Unavailable: All replicas unreachable." });
         }
-        
-        res.status(503).json({ error: "Content Unavailable: All replicas unreachable." });
     } catch (e: any) {
+        readLookups.delete(`${req.params.fileId}:${req.body.user_id}`);
         if (e.response?.status === 403) return res.status(403).json({ error: "Denied" });
         res.status(500).json({ error: "Read Error" });
     }
@@ -287,7 +610,7 @@ app.post("/api/access/request", async (req, res) => {
 
 app.get("/api/access/notifications/:userId", async (req, res) => {
     try {
-        const r = await forwardToLeader('get', `/access/pending/${req.params.userId}`);
+        const r = await readFromMasters('get', `/access/pending/${req.params.userId}`);
         res.json(r.data);
     } catch { res.status(500).json({error: "Fetch Failed"}); }
 });
@@ -295,6 +618,7 @@ app.get("/api/access/notifications/:userId", async (req, res) => {
 app.post("/api/access/approve", async (req, res) => {
     try {
         const r = await forwardToLeader('post', '/access/approve', req.body);
+        readLookups.clear();
         res.json(r.data);
     } catch { res.status(500).json({error: "Action Failed"}); }
 });